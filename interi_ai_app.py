@@ -1,16 +1,39 @@
 import asyncio
+import bisect
+import concurrent.futures
+import difflib
+import functools
+import hashlib
+import importlib
 import io
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unicodedata
+import zlib
+from contextlib import asynccontextmanager, closing, suppress
+from urllib.parse import urljoin, urlparse
 
+import cachetools
+import lxml.html
+import numpy as np
 import pandas as pd
+import psutil
 import streamlit as st
 import streamlit_antd_components as sac
-from crawl4ai import (AsyncWebCrawler, BrowserConfig, CrawlerRunConfig, LLMConfig)
-from crawl4ai.content_scraping_strategy import LXMLWebScrapingStrategy
-from crawl4ai.deep_crawling import BFSDeepCrawlStrategy
-from crawl4ai.extraction_strategy import LLMExtractionStrategy
+import xxhash
+from lxml import etree
 from pydantic import BaseModel, Field
-from sitemapparser import SiteMapParser
-from sitemapparser.exporters import JSONExporter
+
+# crawl4ai（Playwright）、litellm、aiohttp、pdfplumberなどスクレイピング・抽出でのみ使うモジュールは、
+# 家具選定の画面を早く表示するため使う関数の中でインポートする
+# （インポート時間の内訳は python interi_ai_bench.py run --stages startup で確認できる）
 
 FURNITURE_CONDITIONS = {
     'テイスト': ['ナチュラル', 'インダストリアル'],
@@ -22,6 +45,3030 @@ FURNITURE_CONDITIONS = {
     '高さ': (0, 3000),
     '座面高': (0, 3000)
 }
+# カテゴリの階層
+FURNITURE_CATEGORIES = {
+    'ソファ': ['1人掛けソファ', '2人掛けソファ', '3人掛けソファ'],
+    'チェア・椅子': ['オフィスチェア・ワークチェア', 'ミーティングチェア', 'ダイニングチェア'],
+}
+# 価格帯の範囲（円、上限は含まない）
+PRICE_BANDS = {
+    'Low': (0, 50000),
+    'Middle': (50000, 150000),
+    'High': (150000, None),
+}
+
+# スクレイピングの同時実行設定
+SCRAPING_MAX_CONCURRENCY = 8  # 全体の最大同時取得数
+SCRAPING_MAX_CONCURRENCY_PER_HOST = 4  # 同一ホストへの最大同時取得数
+SCRAPING_PAGE_TIMEOUT = 60000  # 1ページあたりのタイムアウト（ミリ秒）
+
+
+class ProductInfo(BaseModel):
+    brand_name: str = Field(..., description="ブランド名を表す文字列")
+    item_name: str = Field(..., description="アイテム名を表す文字列")
+    category: str = Field(
+        ...,
+        description="商品カテゴリを表す文字列. 次のいずれか：" +
+        ', '.join(child for children in FURNITURE_CATEGORIES.values() for child in children))
+    taste: str = Field(...,
+                       description="テイストを表す文字列. 次のいずれか、判断できない場合は空文字：" +
+                       ', '.join(FURNITURE_CONDITIONS['テイスト']))
+    delivery: str = Field(...,
+                          description="納期を表す文字列. 次のいずれか、記載が無い場合は空文字：" +
+                          ', '.join(FURNITURE_CONDITIONS['納期']))
+    size: str = Field(..., description="サイズを表す文字列. 例：W500 D500 H550 ")
+    weight: str = Field(..., description="重量を表す文字列. 例：15kg")
+    material: str = Field(..., description="素材を表す文字列. 例：Fabric, Steel")
+    price: str = Field(..., description="価格を表す文字列. 例：￥120,000（税込）")
+    description: str = Field(...,
+                             description="商品説明を表す文字列. 例：このソファは、快適な座り心地とスタイリッシュなデザインを兼ね備えています。")
+    image_urls: list[str] = Field(..., description="商品画像のURLリスト")  # 画像のURLリスト
+
+
+# LLMによる商品情報抽出の設定
+# 環境変数でOpenAI互換のエンドポイントなどに切り替えられる（ベンチマークでは手元のスタブを使う）
+LLM_PROVIDER = os.environ.get('INTERI_AI_LLM_PROVIDER', "gemini/gemini-2.5-flash")
+LLM_API_BASE = os.environ.get('INTERI_AI_LLM_API_BASE')
+LLM_EXTRACTION_INSTRUCTION = '''
+与えられたコンテンツを、以下のJSON形式に変換して出力してください。\n\n
+プログラムコードではなく、JSON形式のデータを出力します。
+JSON以外の文字やコメントは絶対に絶対に絶対に出力しないでください。
+
+# 以下の条件を必ず守ってください:
+- 結果は厳密なJSONオブジェクトを返すこと
+- JSON以外の文字やコメントは絶対に絶対に絶対に出力しない
+# 出力例
+{
+  "brand_name": "ここにブランド名",
+  "item_name": "ここに商品名を出力",
+  "category": "ここに商品カテゴリを出力",
+  "taste": "ここにテイストを出力",
+  "delivery": "ここに納期を出力",
+  "size": "ここにサイズをmm単位に変換して出力",
+  "weight": "ここに重量をkg単位に変換して出力",
+  "material": "ここに素材を出力",
+  "price": "ここに価格を日本円で出力（税込/税抜がわかるように記載）",
+  "description": "ここに商品説明を出力",
+  "image_urls": [
+    "https://example.com/images/item1.jpg",
+    "https://example.com/images/item2.jpg",
+    "https://example.com/images/item3.jpg"
+  ]
+}
+'''
+
+# ローカルデータの保存先
+DATA_DIR = os.environ.get('INTERI_AI_DATA_DIR', 'data')
+
+# LLM抽出結果キャッシュの設定
+LLM_CACHE_DB_PATH = os.path.join(DATA_DIR, 'llm_cache.sqlite3')
+LLM_CACHE_TTL = 60 * 60 * 24 * 30  # キャッシュの有効期間（秒）
+LLM_CACHE_MAX_ENTRIES = 100000  # キャッシュの最大件数
+
+
+def normalize_markdown(markdown):
+    # 空白の揺れでキャッシュが外れないよう、行内の連続空白と空行を正規化
+    lines = [' '.join(line.split()) for line in markdown.splitlines()]
+    return '\n'.join(line for line in lines if line)
+
+
+def make_llm_cache_key(markdown, schema, instruction, model):
+    # ページ内容・スキーマ・指示文・モデルのいずれかが変われば別のキーになる
+    hasher = hashlib.sha256()
+    for part in (normalize_markdown(markdown), json.dumps(schema, sort_keys=True,
+                                                          ensure_ascii=False), instruction, model):
+        hasher.update(part.encode('utf-8'))
+        hasher.update(b'\0')
+    return hasher.hexdigest()
+
+
+class LLMExtractionCache:
+    # LLM抽出結果をSQLiteに保存し、同じ内容のページではLLMを呼ばずに結果を返す
+
+    def __init__(self,
+                 path=LLM_CACHE_DB_PATH,
+                 ttl=LLM_CACHE_TTL,
+                 max_entries=LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._accessed = {}  # 未反映の最終アクセス時刻（読み込みの度に書き込まないよう、evict()でまとめて反映する）
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        import aiosqlite
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # CLIのワーカープロセスが同じファイルを共有するため、WALにしてロック待ちを許容する
+        self._db = await aiosqlite.connect(self.path, timeout=30)
+        await self._db.execute('PRAGMA journal_mode=WAL')
+        await self._db.execute('CREATE TABLE IF NOT EXISTS llm_cache ('
+                               'key TEXT PRIMARY KEY, '
+                               'value TEXT NOT NULL, '
+                               'created_at REAL NOT NULL, '
+                               'accessed_at REAL NOT NULL)')
+        await self._db.execute(
+            'CREATE INDEX IF NOT EXISTS llm_cache_accessed_at ON llm_cache (accessed_at)')
+        await self._db.commit()
+        await self.evict()
+
+    async def close(self):
+        if self._db is not None:
+            await self.evict()
+            await self._db.close()
+            self._db = None
+
+    async def get(self, key):
+        async with self._db.execute('SELECT value, created_at FROM llm_cache WHERE key = ?',
+                                    (key,)) as cursor:
+            row = await cursor.fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._accessed[key] = time.time()
+        return row[0]
+
+    async def set(self, key, value):
+        now = time.time()
+        await self._db.execute(
+            'INSERT OR REPLACE INTO llm_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)',
+            (key, value, now, now))
+        await self._db.commit()
+
+    async def evict(self):
+        # 最終アクセス時刻をまとめて反映してから、期限切れと件数上限を超えた古いものを削除
+        if self._accessed:
+            await self._db.executemany('UPDATE llm_cache SET accessed_at = ? WHERE key = ?',
+                                       [(accessed_at, key) for key, accessed_at in self._accessed.items()])
+            self._accessed = {}
+        await self._db.execute('DELETE FROM llm_cache WHERE created_at < ?',
+                               (time.time() - self.ttl,))
+        await self._db.execute(
+            'DELETE FROM llm_cache WHERE key NOT IN '
+            '(SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT ?)', (self.max_entries,))
+        await self._db.commit()
+
+    async def clear(self):
+        await self._db.execute('DELETE FROM llm_cache')
+        await self._db.commit()
+        self._accessed = {}
+
+
+# インクリメンタル再クロール用のURL毎の状態
+CRAWL_STATE_DB_PATH = os.path.join(DATA_DIR, 'crawl_state.sqlite3')
+CONDITIONAL_REQUEST_TIMEOUT = 30  # 条件付きリクエストのタイムアウト（秒）
+
+
+def normalize_lastmod(value):
+    # サイトマップのlastmodを比較可能なISO形式の文字列に揃える
+    if value is None or pd.isna(value) or value == '':
+        return None
+    try:
+        timestamp = pd.Timestamp(value)
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.tz_convert('UTC')
+        return timestamp.isoformat()
+    except (ValueError, TypeError):
+        return str(value)
+
+
+def get_header(headers, name):
+    # レスポンスヘッダーを大文字小文字を区別せずに取得
+    for key, value in (headers or {}).items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+class CrawlStateStore:
+    # URL毎に前回のlastmodとHTTPバリデータ（ETag/Last-Modified）を保存する
+    # 変更が無い（304）場合に同じ結果を返せるよう、最終的な抽出結果も保存する
+
+    def __init__(self, path=CRAWL_STATE_DB_PATH):
+        self.path = path
+        self._db = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        import aiosqlite
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # CLIのシャード毎のプロセスが同じファイルに書き込むため、WALにしてロック待ちを許容する
+        self._db = await aiosqlite.connect(self.path, timeout=30)
+        await self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.row_factory = aiosqlite.Row
+        await self._db.execute('CREATE TABLE IF NOT EXISTS url_state ('
+                               'url TEXT PRIMARY KEY, '
+                               'lastmod TEXT, '
+                               'etag TEXT, '
+                               'last_modified TEXT, '
+                               'cache_key TEXT, '
+                               'extracted_content TEXT, '
+                               'fetched_at REAL NOT NULL)')
+        await self._db.commit()
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def get_many(self, urls):
+        states = {}
+        urls = list(urls)
+        # SQLiteのプレースホルダ数の上限に収まるよう分割して取得
+        for start in range(0, len(urls), 500):
+            chunk = urls[start:start + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            async with self._db.execute(f'SELECT * FROM url_state WHERE url IN ({placeholders})',
+                                        chunk) as cursor:
+                async for row in cursor:
+                    states[row['url']] = dict(row)
+        return states
+
+    async def update(self, url, lastmod, etag, last_modified, cache_key, extracted_content):
+        await self._db.execute(
+            'INSERT OR REPLACE INTO url_state '
+            '(url, lastmod, etag, last_modified, cache_key, extracted_content, fetched_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (url, lastmod, etag, last_modified, cache_key, extracted_content, time.time()))
+        await self._db.commit()
+
+
+async def classify_incremental_urls(df_urls):
+    # 前回の状態と比較し、URL毎に 新規/更新/未確認/変更なし を判定する
+    #   新規: 前回取得していない
+    #   更新: サイトマップのlastmodが前回と異なる
+    #   未確認: lastmodで判断できないため、スクレイピング時に条件付きリクエストで確認する
+    #   変更なし: lastmodが前回と同じ
+    async with CrawlStateStore() as state_store:
+        states = await state_store.get_many(df_urls['URL'].tolist())
+
+    lastmods = df_urls['lastmod'] if 'lastmod' in df_urls.columns else [None] * len(df_urls)
+    statuses = []
+    for url, lastmod in zip(df_urls['URL'], lastmods):
+        state = states.get(url)
+        lastmod = normalize_lastmod(lastmod)
+        if state is None:
+            statuses.append('新規')
+        elif lastmod is not None and state['lastmod'] is not None:
+            statuses.append('変更なし' if lastmod == state['lastmod'] else '更新')
+        elif state['etag'] or state['last_modified']:
+            statuses.append('未確認')
+        else:
+            statuses.append('更新')
+
+    df_urls = df_urls.copy()
+    df_urls['状態'] = statuses
+    return df_urls
+
+
+# 色・張地・1P/2P/3Pなどの違いしかないバリエーションページの判定
+NEAR_DUPLICATE_DB_PATH = os.path.join(DATA_DIR, 'near_duplicates.sqlite3')
+NEAR_DUPLICATE_SHINGLE_SIZE = 3  # SimHashを計算するトークンの連なりの長さ
+NEAR_DUPLICATE_MAX_DISTANCE = 5  # これ以下のハミング距離のページを同じグループとみなす
+# 64ビットを距離の上限+1個の帯に分ける（距離が上限以下ならいずれかの帯が必ず一致する）
+NEAR_DUPLICATE_BANDS = NEAR_DUPLICATE_MAX_DISTANCE + 1
+NEAR_DUPLICATE_BAND_BITS = -(-64 // NEAR_DUPLICATE_BANDS)
+NEAR_DUPLICATE_MAX_DIFF_RATIO = 0.5  # 差分がページ全体のこの割合を超える場合は通常通り抽出する
+
+
+def compute_simhash(text):
+    # トークンの連なり（shingle）毎の64ビットハッシュを多数決で1つにまとめる
+    tokens = tokenize_japanese(text)
+    shingles = [' '.join(tokens[i:i + NEAR_DUPLICATE_SHINGLE_SIZE])
+                for i in range(max(len(tokens) - NEAR_DUPLICATE_SHINGLE_SIZE + 1, 1))]
+    hashes = np.array([xxhash.xxh64_intdigest(shingle.encode('utf-8')) for shingle in shingles], dtype=np.uint64)
+    bits = (hashes[:, None] >> np.arange(64, dtype=np.uint64)) & np.uint64(1)
+    votes = bits.sum(axis=0, dtype=np.int64) * 2 - len(hashes)
+    return sum(1 << i for i in range(64) if votes[i] > 0)
+
+
+def simhash_bands(simhash):
+    mask = (1 << NEAR_DUPLICATE_BAND_BITS) - 1
+    return [(simhash >> (i * NEAR_DUPLICATE_BAND_BITS)) & mask for i in range(NEAR_DUPLICATE_BANDS)]
+
+
+def to_signed_int64(value):
+    # SQLiteのINTEGERは符号付き64ビットのため変換して保存する
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def diff_llm_input(base, text):
+    # 代表ページに無い行（サイズ・価格・色など、このページで異なる部分）だけを取り出す
+    base_lines = base.splitlines()
+    lines = text.splitlines()
+    matcher = difflib.SequenceMatcher(None, base_lines, lines, autojunk=False)
+    fragments = []
+    for tag, _, _, start, end in matcher.get_opcodes():
+        if tag in ('replace', 'insert'):
+            fragments.extend(lines[start:end])
+    return '\n'.join(fragments)
+
+
+class NearDuplicateIndex:
+    # ページのSimHashと、グループ毎の代表ページの入力・抽出結果を保存する
+    # 同時に処理中のページは、先に抽出を始めた代表ページの結果を待ってから差分のみを抽出する
+
+    def __init__(self, path=NEAR_DUPLICATE_DB_PATH):
+        self.path = path
+        self._db = None
+        self._pending = []  # (simhash, 代表ページのURL, 結果を受け取るFuture)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        import aiosqlite
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._db = await aiosqlite.connect(self.path, timeout=30)
+        await self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.row_factory = aiosqlite.Row
+        band_columns = ''.join(f'band{i} INTEGER NOT NULL, ' for i in range(NEAR_DUPLICATE_BANDS))
+        await self._db.execute('CREATE TABLE IF NOT EXISTS groups ('
+                               'group_url TEXT PRIMARY KEY, '
+                               'simhash INTEGER NOT NULL, '
+                               f'{band_columns}'
+                               'llm_input TEXT NOT NULL, '
+                               'extracted_content TEXT NOT NULL, '
+                               'updated_at REAL NOT NULL)')
+        await self._db.execute('CREATE TABLE IF NOT EXISTS pages ('
+                               'url TEXT PRIMARY KEY, '
+                               'group_url TEXT NOT NULL, '
+                               'distance INTEGER NOT NULL, '
+                               'updated_at REAL NOT NULL)')
+        for i in range(NEAR_DUPLICATE_BANDS):
+            await self._db.execute(f'CREATE INDEX IF NOT EXISTS groups_band{i} ON groups (band{i})')
+        await self._db.commit()
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def find_group(self, url, simhash):
+        # 距離が上限以下で最も近い代表ページを探す（自身が代表のグループは除く）
+        # 見つからない場合はこのページを代表として登録し、抽出結果を渡すFutureを返す
+        conditions = ' OR '.join(f'band{i} = ?' for i in range(NEAR_DUPLICATE_BANDS))
+        best = None
+        async with self._db.execute(
+                f'SELECT group_url, simhash, llm_input, extracted_content FROM groups '
+                f'WHERE group_url != ? AND ({conditions})', (url, *simhash_bands(simhash))) as cursor:
+            async for row in cursor:
+                distance = bin((row['simhash'] & ((1 << 64) - 1)) ^ simhash).count('1')
+                if distance <= NEAR_DUPLICATE_MAX_DISTANCE and (best is None or distance < best['distance']):
+                    best = dict(row, distance=distance)
+        if best is not None:
+            return best, None
+        # 同じ実行中に抽出を始めた代表ページがあれば、その結果を待つ
+        for pending_simhash, group_url, future in self._pending:
+            distance = bin(pending_simhash ^ simhash).count('1')
+            if group_url != url and distance <= NEAR_DUPLICATE_MAX_DISTANCE:
+                group = await asyncio.shield(future)
+                if group is not None:
+                    return dict(group, distance=distance), None
+                break
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((simhash, url, future))
+        return None, future
+
+    async def add_group(self, url, simhash, llm_input, extracted_content, future=None):
+        if extracted_content is not None:
+            await self._db.execute(
+                f'INSERT OR REPLACE INTO groups (group_url, simhash, '
+                f'{"".join(f"band{i}, " for i in range(NEAR_DUPLICATE_BANDS))}'
+                f'llm_input, extracted_content, updated_at) '
+                f'VALUES ({", ".join("?" * (NEAR_DUPLICATE_BANDS + 5))})',
+                (url, to_signed_int64(simhash), *simhash_bands(simhash), llm_input, extracted_content, time.time()))
+            await self._db.commit()
+        if future is not None:
+            # 抽出に失敗した場合は待っているページに通常の抽出をさせる
+            self._pending = [pending for pending in self._pending if pending[2] is not future]
+            future.set_result(None if extracted_content is None else {
+                'group_url': url,
+                'llm_input': llm_input,
+                'extracted_content': extracted_content,
+            })
+
+    async def add_member(self, url, group_url, distance):
+        await self._db.execute('INSERT OR REPLACE INTO pages (url, group_url, distance, updated_at) VALUES (?, ?, ?, ?)',
+                               (url, group_url, distance, time.time()))
+        await self._db.commit()
+
+
+# サイト毎に学習するCSS抽出スキーマ（同じテンプレートのページはLLMを使わずに抽出する）
+SITE_SCHEMA_DB_PATH = os.path.join(DATA_DIR, 'site_schemas.sqlite3')
+SITE_SCHEMA_SAMPLE_PAGES = 3  # スキーマの生成と検証に使う、LLMで抽出したページ数
+SITE_SCHEMA_MAX_ATTEMPTS = 3  # 検証に失敗した場合にサンプルを取り直して生成し直す回数
+SITE_SCHEMA_HTML_MAX_CHARS = 60000  # スキーマの生成でLLMに送るHTMLの最大文字数
+SITE_SCHEMA_MIN_PAGES = 20  # LLMに戻った割合を判定し始めるページ数
+SITE_SCHEMA_MAX_FALLBACK_RATE = 0.5  # これを超えてLLMに戻るスキーマは学習し直す
+# スキーマで抽出する項目（カテゴリとテイストは、カテゴリの表記毎にLLMの判定結果を覚えて引き当てる）
+SITE_SCHEMA_FIELDS = {
+    'brand_name': 'ブランド名',
+    'item_name': '商品名',
+    'category_text': 'パンくずリストなど、商品のカテゴリを表すテキスト',
+    'delivery': '納期',
+    'size': 'サイズ（幅・奥行・高さ）',
+    'weight': '重量',
+    'material': '素材・仕上げ',
+    'price': '価格',
+    'description': '商品説明',
+}
+SITE_SCHEMA_QUERY = (
+    '商品詳細ページ1件から商品情報を取り出すスキーマを作成してください。'
+    'baseSelectorはページ内の商品情報全体を含む1つの要素（main や body など）にし、'
+    'fieldsは次の名前のtext型の項目にしてください（ページに無い項目は含めない）: ' +
+    ', '.join(f'{name}（{label}）' for name, label in SITE_SCHEMA_FIELDS.items()))
+SITE_SCHEMA_DROP_TAGS = ('script', 'style', 'noscript', 'svg', 'iframe', 'template')
+SITE_SCHEMA_KEEP_ATTRIBUTES = ('id', 'class', 'itemprop', 'itemtype', 'role', 'href', 'src', 'alt', 'content', 'name')
+
+
+def compact_html_for_schema(html, max_chars=SITE_SCHEMA_HTML_MAX_CHARS):
+    # スクリプトや装飾用の属性を取り除き、構造とクラス名だけを残してLLMに送る
+    document = lxml.html.fromstring(html)
+    for element in document.xpath(' | '.join(f'//{tag}' for tag in SITE_SCHEMA_DROP_TAGS) + ' | //comment()'):
+        element.drop_tree()
+    for element in document.iter(etree.Element):
+        for name in [name for name in element.attrib if name not in SITE_SCHEMA_KEEP_ATTRIBUTES]:
+            del element.attrib[name]
+    return re.sub(r'\s+', ' ', lxml.html.tostring(document, encoding='unicode'))[:max_chars]
+
+
+def generate_site_schema(html, example):
+    # crawl4aiのスキーマ生成（同期的にLLMを呼ぶため、スレッドで実行する）
+    from crawl4ai import JsonCssExtractionStrategy, LLMConfig
+
+    return JsonCssExtractionStrategy.generate_schema(
+        html=compact_html_for_schema(html),
+        schema_type='CSS',
+        query=SITE_SCHEMA_QUERY,
+        target_json_example=json.dumps(example, ensure_ascii=False),
+        llm_config=LLMConfig(provider=LLM_PROVIDER, api_token=get_llm_api_token(), base_url=LLM_API_BASE))
+
+
+def normalize_field_text(value):
+    return ' '.join(unicodedata.normalize('NFKC', str(value or '')).split()).casefold()
+
+
+def normalize_delivery(text):
+    # 納期の記載を選定条件の選択肢に揃える（該当しない場合は空文字）
+    text = normalize_field_text(text)
+    return next((value for value in FURNITURE_CONDITIONS['納期'] if normalize_field_text(value) in text), '')
+
+
+def site_schema_item_fields(item):
+    # スキーマで抽出した項目をProductInfoの形に揃える（ルールで抽出した項目は反映しない）
+    product = {name: '' for name in ProductInfo.model_fields}
+    product['image_urls'] = []
+    for name in SITE_SCHEMA_FIELDS:
+        if name in product and item.get(name):
+            product[name] = ' '.join(str(item[name]).split())
+    product['delivery'] = normalize_delivery(product['delivery'])
+    return product
+
+
+def build_site_schema_product(item, semantic_map, rule_fields):
+    # スキーマの抽出結果にカテゴリ・テイストとルールで抽出した項目を加える（カテゴリの表記が未知の場合はNone）
+    semantics = semantic_map.get(normalize_field_text(item.get('category_text')))
+    if not item.get('category_text') or semantics is None:
+        return None
+    product = site_schema_item_fields(item)
+    product.update(semantics)
+    return fill_rule_fields(product, rule_fields)
+
+
+def site_schema_texts_agree(value, expected):
+    # 正規化した文字列の一方が他方を含めば一致とみなす（両方とも空の場合も一致）
+    value = normalize_field_text(value)
+    expected = normalize_field_text(expected)
+    if not value or not expected:
+        return value == expected
+    return value in expected or expected in value
+
+
+def validate_site_schema_product(fields, expected=None):
+    # スキーマだけで抽出した項目（site_schema_item_fields()の結果）を検証する
+    # 商品名と、価格・サイズのいずれかが取れていることを確認し、expectedを指定した場合は
+    # 同じページをLLMで抽出した結果と各項目が一致することも確認する
+    if not normalize_field_text(fields.get('item_name')) or not (fields.get('price') or fields.get('size')):
+        return False
+    if expected is None:
+        return True
+    for name in ('item_name', 'brand_name', 'material'):
+        if not site_schema_texts_agree(fields.get(name), expected.get(name)):
+            return False
+    if fields.get('delivery', '') != normalize_delivery(expected.get('delivery')):
+        return False
+    if parse_price(fields.get('price'))[0] != parse_price(expected.get('price'))[0]:
+        return False
+    if parse_size(fields.get('size')) != parse_size(expected.get('size')):
+        return False
+    return True
+
+
+class SiteSchemaStore:
+    # ホスト毎のCSS抽出スキーマと、スキーマの生成・検証に使うサンプルページを保存する
+    #   learning: LLMで抽出したページをサンプルとして集めている
+    #   active: スキーマで抽出し、検証に失敗したページのみLLMで抽出する
+    #   rejected: 生成し直しても検証に通らなかったため、LLMで抽出する
+
+    def __init__(self, path=SITE_SCHEMA_DB_PATH):
+        self.path = path
+        self._db = None
+        self._entries = {}
+        self._strategies = {}
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        import aiosqlite
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._db = await aiosqlite.connect(self.path, timeout=30)
+        await self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.row_factory = aiosqlite.Row
+        await self._db.execute('CREATE TABLE IF NOT EXISTS site_schemas ('
+                               'host TEXT PRIMARY KEY, '
+                               'status TEXT NOT NULL, '
+                               'schema TEXT, '
+                               'semantic_map TEXT NOT NULL, '
+                               'attempts INTEGER NOT NULL, '
+                               'pages INTEGER NOT NULL, '
+                               'fallbacks INTEGER NOT NULL, '
+                               'updated_at REAL NOT NULL)')
+        await self._db.execute('CREATE TABLE IF NOT EXISTS site_schema_samples ('
+                               'host TEXT NOT NULL, '
+                               'url TEXT NOT NULL, '
+                               'html BLOB NOT NULL, '
+                               'product TEXT NOT NULL, '
+                               'rule_fields TEXT NOT NULL, '
+                               'PRIMARY KEY (host, url))')
+        await self._db.commit()
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def get(self, host):
+        if host not in self._entries:
+            async with self._db.execute('SELECT * FROM site_schemas WHERE host = ?', (host,)) as cursor:
+                row = await cursor.fetchone()
+            entry = dict(row) if row is not None else {
+                'host': host, 'status': 'learning', 'schema': None, 'semantic_map': '{}',
+                'attempts': 0, 'pages': 0, 'fallbacks': 0,
+            }
+            entry['schema'] = json.loads(entry['schema']) if entry['schema'] else None
+            entry['semantic_map'] = json.loads(entry['semantic_map'])
+            self._entries[host] = entry
+        return self._entries[host]
+
+    async def _save(self, entry):
+        entry['updated_at'] = time.time()
+        await self._db.execute(
+            'INSERT OR REPLACE INTO site_schemas '
+            '(host, status, schema, semantic_map, attempts, pages, fallbacks, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (entry['host'], entry['status'], json.dumps(entry['schema'], ensure_ascii=False) if entry['schema'] else None,
+             json.dumps(entry['semantic_map'], ensure_ascii=False), entry['attempts'], entry['pages'],
+             entry['fallbacks'], entry['updated_at']))
+        await self._db.commit()
+
+    def extract_item(self, host, url, html, schema=None):
+        # スキーマで1ページ分の項目を取り出す（CPU処理のため、スレッドで実行する）
+        from crawl4ai import JsonCssExtractionStrategy
+
+        if schema is not None:
+            strategy = JsonCssExtractionStrategy(schema)
+        else:
+            if host not in self._strategies:
+                self._strategies[host] = JsonCssExtractionStrategy(self._entries[host]['schema'])
+            strategy = self._strategies[host]
+        items = strategy.extract(url, html)
+        return items[0] if items else {}
+
+    async def add_sample(self, host, url, html, product, rule_fields):
+        await self._db.execute(
+            'INSERT OR REPLACE INTO site_schema_samples (host, url, html, product, rule_fields) VALUES (?, ?, ?, ?, ?)',
+            (host, url, zlib.compress(html.encode('utf-8')), json.dumps(product, ensure_ascii=False),
+             json.dumps(rule_fields, ensure_ascii=False)))
+        await self._db.commit()
+        async with self._db.execute('SELECT COUNT(*) FROM site_schema_samples WHERE host = ?', (host,)) as cursor:
+            return (await cursor.fetchone())[0]
+
+    async def get_samples(self, host):
+        async with self._db.execute('SELECT * FROM site_schema_samples WHERE host = ? LIMIT ?',
+                                    (host, SITE_SCHEMA_SAMPLE_PAGES)) as cursor:
+            rows = await cursor.fetchall()
+        return [{
+            'url': row['url'],
+            'html': zlib.decompress(row['html']).decode('utf-8'),
+            'product': json.loads(row['product']),
+            'rule_fields': json.loads(row['rule_fields']),
+        } for row in rows]
+
+    async def activate(self, host, schema, semantic_map):
+        entry = await self.get(host)
+        entry.update(status='active', schema=schema, pages=0, fallbacks=0)
+        entry['semantic_map'].update(semantic_map)
+        self._strategies.pop(host, None)
+        await self._save(entry)
+        await self._db.execute('DELETE FROM site_schema_samples WHERE host = ?', (host,))
+        await self._db.commit()
+
+    async def reject(self, host):
+        # サンプルを取り直して生成し直す（上限に達したらLLMでの抽出に戻す）
+        entry = await self.get(host)
+        entry['attempts'] += 1
+        entry.update(status='learning' if entry['attempts'] < SITE_SCHEMA_MAX_ATTEMPTS else 'rejected', schema=None)
+        self._strategies.pop(host, None)
+        await self._save(entry)
+        await self._db.execute('DELETE FROM site_schema_samples WHERE host = ?', (host,))
+        await self._db.commit()
+
+    async def add_semantics(self, host, category_text, product):
+        entry = await self.get(host)
+        entry['semantic_map'][normalize_field_text(category_text)] = {
+            'category': product.get('category', ''),
+            'taste': product.get('taste', ''),
+        }
+        await self._save(entry)
+
+    async def record_page(self, host, fallback):
+        # LLMに戻る割合が高いスキーマは学習し直す
+        entry = await self.get(host)
+        entry['pages'] += 1
+        entry['fallbacks'] += int(fallback)
+        if entry['pages'] >= SITE_SCHEMA_MIN_PAGES and \
+                entry['fallbacks'] / entry['pages'] > SITE_SCHEMA_MAX_FALLBACK_RATE:
+            print(f"SiteSchemaStore.record_page() too many fallbacks for {host}, relearning")
+            await self.reject(host)
+        else:
+            await self._save(entry)
+
+    async def clear(self):
+        await self._db.execute('DELETE FROM site_schemas')
+        await self._db.execute('DELETE FROM site_schema_samples')
+        await self._db.commit()
+        self._entries = {}
+        self._strategies = {}
+
+
+# サイトマップ読み込みの設定
+SITEMAP_MAX_CONCURRENCY = 8  # 子サイトマップの最大同時取得数
+SITEMAP_REQUEST_TIMEOUT = 60  # サイトマップ1件あたりのタイムアウト（秒）
+SITEMAP_CHUNK_SIZE = 64 * 1024  # 逐次パースする際の読み込み単位（バイト）
+
+
+def split_patterns(text):
+    # カンマまたは改行区切りの正規表現パターンをリストに変換
+    return [pattern.strip() for pattern in re.split(r'[,\n]', text or '') if pattern.strip()]
+
+
+async def load_sitemap(url,
+                       include_patterns=None,
+                       exclude_patterns=None,
+                       max_concurrency=SITEMAP_MAX_CONCURRENCY):
+    # サイトマップ（サイトマップインデックス、.xml.gzを含む）を非同期で逐次パースし、
+    # URL一覧のDataFrameを直接作成する
+    import aiohttp
+
+    include_res = [re.compile(pattern) for pattern in include_patterns or []]
+    exclude_res = [re.compile(pattern) for pattern in exclude_patterns or []]
+    columns = {'URL': [], 'lastmod': [], 'changefreq': [], 'priority': []}
+    errors = []
+    seen_sitemaps = {url}
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    def accept(loc):
+        if include_res and not any(pattern.search(loc) for pattern in include_res):
+            return False
+        return not any(pattern.search(loc) for pattern in exclude_res)
+
+    def handle_events(parser, child_sitemaps):
+        for _, elem in parser.read_events():
+            tag = etree.QName(elem).localname
+            if tag not in ('url', 'sitemap'):
+                continue
+            values = {etree.QName(child).localname: (child.text or '').strip() for child in elem}
+            loc = values.get('loc')
+            if loc:
+                if tag == 'sitemap':
+                    child_sitemaps.append(loc)
+                elif accept(loc):
+                    columns['URL'].append(loc)
+                    columns['lastmod'].append(values.get('lastmod') or None)
+                    columns['changefreq'].append(values.get('changefreq') or None)
+                    columns['priority'].append(values.get('priority') or None)
+            # 処理済みの要素を解放してメモリ使用量を一定に保つ
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+    async def parse(session, sitemap_url):
+        child_sitemaps = []
+        parser = etree.XMLPullParser(events=('end',), resolve_entities=False, no_network=True)
+        try:
+            async with semaphore:
+                async with session.get(sitemap_url) as response:
+                    response.raise_for_status()
+                    decompressor = None
+                    first_chunk = True
+                    async for chunk in response.content.iter_chunked(SITEMAP_CHUNK_SIZE):
+                        # Content-Encodingではなくファイル自体がgzipの場合は自前で展開
+                        if first_chunk and chunk[:2] == b'\x1f\x8b':
+                            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        first_chunk = False
+                        if decompressor is not None:
+                            chunk = decompressor.decompress(chunk)
+                        parser.feed(chunk)
+                        handle_events(parser, child_sitemaps)
+                    if decompressor is not None:
+                        parser.feed(decompressor.flush())
+                    parser.close()
+                    handle_events(parser, child_sitemaps)
+        except (aiohttp.ClientError, asyncio.TimeoutError, etree.XMLSyntaxError, zlib.error) as e:
+            print(f"load_sitemap() failed to load {sitemap_url}: {e}")
+            errors.append(f"{sitemap_url}: {e}")
+            return
+
+        # 子サイトマップは並行して取得する
+        child_sitemaps = [child for child in child_sitemaps if child not in seen_sitemaps]
+        seen_sitemaps.update(child_sitemaps)
+        await asyncio.gather(*[parse(session, child) for child in child_sitemaps])
+
+    timeout = aiohttp.ClientTimeout(total=SITEMAP_REQUEST_TIMEOUT)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        await parse(session, url)
+
+    df_urls = pd.DataFrame({
+        'URL':
+            pd.Series(columns['URL'], dtype='string'),
+        'lastmod':
+            pd.to_datetime(pd.Series(columns['lastmod'], dtype='object'),
+                           utc=True,
+                           errors='coerce',
+                           format='ISO8601'),
+        'changefreq':
+            pd.Series(columns['changefreq'], dtype='category'),
+        'priority':
+            pd.to_numeric(pd.Series(columns['priority'], dtype='object'),
+                          errors='coerce').astype('float32'),
+    })
+    df_urls = df_urls.drop_duplicates(subset='URL').reset_index(drop=True)
+    return df_urls, errors
+
+
+# サイトマップ解析結果のキャッシュ（再実行・セッションをまたいでURL毎に共有する）
+SITEMAP_CACHE_TTL = 60 * 60  # 有効期間（秒）
+SITEMAP_CACHE_MAX_ENTRIES = 8  # 保持するサイトマップ数の上限
+
+
+@st.cache_data(ttl=SITEMAP_CACHE_TTL, max_entries=SITEMAP_CACHE_MAX_ENTRIES, show_spinner=False)
+def load_sitemap_cached(url):
+    # URLパターンで絞り込む前の一覧をキャッシュし、パターンの変更では再取得しない
+    df_urls, errors = asyncio.run(load_sitemap(url))
+    return df_urls, errors, time.time()
+
+
+def filter_url_table(df_urls, include_patterns=None, exclude_patterns=None):
+    # load_sitemap()と同じ条件（いずれかのincludeに一致し、どのexcludeにも一致しない）で絞り込む
+    include_res = [re.compile(pattern) for pattern in include_patterns or []]
+    exclude_res = [re.compile(pattern) for pattern in exclude_patterns or []]
+    mask = pd.Series(not include_res, index=df_urls.index)
+    for pattern in include_res:
+        mask |= df_urls['URL'].str.contains(pattern, na=False)
+    for pattern in exclude_res:
+        mask &= ~df_urls['URL'].str.contains(pattern, na=False)
+    return df_urls[mask].reset_index(drop=True)
+
+
+# 一覧ページからの商品URL探索の設定
+DISCOVERY_MAX_DEPTH = 2  # 開始ページから辿る一覧ページの深さ
+DISCOVERY_MAX_PAGES = 500  # 取得する一覧ページ数の上限
+DISCOVERY_MAX_CONCURRENCY = 8  # 一覧ページの最大同時取得数
+DISCOVERY_MAX_CONCURRENCY_PER_HOST = 2  # 同じホストへの最大同時取得数
+DISCOVERY_HOST_DELAY = 1.0  # 同じホストへのリクエスト間隔（秒）
+DISCOVERY_REQUEST_TIMEOUT = 60  # 一覧ページ1件あたりのタイムアウト（秒）
+DISCOVERY_BLOOM_CAPACITY = 1000000  # 重複判定で想定するURL数
+DISCOVERY_BLOOM_ERROR_RATE = 0.0001  # 重複判定の偽陽性率
+# ページ送りのリンク（?page=2、/page/2/、?p=2 など）
+PAGINATION_PATTERN = re.compile(r'[?&](?:page|paged|p|pg|start|offset)=\d+|/page/\d+/?$', re.IGNORECASE)
+PAGINATION_PARAM_PATTERN = re.compile(r'^(?:page|paged|p|pg|start|offset)=\d+$', re.IGNORECASE)
+PAGINATION_PATH_PATTERN = re.compile(r'/page/\d+/?$', re.IGNORECASE)
+# 探索対象外のリンク（画像やファイルなど）
+DISCOVERY_SKIP_PATTERN = re.compile(r'\.(?:jpe?g|png|gif|webp|svg|pdf|zip|css|js|xml)(?:$|\?)', re.IGNORECASE)
+# 含めるURLパターンが無い場合に商品ページとみなすURL
+DISCOVERY_PRODUCT_PATTERN = re.compile(
+    r'/(?:products?|items?|goods|detail)/|/(?:products?|items?|goods|detail)[-_]?\w*\.html?$|'
+    r'[?&](?:product|item|goods)(?:_?id|_?code|_?no)?=', re.IGNORECASE)
+TRACKING_PARAM_PATTERN = re.compile(r'^(?:utm_\w+|fbclid|gclid|yclid)$', re.IGNORECASE)
+
+
+class BloomFilter:
+    # 大きなサイトでもメモリ使用量が一定になるURLの重複判定（xxhashのダブルハッシュ）
+
+    def __init__(self, capacity=DISCOVERY_BLOOM_CAPACITY, error_rate=DISCOVERY_BLOOM_ERROR_RATE):
+        self.size = max(8, int(-capacity * np.log(error_rate) / np.log(2)**2))
+        self.hash_count = max(1, round(self.size / capacity * np.log(2)))
+        self.bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+
+    def _positions(self, item):
+        digest = xxhash.xxh3_128_intdigest(item.encode('utf-8'))
+        h1, h2 = digest >> 64, digest & 0xFFFFFFFFFFFFFFFF
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def __contains__(self, item):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(item))
+
+    def add(self, item):
+        # 新しく追加した場合はTrue、既に含まれていた（と判定された）場合はFalseを返す
+        added = False
+        for p in self._positions(item):
+            if not self.bits[p >> 3] & (1 << (p & 7)):
+                self.bits[p >> 3] |= 1 << (p & 7)
+                added = True
+        return added
+
+
+class HostRateLimiter:
+    # ホスト毎の同時取得数とリクエスト間隔を制限する
+
+    def __init__(self, max_concurrency_per_host=DISCOVERY_MAX_CONCURRENCY_PER_HOST, delay=DISCOVERY_HOST_DELAY):
+        self.max_concurrency_per_host = max_concurrency_per_host
+        self.delay = delay
+        self.semaphores = {}
+        self.locks = {}
+        self.next_times = {}
+
+    @asynccontextmanager
+    async def limit(self, url):
+        host = urlparse(url).netloc
+        semaphore = self.semaphores.setdefault(host, asyncio.Semaphore(self.max_concurrency_per_host))
+        async with semaphore:
+            async with self.locks.setdefault(host, asyncio.Lock()):
+                wait = self.next_times.get(host, 0) - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                self.next_times[host] = time.monotonic() + self.delay
+            yield
+
+
+def strip_pagination(url):
+    # ページ送りのパラメータとパスを除き、同じ一覧のページが同じURLになるようにする
+    parsed = urlparse(url)
+    query = '&'.join(param for param in parsed.query.split('&')
+                     if param and not PAGINATION_PARAM_PATTERN.match(param))
+    path = PAGINATION_PATH_PATTERN.sub('', parsed.path).rstrip('/')
+    return parsed._replace(path=path, query=query).geturl()
+
+
+def normalize_url(url):
+    # 重複判定のため、フラグメントとトラッキング用のパラメータを除いてURLを揃える
+    parsed = urlparse(url)
+    query = '&'.join(param for param in parsed.query.split('&')
+                     if param and not TRACKING_PARAM_PATTERN.match(param.split('=', 1)[0]))
+    return parsed._replace(scheme=parsed.scheme.lower(), netloc=parsed.netloc.lower(), query=query,
+                           fragment='').geturl()
+
+
+async def discover_product_urls(start_url,
+                                include_patterns=None,
+                                exclude_patterns=None,
+                                max_depth=DISCOVERY_MAX_DEPTH,
+                                max_pages=DISCOVERY_MAX_PAGES,
+                                max_concurrency=DISCOVERY_MAX_CONCURRENCY,
+                                max_concurrency_per_host=DISCOVERY_MAX_CONCURRENCY_PER_HOST,
+                                host_delay=DISCOVERY_HOST_DELAY,
+                                errors=None):
+    # ブランドやカテゴリの一覧ページから、ページ送りと配下の一覧ページを並行して辿り、
+    # 見つかった商品URLを逐次返す
+    # 含めるURLパターン（無い場合は商品ページらしいURL）に一致するリンクを商品ページ、
+    # 開始URLの配下かページ送りのリンクを一覧ページとみなす
+    import aiohttp
+
+    include_res = [re.compile(pattern) for pattern in include_patterns or []]
+    exclude_res = [re.compile(pattern) for pattern in exclude_patterns or []]
+    start_url = normalize_url(start_url)
+    start = urlparse(start_url)
+    scope_path = start.path if start.path.endswith('/') else start.path.rsplit('/', 1)[0] + '/'
+    errors = errors if errors is not None else []
+
+    # 商品URLは返したものだけをBloomフィルタに記録し、一覧ページは浅い深さで見つかった場合に辿り直せるよう
+    # キューに入れた深さを記録する
+    seen = BloomFilter()
+    page_depths = {start_url: 0}
+    pages = asyncio.Queue()
+    found = asyncio.Queue()
+    limiter = HostRateLimiter(max_concurrency_per_host, host_delay)
+    page_count = 0
+
+    def is_listing(url):
+        parsed = urlparse(url)
+        return parsed.path.startswith(scope_path) or bool(PAGINATION_PATTERN.search(url))
+
+    def is_product(url):
+        if include_res:
+            return any(pattern.search(url) for pattern in include_res)
+        return bool(DISCOVERY_PRODUCT_PATTERN.search(url)) and not PAGINATION_PATTERN.search(url)
+
+    async def crawl_page(session, url, depth):
+        try:
+            async with limiter.limit(url), session.get(url) as response:
+                response.raise_for_status()
+                content = await response.read()
+                base_url = str(response.url)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"discover_product_urls() failed to load {url}: {e}")
+            errors.append(f"{url}: {e}")
+            return
+        try:
+            document = lxml.html.fromstring(content)
+        except (etree.ParserError, ValueError) as e:
+            errors.append(f"{url}: {e}")
+            return
+        for href in document.xpath('//a/@href'):
+            link = normalize_url(urljoin(base_url, href.strip()))
+            parsed = urlparse(link)
+            # 同じホストのページのみ対象にする
+            if parsed.scheme not in ('http', 'https') or parsed.netloc != start.netloc or \
+                    DISCOVERY_SKIP_PATTERN.search(link):
+                continue
+            if any(pattern.search(link) for pattern in exclude_res):
+                continue
+            if is_product(link):
+                if seen.add(link):
+                    await found.put({'URL': link, '取得元': url})
+                continue
+            if PAGINATION_PATTERN.search(link) and strip_pagination(link) == strip_pagination(url):
+                # 同じ一覧の次のページは深さを変えずに辿る（ページ数はmax_pagesで制限する）
+                link_depth = depth
+            elif is_listing(link):
+                link_depth = depth + 1
+            else:
+                continue
+            if link_depth <= max_depth and link_depth < page_depths.get(link, max_depth + 1):
+                page_depths[link] = link_depth
+                await pages.put((link, link_depth))
+
+    async def worker(session):
+        nonlocal page_count
+        while True:
+            url, depth = await pages.get()
+            try:
+                if page_count < max_pages:
+                    page_count += 1
+                    await crawl_page(session, url, depth)
+            finally:
+                pages.task_done()
+
+    async def run(session):
+        await pages.put((start_url, 0))
+        workers = [asyncio.create_task(worker(session)) for _ in range(max_concurrency)]
+        await pages.join()
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await found.put(None)
+
+    timeout = aiohttp.ClientTimeout(total=DISCOVERY_REQUEST_TIMEOUT)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        runner = asyncio.create_task(run(session))
+        try:
+            while (item := await found.get()) is not None:
+                yield item
+        finally:
+            runner.cancel()
+            await asyncio.gather(runner, return_exceptions=True)
+
+
+# 商品カタログの保存先
+CATALOG_DB_PATH = os.path.join(DATA_DIR, 'catalog.sqlite3')
+# 抽出したサイズ・重量・価格を数値化したカラムを持つ商品テーブル
+CATALOG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS products (
+    url TEXT PRIMARY KEY,
+    brand_name TEXT,
+    item_name TEXT,
+    category TEXT,
+    taste TEXT,
+    delivery TEXT,
+    size TEXT,
+    weight TEXT,
+    material TEXT,
+    price TEXT,
+    description TEXT,
+    image_urls TEXT,
+    width_mm REAL,
+    depth_mm REAL,
+    height_mm REAL,
+    seat_height_mm REAL,
+    weight_kg REAL,
+    price_yen INTEGER,
+    price_tax_included INTEGER,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS products_brand_name ON products (brand_name);
+CREATE INDEX IF NOT EXISTS products_category ON products (category);
+CREATE INDEX IF NOT EXISTS products_taste ON products (taste);
+CREATE INDEX IF NOT EXISTS products_delivery ON products (delivery);
+CREATE INDEX IF NOT EXISTS products_width_mm ON products (width_mm);
+CREATE INDEX IF NOT EXISTS products_depth_mm ON products (depth_mm);
+CREATE INDEX IF NOT EXISTS products_height_mm ON products (height_mm);
+CREATE INDEX IF NOT EXISTS products_seat_height_mm ON products (seat_height_mm);
+CREATE INDEX IF NOT EXISTS products_price_yen ON products (price_yen);
+'''
+# 範囲検索できる数値カラム
+CATALOG_RANGE_COLUMNS = {
+    'width': 'width_mm',
+    'depth': 'depth_mm',
+    'height': 'height_mm',
+    'seat_height': 'seat_height_mm',
+    'weight': 'weight_kg',
+    'price': 'price_yen',
+}
+
+SIZE_PATTERN = re.compile(r'(?<![A-Za-z])(SH|W|D|H)\s*[:.]?\s*(\d+(?:\.\d+)?)\s*(mm|cm|m)?(?![A-Za-z])')
+SIZE_TRIPLE_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s*[×xX*]\s*(\d+(?:\.\d+)?)\s*[×xX*]\s*(\d+(?:\.\d+)?)')
+WEIGHT_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s*(kg|g)(?![A-Za-z])', re.IGNORECASE)
+PRICE_PATTERN = re.compile(r'¥\s*(\d[\d,]*)|(\d[\d,]*)\s*円')
+UNIT_TO_MM = {'mm': 1.0, 'cm': 10.0, 'm': 1000.0}
+
+
+def parse_size(size):
+    # 'W500 D500 H550 SH420' のような文字列から幅・奥行・高さ・座面高（mm）を取り出す
+    text = unicodedata.normalize('NFKC', size or '').replace(',', '')
+    default_unit = 'cm' if re.search(r'\dcm', text) and 'mm' not in text else 'mm'
+    dims = {'W': None, 'D': None, 'H': None, 'SH': None}
+    for key, value, unit in SIZE_PATTERN.findall(text):
+        if dims[key] is None:
+            dims[key] = float(value) * UNIT_TO_MM[unit or default_unit]
+    if all(value is None for value in dims.values()):
+        # 'W×D×H' の順に数値だけが並んでいる場合
+        match = SIZE_TRIPLE_PATTERN.search(text)
+        if match:
+            dims['W'], dims['D'], dims['H'] = (float(value) * UNIT_TO_MM[default_unit]
+                                               for value in match.groups())
+    return dims['W'], dims['D'], dims['H'], dims['SH']
+
+
+def parse_weight(weight):
+    # '15kg' や '1500g' のような文字列から重量（kg）を取り出す
+    match = WEIGHT_PATTERN.search(unicodedata.normalize('NFKC', weight or ''))
+    if match is None:
+        return None
+    value = float(match.group(1))
+    return value / 1000 if match.group(2).lower() == 'g' else value
+
+
+def parse_price(price):
+    # '￥120,000（税込）' のような文字列から価格（円）と税込かどうかを取り出す
+    text = unicodedata.normalize('NFKC', price or '')
+    match = PRICE_PATTERN.search(text)
+    if match is None:
+        return None, None
+    price_yen = int((match.group(1) or match.group(2)).replace(',', ''))
+    if '税込' in text:
+        tax_included = 1
+    elif '税抜' in text or '税別' in text:
+        tax_included = 0
+    else:
+        tax_included = None
+    return price_yen, tax_included
+
+
+def parse_extracted_product(extracted_content):
+    # LLM抽出結果（JSON）から最初の有効な商品情報を取り出す
+    try:
+        blocks = json.loads(extracted_content or '[]')
+    except json.JSONDecodeError:
+        return None
+    if isinstance(blocks, dict):
+        blocks = [blocks]
+    for block in blocks:
+        if isinstance(block, dict) and not block.get('error') and block.get('item_name'):
+            return block
+    return None
+
+
+def build_catalog_row(url, product):
+    width, depth, height, seat_height = parse_size(product.get('size'))
+    price_yen, price_tax_included = parse_price(product.get('price'))
+    return {
+        'url': url,
+        'brand_name': product.get('brand_name') or '',
+        'item_name': product.get('item_name') or '',
+        'category': product.get('category') or '',
+        'taste': product.get('taste') or '',
+        'delivery': product.get('delivery') or '',
+        'size': product.get('size') or '',
+        'weight': product.get('weight') or '',
+        'material': product.get('material') or '',
+        'price': product.get('price') or '',
+        'description': product.get('description') or '',
+        'image_urls': json.dumps(product.get('image_urls') or [], ensure_ascii=False),
+        'width_mm': width,
+        'depth_mm': depth,
+        'height_mm': height,
+        'seat_height_mm': seat_height,
+        'weight_kg': parse_weight(product.get('weight')),
+        'price_yen': price_yen,
+        'price_tax_included': price_tax_included,
+        'updated_at': time.time(),
+    }
+
+
+# 既存のカタログに後から追加したカラム
+CATALOG_ADDED_COLUMNS = {
+    'taste': 'TEXT',
+    'delivery': 'TEXT',
+}
+
+
+def open_catalog(path=CATALOG_DB_PATH):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    conn = sqlite3.connect(path)
+    # 古いカタログには追加したカラムが無いため、インデックス作成前に追加する
+    table_exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products'").fetchone()
+    if table_exists:
+        existing_columns = {row[1] for row in conn.execute('PRAGMA table_info(products)')}
+        for column, column_type in CATALOG_ADDED_COLUMNS.items():
+            if column not in existing_columns:
+                conn.execute(f'ALTER TABLE products ADD COLUMN {column} {column_type}')
+    conn.executescript(CATALOG_SCHEMA)
+    return conn
+
+
+def save_products(records, path=CATALOG_DB_PATH):
+    # スクレイピング結果を商品カタログにURL単位でupsertする
+    rows = []
+    for record in records:
+        if not record['success']:
+            continue
+        product = parse_extracted_product(record['extracted_content'])
+        if product is not None:
+            rows.append(build_catalog_row(record['url'], product))
+    if not rows:
+        return 0
+
+    columns = list(rows[0].keys())
+    updates = ', '.join(f'{column} = excluded.{column}' for column in columns if column != 'url')
+    with closing(open_catalog(path)) as conn, conn:
+        conn.executemany(
+            f"INSERT INTO products ({', '.join(columns)}) "
+            f"VALUES ({', '.join(':' + column for column in columns)}) "
+            f"ON CONFLICT(url) DO UPDATE SET {updates}", rows)
+    return len(rows)
+
+
+def query_catalog(brand_name=None,
+                  category=None,
+                  urls=None,
+                  limit=None,
+                  path=CATALOG_DB_PATH,
+                  **ranges):
+    # インデックス付きのカラムで商品カタログを検索する
+    # ranges には width=(500, 1000) のように CATALOG_RANGE_COLUMNS のキーで範囲を指定する
+    conditions = []
+    params = []
+    if urls is not None:
+        conditions.append(f"url IN ({', '.join('?' * len(urls))})")
+        params.extend(urls)
+    if brand_name:
+        conditions.append('brand_name = ?')
+        params.append(brand_name)
+    if category:
+        categories = [category] if isinstance(category, str) else list(category)
+        conditions.append(f"category IN ({', '.join('?' * len(categories))})")
+        params.extend(categories)
+    for key, (low, high) in ranges.items():
+        column = CATALOG_RANGE_COLUMNS[key]
+        conditions.append(f'{column} BETWEEN ? AND ?')
+        params.extend([low, high])
+    sql = 'SELECT * FROM products'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    with closing(open_catalog(path)) as conn:
+        return pd.read_sql_query(sql, conn, params=params)
+
+
+# LLM抽出前の前処理の設定
+LLM_INPUT_TOKEN_BUDGET = 4000  # LLMに送る本文の最大トークン数
+LLM_MAX_IMAGE_URLS = 10  # ルールで抽出する画像URLの最大数
+LLM_PRUNED_MIN_CHARS = 200  # 商品部分の抽出結果がこれより短い場合はページ全体を使う
+TOKEN_ENCODING = 'cl100k_base'
+MARKDOWN_IMAGE_PATTERN = re.compile(r'!\[[^\]]*\]\(([^)\s]+)[^)]*\)')
+MARKDOWN_LINK_PATTERN = re.compile(r'\[([^\]]*)\]\([^)]*\)')
+IMAGE_EXTENSION_PATTERN = re.compile(r'\.(jpe?g|png|webp|gif)(\?|$)', re.IGNORECASE)
+# ルールで抽出する項目は、項目名のある記載（「/」区切りの1項目）からのみ取り出す
+RULE_SEGMENT_SEPARATOR_PATTERN = re.compile(r'[/／]')
+RULE_WEIGHT_LABEL_PATTERN = re.compile(r'重量|重さ')
+RULE_PRICE_LABEL_PATTERN = re.compile(r'価格|税込|税抜|税別')
+RULE_EXCLUDED_LABEL_PATTERN = re.compile(r'送料|耐荷重|ポイント')
+
+
+@functools.lru_cache(maxsize=1)
+def get_token_encoding():
+    # tiktokenの語彙を取得できない環境では概算でトークン数を数える
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(TOKEN_ENCODING)
+    except Exception as e:
+        print(f"get_token_encoding() failed to load {TOKEN_ENCODING}: {e}")
+        return None
+
+
+def count_tokens(text):
+    encoding = get_token_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    # 概算：日本語は1文字1トークン、英数字は4文字1トークン
+    ascii_count = sum(1 for c in text if c.isascii())
+    return (len(text) - ascii_count) + ascii_count // 4
+
+
+def truncate_to_token_budget(text, budget):
+    encoding = get_token_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= budget else encoding.decode(tokens[:budget])
+    token_count = count_tokens(text)
+    if token_count <= budget:
+        return text
+    return text[:int(len(text) * budget / token_count)]
+
+
+def format_price(price_yen, tax_included):
+    tax_label = {1: '（税込）', 0: '（税抜）'}.get(tax_included, '')
+    return f'￥{price_yen:,}{tax_label}'
+
+
+def extract_product_fields_by_rules(markdown, images=None):
+    # 価格・サイズ・重量・画像URLなど、ルールで確実に取れる項目をLLMを使わずに抽出する
+    # 重量と価格は耐荷重・送料・ポイントなどの紛らわしい記載を除き、項目名のある記載からのみ取り出す
+    fields = {}
+    for line in normalize_markdown(markdown).splitlines():
+        if 'size' not in fields:
+            width, depth, height, seat_height = parse_size(line)
+            dims = [('W', width), ('D', depth), ('H', height), ('SH', seat_height)]
+            if sum(value is not None for _, value in dims) >= 2:
+                fields['size'] = ' '.join(f'{key}{value:g}' for key, value in dims
+                                          if value is not None)
+        for segment in RULE_SEGMENT_SEPARATOR_PATTERN.split(line):
+            if RULE_EXCLUDED_LABEL_PATTERN.search(segment):
+                continue
+            if 'weight' not in fields and RULE_WEIGHT_LABEL_PATTERN.search(segment):
+                weight_kg = parse_weight(segment)
+                if weight_kg is not None:
+                    fields['weight'] = f'{weight_kg:g}kg'
+            if 'price' not in fields and RULE_PRICE_LABEL_PATTERN.search(segment):
+                price_yen, tax_included = parse_price(segment)
+                if price_yen is not None:
+                    fields['price'] = format_price(price_yen, tax_included)
+
+    # 画像は商品部分のmarkdownにあるものを優先し、無ければクローラーが取得したメディア情報を
+    # 関連度の高い順に使う
+    image_urls = MARKDOWN_IMAGE_PATTERN.findall(markdown)
+    if not image_urls:
+        images = sorted(images or [], key=lambda image: image.get('score') or 0, reverse=True)
+        image_urls = [image.get('src') for image in images]
+    image_urls = [
+        image_url for image_url in dict.fromkeys(image_urls)
+        if image_url and IMAGE_EXTENSION_PATTERN.search(image_url)
+    ]
+    if image_urls:
+        fields['image_urls'] = image_urls[:LLM_MAX_IMAGE_URLS]
+    return fields
+
+
+def prepare_llm_input(markdown, budget=LLM_INPUT_TOKEN_BUDGET):
+    # 画像とリンクのURLを取り除き、トークン数の上限で切り詰める
+    text = MARKDOWN_IMAGE_PATTERN.sub('', markdown)
+    text = MARKDOWN_LINK_PATTERN.sub(r'\1', text)
+    text = normalize_markdown(text)
+    return truncate_to_token_budget(text, budget)
+
+
+def fill_rule_fields(product, rule_fields):
+    # LLMが空にした項目だけをルールで抽出した値で補う（LLMの値は上書きしない）
+    for name, value in rule_fields.items():
+        if not product.get(name):
+            product[name] = value
+    return product
+
+
+def merge_rule_fields(extracted_content, rule_fields):
+    if not rule_fields:
+        return extracted_content
+    try:
+        blocks = json.loads(extracted_content)
+    except json.JSONDecodeError:
+        return extracted_content
+    for block in blocks if isinstance(blocks, list) else [blocks]:
+        if isinstance(block, dict) and not block.get('error'):
+            fill_rule_fields(block, rule_fields)
+    return json.dumps(blocks, ensure_ascii=False)
+
+
+# LLM抽出ステージの設定（Geminiのクォータに合わせて調整する）
+LLM_MAX_CONCURRENCY = 8  # LLMへの最大同時リクエスト数
+LLM_REQUESTS_PER_MINUTE = 1000  # 1分あたりのリクエスト数の上限
+LLM_TOKENS_PER_MINUTE = 1000000  # 1分あたりの入力トークン数の上限
+LLM_MAX_OUTPUT_TOKENS = 65536
+LLM_MAX_RETRIES = 6  # 429/5xxの場合の最大試行回数
+LLM_RETRY_MAX_WAIT = 60  # リトライ間隔の上限（秒）
+LLM_BATCH_MAX_PAGES = 5  # 1リクエストにまとめる最大ページ数
+LLM_BATCH_MAX_TOKENS = 8000  # 1リクエストにまとめる入力トークン数の上限
+LLM_BATCH_PAGE_MAX_TOKENS = 1500  # これより小さいページだけをまとめる
+LLM_BATCH_WAIT_SECONDS = 0.5  # まとめるページが揃うのを待つ時間
+LLM_BATCH_INSTRUCTION = '''
+以下に複数の商品ページのコンテンツがあります。各ページをそれぞれ上記のJSON形式に変換し、
+{"products": [...]} の形式で出力してください。
+各要素には、対応するページのURLを "url" キーで必ず含めてください。
+'''
+# バリエーションページは代表ページの抽出結果と、このページで異なる部分のみを送る
+LLM_VARIANT_INSTRUCTION = '''
+以下は同じ商品シリーズの別のページから抽出済みの商品情報と、このページでその抽出元と異なる部分です。
+異なる部分から読み取れる項目（商品名・サイズ・価格・素材・重量など）だけを、上記のJSON形式のキーで出力してください。
+抽出済みの商品情報と同じ値の項目や、異なる部分から読み取れない項目は出力しないでください。
+'''
+LLM_RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    # トークンバケット方式のレート制限（1分あたりの上限を平準化して払い出す）
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        # 待ち時間はロック内で予約して計算し、待つ間は他の呼び出しを塞がない（不足分は負の残量になる）
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def is_retryable_llm_error(e):
+    # レート制限（429）とサーバーエラー（5xx）、接続エラーはリトライする
+    import litellm
+
+    if isinstance(e, (litellm.RateLimitError, litellm.InternalServerError,
+                      litellm.ServiceUnavailableError, litellm.APIConnectionError, litellm.Timeout)):
+        return True
+    return getattr(e, 'status_code', None) in LLM_RETRYABLE_STATUS_CODES
+
+
+def parse_llm_json(text):
+    # LLMの出力からJSONを取り出す（コードブロックや前後の文字列が付いていても読めるようにする）
+    text = re.sub(r'^```(?:json)?\s*|\s*```$', '', (text or '').strip())
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        start = min((i for i in (text.find('{'), text.find('[')) if i >= 0), default=-1)
+        end = max(text.rfind('}'), text.rfind(']'))
+        if start < 0 or end <= start:
+            raise
+        return json.loads(text[start:end + 1])
+
+
+class LLMExtractionStage:
+    # ページ取得とは独立した非同期のLLM抽出ステージ
+    # キューで受け付けたページを複数のワーカーで並行して処理し、リクエスト数・トークン数の
+    # レート制限と429/5xxのリトライを行う。バッチモードでは小さいページを1リクエストにまとめる
+
+    def __init__(self,
+                 concurrency=LLM_MAX_CONCURRENCY,
+                 batching=False,
+                 request_limiter=None,
+                 token_limiter=None):
+        self.concurrency = concurrency
+        self.batching = batching
+        self.request_limiter = request_limiter or TokenBucket(LLM_REQUESTS_PER_MINUTE)
+        self.token_limiter = token_limiter or TokenBucket(LLM_TOKENS_PER_MINUTE)
+        self.schema = ProductInfo.model_json_schema()
+        self.prompt_header = (f"{LLM_EXTRACTION_INSTRUCTION}\n\n# スキーマ\n"
+                              f"{json.dumps(self.schema, ensure_ascii=False)}\n")
+        self.prompt_header_tokens = count_tokens(self.prompt_header)
+        self._queue = None
+        self._collect_lock = None
+        self._workers = []
+
+    async def __aenter__(self):
+        self._queue = asyncio.Queue()
+        self._collect_lock = asyncio.Lock()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def extract(self, url, llm_input, tokens=None, base_product=None):
+        # 抽出結果（JSON文字列）と使用トークン数・処理時間を返す
+        # base_productを指定した場合、llm_inputは代表ページとの差分で、異なる項目のみを抽出して上書きする
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put({
+            'url': url,
+            'llm_input': llm_input,
+            'tokens': tokens if tokens is not None else count_tokens(llm_input),
+            'base_product': base_product,
+            'single': False,  # バッチの応答に含まれなかったページは1ページずつ処理する
+            'future': future,
+        })
+        return await future
+
+    async def _worker(self):
+        while True:
+            # バッチを集めている間に他のワーカーがページを取り出さないよう、取り出しは1つずつ行う
+            async with self._collect_lock:
+                jobs = [await self._queue.get()]
+                if self.batching and self._can_batch(jobs[0]):
+                    await self._collect_batch(jobs)
+            try:
+                await self._run(jobs)
+            except Exception as e:
+                for job in jobs:
+                    self._set_exception(job, e)
+            finally:
+                for _ in jobs:
+                    self._queue.task_done()
+
+    async def _collect_batch(self, jobs):
+        # 上限に達するか待ち時間が過ぎるまで、小さいページを集める
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + LLM_BATCH_WAIT_SECONDS
+        total_tokens = jobs[0]['tokens']
+        while len(jobs) < LLM_BATCH_MAX_PAGES:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                job = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if not self._can_batch(job) or total_tokens + job['tokens'] > LLM_BATCH_MAX_TOKENS:
+                # まとめられないページはキューに戻す
+                self._queue.put_nowait(job)
+                self._queue.task_done()
+                break
+            jobs.append(job)
+            total_tokens += job['tokens']
+
+    @staticmethod
+    def _can_batch(job):
+        return job['base_product'] is None and not job['single'] and job['tokens'] <= LLM_BATCH_PAGE_MAX_TOKENS
+
+    @staticmethod
+    def _set_result(job, result):
+        # 呼び出し元がキャンセルした場合は結果を捨てる
+        if not job['future'].done():
+            job['future'].set_result(result)
+
+    @staticmethod
+    def _set_exception(job, e):
+        if not job['future'].done():
+            job['future'].set_exception(e)
+
+    async def _run(self, jobs):
+        if len(jobs) == 1:
+            try:
+                self._set_result(jobs[0], await self._run_single(jobs[0]))
+            except Exception as e:
+                self._set_exception(jobs[0], e)
+            return
+        try:
+            results = await self._run_batch(jobs)
+        except Exception as e:
+            for job in jobs:
+                self._set_exception(job, e)
+            return
+        for job in jobs:
+            if job['url'] in results:
+                self._set_result(job, results[job['url']])
+            elif not job['future'].done():
+                # バッチの応答に含まれなかったページは1ページずつのジョブとしてキューに戻し、他のワーカーで並行して処理する
+                self._queue.put_nowait(dict(job, single=True))
+
+    async def _run_single(self, job):
+        if job['base_product'] is None:
+            prompt = f"{self.prompt_header}\n# URL\n{job['url']}\n\n# コンテンツ\n{job['llm_input']}"
+        else:
+            prompt = (f"{self.prompt_header}\n{LLM_VARIANT_INSTRUCTION}\n# 抽出済みの商品情報\n"
+                      f"{json.dumps(job['base_product'], ensure_ascii=False)}\n\n# URL\n{job['url']}\n\n"
+                      f"# このページで異なる部分\n{job['llm_input']}")
+        content, prompt_tokens, completion_tokens, seconds = await self._complete(
+            prompt, self.prompt_header_tokens + job['tokens'])
+        blocks = parse_llm_json(content)
+        blocks = blocks if isinstance(blocks, list) else [blocks]
+        if job['base_product'] is not None:
+            # 読み取れた項目だけを代表ページの抽出結果に上書きする
+            fields = next((block for block in blocks if isinstance(block, dict)), {})
+            blocks = [dict(job['base_product'], **{
+                key: value for key, value in fields.items()
+                if key in ProductInfo.model_fields and value not in (None, '', [])
+            })]
+        return {
+            'extracted_content': json.dumps(blocks, ensure_ascii=False),
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'seconds': seconds,
+        }
+
+    async def _run_batch(self, jobs):
+        sections = '\n\n'.join(f"## URL: {job['url']}\n{job['llm_input']}" for job in jobs)
+        prompt = f"{self.prompt_header}\n{LLM_BATCH_INSTRUCTION}\n# コンテンツ\n{sections}"
+        total_tokens = sum(job['tokens'] for job in jobs)
+        content, prompt_tokens, completion_tokens, seconds = await self._complete(
+            prompt, self.prompt_header_tokens + total_tokens)
+        try:
+            products = parse_llm_json(content)
+        except json.JSONDecodeError as e:
+            print(f"LLMExtractionStage._run_batch() invalid response: {e}")
+            return {}
+        if isinstance(products, dict):
+            products = products.get('products', [])
+        # URLで各ページに対応付け、使用トークン数はページの大きさで按分する
+        job_tokens = {job['url']: job['tokens'] for job in jobs}
+        results = {}
+        for product in products:
+            if not isinstance(product, dict) or product.get('url') not in job_tokens:
+                continue
+            url = product.pop('url')
+            share = job_tokens[url] / max(total_tokens, 1)
+            results[url] = {
+                'extracted_content': json.dumps([product], ensure_ascii=False),
+                'prompt_tokens': round(prompt_tokens * share),
+                'completion_tokens': round(completion_tokens * share),
+                'seconds': seconds,
+            }
+        return results
+
+    async def _complete(self, prompt, estimated_tokens):
+        import litellm
+        from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+        async for attempt in AsyncRetrying(retry=retry_if_exception(is_retryable_llm_error),
+                                           wait=wait_random_exponential(multiplier=1,
+                                                                        max=LLM_RETRY_MAX_WAIT),
+                                           stop=stop_after_attempt(LLM_MAX_RETRIES),
+                                           reraise=True):
+            with attempt:
+                await self.request_limiter.acquire()
+                await self.token_limiter.acquire(estimated_tokens)
+                started = time.perf_counter()
+                response = await litellm.acompletion(model=LLM_PROVIDER,
+                                                     messages=[{
+                                                         'role': 'user',
+                                                         'content': prompt
+                                                     }],
+                                                     api_key=get_llm_api_token(),
+                                                     api_base=LLM_API_BASE,
+                                                     temperature=0.0,
+                                                     max_tokens=LLM_MAX_OUTPUT_TOKENS,
+                                                     response_format={'type': 'json_object'})
+        usage = getattr(response, 'usage', None)
+        return (response.choices[0].message.content, getattr(usage, 'prompt_tokens', 0) or 0,
+                getattr(usage, 'completion_tokens', 0) or 0, time.perf_counter() - started)
+
+
+# パイプラインの計測（LLMの料金はGemini 2.5 Flashの100万トークンあたりの米ドル）
+LLM_PRICE_PER_MILLION_PROMPT_TOKENS = float(os.environ.get('INTERI_AI_LLM_PRICE_PROMPT', 0.30))
+LLM_PRICE_PER_MILLION_COMPLETION_TOKENS = float(os.environ.get('INTERI_AI_LLM_PRICE_COMPLETION', 2.50))
+METRICS_DIR = os.path.join(DATA_DIR, 'metrics')
+# URL毎に計測する処理段階
+PIPELINE_STAGES = {
+    'wait': '取得待ち',
+    'conditional_request': '条件付きリクエスト',
+    'page_load': 'ページ読み込み',
+    'markdown': 'markdown生成',
+    'preprocess': '前処理',
+    'schema_extraction': 'CSSスキーマ抽出',
+    'llm_wait': 'LLM待ち',
+    'llm': 'LLM',
+}
+PIPELINE_LATENCY_QUANTILES = (0.5, 0.95, 0.99)
+# 処理時間のヒストグラムのバケットの上限（秒）
+PIPELINE_LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+PIPELINE_HISTOGRAMS = list(PIPELINE_STAGES) + ['total']
+# URL毎に合計する計測値
+PIPELINE_TOTALS = ['bytes_fetched', 'markdown_chars', 'prompt_tokens', 'completion_tokens', 'cost_usd']
+
+
+def estimate_llm_cost(prompt_tokens, completion_tokens):
+    return (prompt_tokens * LLM_PRICE_PER_MILLION_PROMPT_TOKENS +
+            completion_tokens * LLM_PRICE_PER_MILLION_COMPLETION_TOKENS) / 1000000
+
+
+class TimedMarkdownGenerator:
+    # markdown生成の時間をURL毎に記録する（crawl4aiのarun()の中で同期的に呼ばれる）
+    # crawl4aiを遅延インポートするため、継承ではなくDefaultMarkdownGeneratorを包む
+
+    def __init__(self, *args, **kwargs):
+        from crawl4ai import DefaultMarkdownGenerator
+
+        self.generator = DefaultMarkdownGenerator(*args, **kwargs)
+        self.durations = {}
+
+    def __getattr__(self, name):
+        # content_sourceなどcrawl4aiが参照する属性は包んだ生成器のものを返す
+        if name == 'generator':
+            raise AttributeError(name)
+        return getattr(self.generator, name)
+
+    def generate_markdown(self, input_html, base_url='', *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self.generator.generate_markdown(input_html, base_url, *args, **kwargs)
+        finally:
+            self.durations[base_url] = time.perf_counter() - started
+
+    def pop_duration(self, *urls):
+        durations = [self.durations.pop(url, None) for url in urls if url]
+        return next((duration for duration in durations if duration is not None), 0.0)
+
+
+class PipelineMetrics:
+    # URL毎の処理段階の時間・取得バイト数・markdownの大きさ・トークン数・推定料金を集計する
+    # 進捗表示では毎回全件を集計し直さないよう、件数・合計・ヒストグラムだけをメモリに持つ
+    # pathを指定するとURL毎の計測値をJSON Linesで追記する（ダウンロードはこのファイルから作る）
+
+    def __init__(self, path=None):
+        self.path = path
+        self.browser_launch_seconds = None
+        self.pages = 0
+        self.succeeded = 0
+        self.totals = dict.fromkeys(PIPELINE_TOTALS, 0)
+        # 処理段階毎と1ページ全体（total）の件数・合計時間・ヒストグラム
+        self.counts = dict.fromkeys(PIPELINE_HISTOGRAMS, 0)
+        self.seconds = dict.fromkeys(PIPELINE_HISTOGRAMS, 0.0)
+        self.buckets = {name: [0] * (len(PIPELINE_LATENCY_BUCKETS) + 1) for name in PIPELINE_HISTOGRAMS}
+        self._lock = threading.Lock()
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    @classmethod
+    def from_jsonl(cls, path):
+        # 書き出したJSON Linesを1行ずつ読み込んで集計し直す（再開したジョブは同じファイルに追記を続ける）
+        metrics = cls(path=path)
+        if not os.path.exists(path):
+            return metrics
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                entry = json.loads(line)
+                if entry.get('event') == 'browser_launch':
+                    metrics.browser_launch_seconds = entry['seconds']
+                elif entry.get('event') == 'page':
+                    metrics._observe(entry)
+        return metrics
+
+    def set_browser_launch(self, seconds):
+        self.browser_launch_seconds = seconds
+        self._write({'event': 'browser_launch', 'seconds': seconds})
+
+    def add(self, url, success, metrics):
+        entry = dict(metrics, url=url, success=success)
+        self._observe(entry)
+        self._write(dict(entry, event='page'))
+
+    def _observe(self, entry):
+        with self._lock:
+            self.pages += 1
+            self.succeeded += bool(entry['success'])
+            for name in PIPELINE_TOTALS:
+                self.totals[name] += entry.get(name, 0)
+            for name in PIPELINE_HISTOGRAMS:
+                seconds = entry.get(f'{name}_seconds')
+                if seconds is None:
+                    continue
+                self.counts[name] += 1
+                self.seconds[name] += seconds
+                self.buckets[name][bisect.bisect_left(PIPELINE_LATENCY_BUCKETS, seconds)] += 1
+
+    def _write(self, entry):
+        if self.path is None:
+            return
+        with self._lock, open(self.path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(dict(entry, timestamp=time.time()), ensure_ascii=False) + '\n')
+
+    def quantile(self, name, quantile):
+        # ヒストグラムのバケット内を線形補間して推定する（Prometheusのhistogram_quantileと同じ）
+        counts = self.buckets[name]
+        rank = quantile * sum(counts)
+        cumulative = 0
+        for i, count in enumerate(counts):
+            if count > 0 and cumulative + count >= rank:
+                if i == len(PIPELINE_LATENCY_BUCKETS):
+                    return PIPELINE_LATENCY_BUCKETS[-1]
+                lower = PIPELINE_LATENCY_BUCKETS[i - 1] if i > 0 else 0.0
+                return lower + (PIPELINE_LATENCY_BUCKETS[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return 0.0
+
+    def summary(self):
+        with self._lock:
+            totals = dict(self.totals,
+                          pages=self.pages,
+                          succeeded=self.succeeded,
+                          browser_launch_seconds=self.browser_launch_seconds,
+                          stage_seconds={stage: self.seconds[stage] for stage in PIPELINE_STAGES})
+            totals['page_seconds_quantiles'] = {
+                quantile: self.quantile('total', quantile) for quantile in PIPELINE_LATENCY_QUANTILES
+            }
+        return totals
+
+    def to_prometheus(self, prefix='interi_ai_scrape'):
+        # Prometheusのテキスト形式（textfile collectorなどで取り込む）
+        summary = self.summary()
+        lines = [
+            f'# HELP {prefix}_pages_total Scraped pages.',
+            f'# TYPE {prefix}_pages_total counter',
+            f'{prefix}_pages_total{{status="success"}} {summary["succeeded"]}',
+            f'{prefix}_pages_total{{status="failure"}} {summary["pages"] - summary["succeeded"]}',
+            f'# HELP {prefix}_stage_seconds Wall time spent in each pipeline stage per page.',
+            f'# TYPE {prefix}_stage_seconds histogram',
+        ]
+        for stage in PIPELINE_STAGES:
+            lines += self._prometheus_histogram(f'{prefix}_stage_seconds', stage, f'stage="{stage}",')
+        lines += [
+            f'# HELP {prefix}_page_seconds Wall time per page.',
+            f'# TYPE {prefix}_page_seconds histogram',
+        ]
+        lines += self._prometheus_histogram(f'{prefix}_page_seconds', 'total')
+        lines += [
+            f'# HELP {prefix}_bytes_fetched_total HTML bytes fetched.',
+            f'# TYPE {prefix}_bytes_fetched_total counter',
+            f'{prefix}_bytes_fetched_total {summary["bytes_fetched"]}',
+            f'# HELP {prefix}_markdown_chars_total Generated markdown characters.',
+            f'# TYPE {prefix}_markdown_chars_total counter',
+            f'{prefix}_markdown_chars_total {summary["markdown_chars"]}',
+            f'# HELP {prefix}_llm_tokens_total LLM tokens used.',
+            f'# TYPE {prefix}_llm_tokens_total counter',
+            f'{prefix}_llm_tokens_total{{type="prompt"}} {summary["prompt_tokens"]}',
+            f'{prefix}_llm_tokens_total{{type="completion"}} {summary["completion_tokens"]}',
+            f'# HELP {prefix}_llm_cost_usd_total Estimated LLM cost in USD.',
+            f'# TYPE {prefix}_llm_cost_usd_total counter',
+            f'{prefix}_llm_cost_usd_total {summary["cost_usd"]:.6f}',
+        ]
+        if summary['browser_launch_seconds'] is not None:
+            lines += [
+                f'# HELP {prefix}_browser_launch_seconds Browser launch time.',
+                f'# TYPE {prefix}_browser_launch_seconds gauge',
+                f'{prefix}_browser_launch_seconds {summary["browser_launch_seconds"]:.6f}',
+            ]
+        return '\n'.join(lines) + '\n'
+
+    def _prometheus_histogram(self, metric, name, labels=''):
+        with self._lock:
+            counts, count, seconds = list(self.buckets[name]), self.counts[name], self.seconds[name]
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(PIPELINE_LATENCY_BUCKETS, counts):
+            cumulative += bucket_count
+            lines.append(f'{metric}_bucket{{{labels}le="{bound:g}"}} {cumulative}')
+        lines += [
+            f'{metric}_bucket{{{labels}le="+Inf"}} {count}',
+            f'{metric}_sum{{{labels.rstrip(",")}}} {seconds:.6f}' if labels else f'{metric}_sum {seconds:.6f}',
+            f'{metric}_count{{{labels.rstrip(",")}}} {count}' if labels else f'{metric}_count {count}',
+        ]
+        return lines
+
+
+# 家具選定の検索設定
+SEARCH_TOP_K = 5  # 条件毎に返す商品数
+# 数値範囲の条件と商品カタログのカラムの対応
+SEARCH_RANGE_COLUMNS = {
+    '幅': 'width_mm',
+    '奥行': 'depth_mm',
+    '高さ': 'height_mm',
+    '座面高': 'seat_height_mm',
+}
+# 選択肢の条件と商品カタログのカラムの対応
+SEARCH_SET_COLUMNS = {
+    'テイスト': 'taste',
+    '納期': 'delivery',
+    '価格帯': 'price_band',
+    'カテゴリ': 'category',
+}
+# 商品ページに記載が無いことが多いため、値が不明でも除外しない条件
+SEARCH_LENIENT_KEYS = ['テイスト', '納期']
+
+
+def expand_categories(categories):
+    # 親カテゴリが選択された場合は子カテゴリもすべて対象にする
+    expanded = set(categories)
+    for category in categories:
+        expanded.update(FURNITURE_CATEGORIES.get(category, []))
+    return expanded
+
+
+def price_band_of(price_yen):
+    # 価格（円）の配列から価格帯の配列を求める
+    price_yen = np.asarray(price_yen, dtype=float)
+    bands = np.full(price_yen.shape, '', dtype=object)
+    for band, (low, high) in PRICE_BANDS.items():
+        with np.errstate(invalid='ignore'):
+            in_band = (price_yen >= low) & (price_yen < (high if high is not None else np.inf))
+        bands[in_band] = band
+    return bands
+
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def load_search_catalog(path, mtime):
+    # 商品カタログを検索用に読み込む（カタログが更新されるとmtimeが変わり再読み込みされる）
+    df_catalog = query_catalog(path=path)
+    df_catalog['price_band'] = price_band_of(df_catalog['price_yen'])
+    # 選択肢のカラムはカテゴリ型にしておき、検索時はコードで比較する
+    for column in SEARCH_SET_COLUMNS.values():
+        df_catalog[column] = df_catalog[column].fillna('').astype('category')
+    return df_catalog
+
+
+def get_search_catalog(path=CATALOG_DB_PATH):
+    mtime = os.path.getmtime(path) if os.path.exists(path) else 0
+    return load_search_catalog(path, mtime)
+
+
+def match_furniture_conditions(df_conditions, df_catalog, top_k=SEARCH_TOP_K):
+    # 保存したすべての条件行を商品カタログ全体に対して一括で評価し、条件行毎の上位商品を返す
+    # 条件行×商品の2次元配列でマスクとスコアを計算する
+    row_count = len(df_conditions)
+    product_count = len(df_catalog)
+    if row_count == 0 or product_count == 0:
+        return [df_catalog.iloc[[]] for _ in range(row_count)]
+
+    # 選択肢（テイスト・納期・価格帯・カテゴリ）
+    # 条件行×ユニーク値の表を作り、商品のコードで引いて条件行×商品のマスクにする
+    mask = np.ones((row_count, product_count), dtype=bool)
+    for key, column in SEARCH_SET_COLUMNS.items():
+        values = df_catalog[column]
+        if not isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.fillna('').astype('category')
+        codes = values.cat.codes.to_numpy()
+        uniques = np.asarray(values.cat.categories, dtype=object)
+        selected = np.zeros((row_count, len(uniques)), dtype=bool)
+        for row, values in enumerate(df_conditions[key]):
+            allowed = expand_categories(values) if key == 'カテゴリ' else set(values)
+            selected[row] = np.isin(uniques, list(allowed))
+            if key in SEARCH_LENIENT_KEYS:
+                selected[row] |= uniques == ''
+        mask &= selected[:, codes]
+
+    # 以降の数値計算は、いずれかの条件行の選択肢に一致した商品だけを対象にする
+    candidates = np.flatnonzero(mask.any(axis=0))
+    mask = mask[:, candidates]
+    score = np.zeros(mask.shape, dtype=np.float32)
+
+    # 数値範囲（幅・奥行・高さ・座面高）
+    for key, column in SEARCH_RANGE_COLUMNS.items():
+        bounds = np.array([list(value) for value in df_conditions[key]], dtype=float)
+        # 全範囲が指定されている条件行は絞り込まない（寸法が不明な商品も除外しない）
+        full_range = (bounds[:, 0] <= FURNITURE_CONDITIONS[key][0]) & (bounds[:, 1] >=
+                                                                      FURNITURE_CONDITIONS[key][1])
+        active_rows = np.flatnonzero(~full_range)
+        if len(active_rows) == 0 or len(candidates) == 0:
+            continue
+        values = df_catalog[column].to_numpy(dtype=np.float32)[candidates][np.newaxis, :]
+        low = bounds[active_rows, :1].astype(np.float32)
+        high = bounds[active_rows, 1:].astype(np.float32)
+        # 寸法が不明（NaN）の商品は比較結果がFalseになり除外される
+        with np.errstate(invalid='ignore'):
+            inside = (values >= low) & (values <= high)
+        mask[active_rows] &= inside
+        # 範囲の中央からの距離（範囲の半分を1とする）が小さいほどスコアを高くする
+        # 除外された商品のスコアは使わないため、範囲外やNaNでもそのまま計算する
+        distance = np.abs(values - (low + high) / 2)
+        distance /= np.maximum((high - low) / 2, 1)
+        score[active_rows] -= distance
+
+    # 条件行毎に上位top_k件を取り出す（スコア降順、同点は価格の安い順）
+    # 全範囲の条件では全商品が同点になるため、価格も含めた順位で選んでから切り出す
+    results = []
+    price = np.nan_to_num(df_catalog['price_yen'].to_numpy(dtype=float)[candidates], nan=np.inf)
+    for row in range(row_count):
+        matched = np.flatnonzero(mask[row])
+        order = np.lexsort((price[matched], -score[row, matched]))[:top_k]
+        results.append(df_catalog.iloc[candidates[matched[order]]])
+    return results
+
+
+def format_product_markdown(product):
+    # 商品1件をチャットに表示するmarkdownに変換（画像はshow_products()で表示する）
+    lines = [
+        f"商品名：[{product['item_name']}]({product['url']})  ",
+        f"ブランド：{product['brand_name']}  ",
+        f"Size:{product['size']}  ",
+        f"Material:{product['material']}  ",
+        f"Price:{product['price']}  ",
+    ]
+    return '\n'.join(lines)
+
+
+def show_products(df_products):
+    # 商品を順に表示する（画像はローカルにキャッシュしたサムネイルを優先し、無ければ元のURLを使う）
+    first_image_urls = []
+    for image_urls in df_products['image_urls']:
+        if isinstance(image_urls, str):
+            image_urls = json.loads(image_urls or '[]')
+        first_image_urls.append(image_urls[0] if image_urls else None)
+    thumbnails = get_image_cache().get_thumbnails(first_image_urls)
+    for (_, product), image_url in zip(df_products.iterrows(), first_image_urls):
+        st.markdown(format_product_markdown(product))
+        if image_url:
+            st.image(thumbnails.get(image_url, image_url), caption=product['item_name'], width=IMAGE_THUMBNAIL_SIZE[0])
+
+
+def format_furniture_condition_list(df_conditions):
+    # 保存した条件を一覧表示用の文字列に変換
+    df_display = df_conditions.copy()
+    for key in FURNITURE_CONDITIONS.keys():
+        if isinstance(FURNITURE_CONDITIONS[key], tuple):
+            df_display[key] = [f"{value[0]} - {value[1]} mm" for value in df_conditions[key]]
+        else:
+            df_display[key] = [', '.join(value) for value in df_conditions[key]]
+    return df_display
+
+
+def search_furniture():
+    # 保存した条件で商品カタログを検索して表示
+    df_conditions = st.session_state['furniture_condition_list']
+    results = match_furniture_conditions(df_conditions, get_search_catalog())
+    with st.chat_message(name="assistant"):
+        for row, df_matches in enumerate(results):
+            st.markdown(f"**条件{row + 1}**")
+            if len(df_matches) == 0:
+                st.markdown('条件に合う商品が見つかりませんでした。')
+                continue
+            conditions = {key: df_conditions[key].iloc[row] for key in FURNITURE_CONDITIONS}
+            write_recommendation(make_recommendation_cache_key(conditions=conditions),
+                                 format_recommendation_request(conditions=conditions), df_matches)
+            show_products(df_matches)
+
+
+# 自由入力による商品検索（BM25と埋め込みのハイブリッド）の設定
+RETRIEVAL_INDEX_DIR = os.path.join(DATA_DIR, 'retrieval_index')
+RETRIEVAL_TEXT_FIELDS = ['item_name', 'brand_name', 'category', 'description', 'material']
+RETRIEVAL_TOP_K = 5  # 返す商品数
+RETRIEVAL_CANDIDATES = 50  # BM25と埋め込みのそれぞれから統合前に取り出す候補数
+RETRIEVAL_BM25_K1 = 1.5
+RETRIEVAL_BM25_B = 0.75
+RETRIEVAL_RRF_K = 60  # Reciprocal Rank Fusionの定数
+RETRIEVAL_VERSION_PATTERN = re.compile(r'^v\d+$')  # インデックスの版のディレクトリ名
+EMBEDDING_MODEL = 'gemini/text-embedding-004'
+EMBEDDING_BATCH_SIZE = 100
+
+# 英数字はまとまりのまま、かな・漢字は文字bigramに分割する
+TOKEN_PATTERN = re.compile(r'[0-9a-z]+|[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff]+')
+
+
+def get_llm_api_token():
+    # 環境変数を優先し、無ければStreamlitのsecretsから取得
+    token = os.environ.get('GEMINI_API_TOKEN')
+    if token:
+        return token
+    try:
+        return st.secrets['GEMINI_API_TOKEN']
+    except (KeyError, FileNotFoundError):
+        return None
+
+
+def tokenize_japanese(text):
+    # 形態素解析器を使わずに日本語をBM25用のトークンに分割する
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    tokens = []
+    for run in TOKEN_PATTERN.findall(text):
+        if run.isascii() or len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def embed_texts(texts):
+    # 埋め込みベクトル（L2正規化済み）を取得する。失敗した場合はNoneを返す
+    vectors = []
+    try:
+        import litellm
+
+        for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            response = litellm.embedding(model=EMBEDDING_MODEL,
+                                         input=texts[start:start + EMBEDDING_BATCH_SIZE],
+                                         api_key=get_llm_api_token())
+            vectors.extend(item['embedding'] for item in response.data)
+    except Exception as e:
+        print(f"embed_texts() failed to embed {len(texts)} texts: {e}")
+        return None
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    return vectors
+
+
+class RetrievalIndex:
+    # 商品カタログに対するBM25の転置インデックスと埋め込みベクトルをディスクに保存し、
+    # 読み込み時はメモリマップで開く
+    # 転置インデックスは文書毎（CSR）と語毎（CSC）の両方を持ち、更新時は変更された商品だけを
+    # トークン化・埋め込みして配列を組み直す
+    # 配列は版毎のディレクトリに書き、meta.jsonの置き換えで切り替える（アプリとCLIが同じファイルを更新する）
+
+    ARRAY_NAMES = [
+        'doc_terms', 'doc_tfs', 'doc_offsets', 'doc_lengths', 'post_docs', 'post_tfs', 'term_offsets',
+        'embeddings'
+    ]
+
+    def __init__(self, index_dir=RETRIEVAL_INDEX_DIR):
+        self.index_dir = index_dir
+        self.urls = []
+        self.hashes = []
+        self.vocab = {}
+        self.arrays = {}
+        self._url_positions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.urls)
+
+    def load(self):
+        meta_path = os.path.join(self.index_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            return self
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('embedding_model') != EMBEDDING_MODEL:
+            # 埋め込みモデルが変わった場合は作り直す
+            return self
+        self.urls = meta['urls']
+        self.hashes = meta['hashes']
+        self.vocab = meta['vocab']
+        self.arrays = {
+            name: np.load(os.path.join(self.index_dir, meta['version'], f'{name}.npy'), mmap_mode='r')
+            for name in self.ARRAY_NAMES
+        }
+        self._url_positions = {url: i for i, url in enumerate(self.urls)}
+        return self
+
+    def update(self, df_products):
+        # 新規・変更された商品だけをトークン化・埋め込みしてインデックスを更新する
+        # 他のプロセスが更新している場合があるため、ロックを取ってからディスク上の最新の状態に反映する
+        from filelock import FileLock
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        with self._lock, FileLock(os.path.join(self.index_dir, 'update.lock')):
+            self.load()
+            changed = {}
+            for product in df_products[['url'] + RETRIEVAL_TEXT_FIELDS].to_dict('records'):
+                text = '\n'.join(str(product[field] or '') for field in RETRIEVAL_TEXT_FIELDS)
+                text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+                position = self._url_positions.get(product['url'])
+                # 埋め込みが取得できなかった商品（ハッシュがNone）は次の更新で取得し直す
+                if position is None or self.hashes[position] != text_hash:
+                    changed[product['url']] = (text, text_hash)
+            if not changed:
+                return 0
+
+            texts = [text for text, _ in changed.values()]
+            new_embeddings = embed_texts(texts)
+            if new_embeddings is None:
+                new_embeddings = np.zeros((len(texts), self._embedding_dim()), dtype=np.float32)
+                changed = {url: (text, None) for url, (text, _) in changed.items()}
+
+            urls = list(self.urls)
+            hashes = list(self.hashes)
+            vocab = dict(self.vocab)
+            doc_rows = [self._doc_row(i) for i in range(len(urls))]
+            embeddings = [self.arrays['embeddings'][i] for i in range(len(urls))] if urls else []
+            dim = max(new_embeddings.shape[1], self._embedding_dim())
+            for (url, (text, text_hash)), embedding in zip(changed.items(), new_embeddings):
+                terms, tfs = np.unique([vocab.setdefault(token, len(vocab))
+                                        for token in tokenize_japanese(text)],
+                                       return_counts=True)
+                row = (terms.astype(np.int32), tfs.astype(np.float32))
+                position = self._url_positions.get(url)
+                if position is None:
+                    urls.append(url)
+                    hashes.append(text_hash)
+                    doc_rows.append(row)
+                    embeddings.append(embedding)
+                else:
+                    hashes[position] = text_hash
+                    doc_rows[position] = row
+                    embeddings[position] = embedding
+            # 埋め込みが取得できなかった商品はゼロベクトルにする
+            embeddings = np.stack([
+                np.asarray(vector, dtype=np.float32)
+                if len(vector) == dim else np.zeros(dim, dtype=np.float32) for vector in embeddings
+            ])
+            self._save(urls, hashes, vocab, doc_rows, embeddings)
+            self.load()
+            return len(changed)
+
+    def search(self, query, top_k=RETRIEVAL_TOP_K):
+        # BM25と埋め込みのそれぞれの順位をReciprocal Rank Fusionで統合する
+        if not self.urls:
+            return []
+        fused = {}
+        for ranking in (self._bm25_ranking(query), self._dense_ranking(query)):
+            for rank, position in enumerate(ranking):
+                fused[position] = fused.get(position, 0.0) + 1.0 / (RETRIEVAL_RRF_K + rank + 1)
+        best = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return [(self.urls[position], score) for position, score in best]
+
+    def _bm25_ranking(self, query):
+        term_ids = {self.vocab[token] for token in tokenize_japanese(query) if token in self.vocab}
+        if not term_ids:
+            return []
+        doc_lengths = self.arrays['doc_lengths']
+        term_offsets = self.arrays['term_offsets']
+        doc_count = len(self.urls)
+        average_length = max(float(doc_lengths.mean()), 1.0)
+        scores = np.zeros(doc_count, dtype=np.float32)
+        for term_id in term_ids:
+            start, end = term_offsets[term_id], term_offsets[term_id + 1]
+            docs = self.arrays['post_docs'][start:end]
+            tfs = self.arrays['post_tfs'][start:end]
+            idf = np.log(1 + (doc_count - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = RETRIEVAL_BM25_K1 * (1 - RETRIEVAL_BM25_B +
+                                        RETRIEVAL_BM25_B * doc_lengths[docs] / average_length)
+            scores[docs] += idf * tfs * (RETRIEVAL_BM25_K1 + 1) / (tfs + norm)
+        return self._top_positions(scores, scores > 0)
+
+    def _dense_ranking(self, query):
+        embeddings = self.arrays['embeddings']
+        if embeddings.shape[1] == 0:
+            return []
+        query_embedding = embed_query(query)
+        if query_embedding is None or len(query_embedding) != embeddings.shape[1]:
+            return []
+        scores = embeddings @ query_embedding
+        # 埋め込みが取得できていない商品（ゼロベクトル）は除く
+        return self._top_positions(scores, scores != 0)
+
+    @staticmethod
+    def _top_positions(scores, valid):
+        positions = np.flatnonzero(valid)
+        if len(positions) > RETRIEVAL_CANDIDATES:
+            positions = positions[np.argpartition(-scores[positions],
+                                                  RETRIEVAL_CANDIDATES - 1)[:RETRIEVAL_CANDIDATES]]
+        return positions[np.argsort(-scores[positions], kind='stable')].tolist()
+
+    def _doc_row(self, position):
+        start, end = self.arrays['doc_offsets'][position], self.arrays['doc_offsets'][position + 1]
+        return (np.asarray(self.arrays['doc_terms'][start:end]),
+                np.asarray(self.arrays['doc_tfs'][start:end]))
+
+    def _embedding_dim(self):
+        embeddings = self.arrays.get('embeddings')
+        return embeddings.shape[1] if embeddings is not None else 0
+
+    def _save(self, urls, hashes, vocab, doc_rows, embeddings):
+        lengths = np.array([len(terms) for terms, _ in doc_rows], dtype=np.int64)
+        doc_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        doc_terms = np.concatenate([terms for terms, _ in doc_rows]).astype(np.int32)
+        doc_tfs = np.concatenate([tfs for _, tfs in doc_rows]).astype(np.float32)
+        doc_ids = np.repeat(np.arange(len(doc_rows), dtype=np.int32), lengths)
+        # 語ID順に並べ替えて語毎のポスティングリストにする
+        order = np.argsort(doc_terms, kind='stable')
+        term_offsets = np.concatenate([[0], np.cumsum(np.bincount(doc_terms,
+                                                                  minlength=len(vocab)))])
+        arrays = {
+            'doc_terms': doc_terms,
+            'doc_tfs': doc_tfs,
+            'doc_offsets': doc_offsets,
+            'doc_lengths': np.array([tfs.sum() for _, tfs in doc_rows], dtype=np.float32),
+            'post_docs': doc_ids[order],
+            'post_tfs': doc_tfs[order],
+            'term_offsets': term_offsets.astype(np.int64),
+            'embeddings': embeddings.astype(np.float32),
+        }
+        # 書き込み途中の配列を読み込まないよう、新しい版のディレクトリに書いてからmeta.jsonを置き換える
+        version = f'v{time.time_ns()}'
+        os.makedirs(os.path.join(self.index_dir, version))
+        for name, array in arrays.items():
+            np.save(os.path.join(self.index_dir, version, f'{name}.npy'), array)
+        meta = {'embedding_model': EMBEDDING_MODEL, 'version': version, 'urls': urls, 'hashes': hashes, 'vocab': vocab}
+        tmp_path = os.path.join(self.index_dir, 'meta.json.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.index_dir, 'meta.json'))
+        # 読み込み中のプロセスがあるため、直前の版は残してそれより古い版を削除する
+        versions = sorted(name for name in os.listdir(self.index_dir) if RETRIEVAL_VERSION_PATTERN.match(name))
+        for name in versions[:-2]:
+            shutil.rmtree(os.path.join(self.index_dir, name), ignore_errors=True)
+
+
+@functools.lru_cache(maxsize=256)
+def embed_query(query):
+    vectors = embed_texts([query])
+    return None if vectors is None else vectors[0]
+
+
+@st.cache_resource(show_spinner=False)
+def get_retrieval_index():
+    # プロセス全体で1つのインデックスを共有し、起動時に商品カタログとの差分だけを反映する
+    retrieval_index = RetrievalIndex().load()
+    retrieval_index.update(query_catalog())
+    return retrieval_index
+
+
+def search_products_by_text(query, top_k=RETRIEVAL_TOP_K):
+    # 自由入力に近い商品を商品カタログから取得する（順位順）
+    hits = get_retrieval_index().search(query, top_k=top_k)
+    if not hits:
+        return query_catalog(limit=0)
+    df_products = query_catalog(urls=[url for url, _ in hits]).set_index('url')
+    urls = [url for url, _ in hits if url in df_products.index]
+    return df_products.loc[urls].reset_index()
+
+
+# 商品の提案文（LLMの応答を逐次表示し、同じ条件・要望への応答はキャッシュから返す）
+RECOMMENDATION_CONTEXT_TOP_K = 5  # 提案文のコンテキストに含める商品数（検索結果の上位）
+RECOMMENDATION_CONTEXT_FIELDS = {
+    'item_name': '商品名',
+    'brand_name': 'ブランド',
+    'category': 'カテゴリ',
+    'size': 'サイズ',
+    'material': '素材',
+    'price': '価格',
+}
+RECOMMENDATION_FIELD_MAX_CHARS = 60  # コンテキストの項目毎の最大文字数
+RECOMMENDATION_MAX_OUTPUT_TOKENS = 1024
+RECOMMENDATION_CACHE_TTL = 60 * 60  # 提案文をキャッシュする期間（秒）
+RECOMMENDATION_CACHE_MAX_ENTRIES = 1000
+RECOMMENDATION_FALLBACK_MESSAGE = 'こちらの商品はいかがでしょうか？'
+RECOMMENDATION_INSTRUCTION = '''
+あなたはインテリアコーディネーターです。
+お客様の条件・ご要望と、商品カタログから検索した候補商品を示します。
+候補商品の中から、条件・ご要望に合う理由を添えて商品を簡潔に提案してください。
+候補商品に無い商品や、候補商品に記載の無い情報は書かないでください。
+'''
+
+
+class RecommendationCache:
+    # 条件とご要望を正規化したキーで提案文と商品URLをTTL付きで保持する（セッション間で共有する）
+
+    def __init__(self, ttl=RECOMMENDATION_CACHE_TTL, max_entries=RECOMMENDATION_CACHE_MAX_ENTRIES):
+        self._cache = cachetools.TTLCache(maxsize=max_entries, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._cache.get(key)
+
+    def set(self, key, answer, urls):
+        with self._lock:
+            self._cache[key] = {'answer': answer, 'urls': urls}
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+@st.cache_resource(show_spinner=False)
+def get_recommendation_cache():
+    return RecommendationCache()
+
+
+def make_recommendation_cache_key(conditions=None, query=''):
+    # 選択肢の順序や表記揺れによらず同じキーにする（商品カタログが更新されたらキーが変わる）
+    normalized = {}
+    for key, value in (conditions or {}).items():
+        normalized[key] = list(value) if isinstance(FURNITURE_CONDITIONS.get(key), tuple) else sorted(value)
+    catalog_mtime = os.path.getmtime(CATALOG_DB_PATH) if os.path.exists(CATALOG_DB_PATH) else 0
+    return hashlib.sha256(
+        json.dumps([normalized, normalize_field_text(query), catalog_mtime], ensure_ascii=False,
+                   sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def format_recommendation_context(df_products, top_k=RECOMMENDATION_CONTEXT_TOP_K):
+    # 上位の商品だけを1商品1行の短いテキストにしてプロンプトを小さく保つ
+    lines = []
+    for number, (_, product) in enumerate(df_products.head(top_k).iterrows(), start=1):
+        values = []
+        for name, label in RECOMMENDATION_CONTEXT_FIELDS.items():
+            value = ' '.join(str(product.get(name) or '').split())
+            if value:
+                values.append(f'{label}: {value[:RECOMMENDATION_FIELD_MAX_CHARS]}')
+        lines.append(f'{number}. ' + ' / '.join(values))
+    return '\n'.join(lines)
+
+
+def format_recommendation_request(conditions=None, query=''):
+    lines = []
+    for key, value in (conditions or {}).items():
+        if isinstance(FURNITURE_CONDITIONS.get(key), tuple):
+            # 全範囲の寸法は条件に含めない
+            if value[0] > FURNITURE_CONDITIONS[key][0] or value[1] < FURNITURE_CONDITIONS[key][1]:
+                lines.append(f'{key}: {value[0]} - {value[1]} mm')
+        elif value:
+            lines.append(f"{key}: {', '.join(value)}")
+    if query:
+        lines.append(f'ご要望: {query}')
+    return '\n'.join(lines) or '指定なし'
+
+
+def stream_recommendation(cache_key, request, df_products):
+    # LLMの応答をトークン単位で返し、最後まで受け取れた応答だけをキャッシュする
+    chunks = []
+    try:
+        import litellm
+
+        prompt = f'{RECOMMENDATION_INSTRUCTION}\n## 条件・ご要望\n{request}\n\n## 候補商品\n' \
+                 f'{format_recommendation_context(df_products)}'
+        response = litellm.completion(model=LLM_PROVIDER,
+                                      messages=[{
+                                          'role': 'user',
+                                          'content': prompt
+                                      }],
+                                      api_key=get_llm_api_token(),
+                                      api_base=LLM_API_BASE,
+                                      max_tokens=RECOMMENDATION_MAX_OUTPUT_TOKENS,
+                                      stream=True)
+        for chunk in response:
+            text = chunk.choices[0].delta.content or ''
+            if text:
+                chunks.append(text)
+                yield text
+    except Exception as e:
+        print(f"stream_recommendation() failed to generate recommendation: {e}")
+        if not chunks:
+            yield RECOMMENDATION_FALLBACK_MESSAGE
+        return
+    get_recommendation_cache().set(cache_key, ''.join(chunks), df_products['url'].tolist())
+
+
+def write_recommendation(cache_key, request, df_products):
+    # キャッシュにあればすぐに表示し、無ければLLMの応答を逐次表示する
+    cached = get_recommendation_cache().get(cache_key)
+    if cached is not None:
+        st.markdown(cached['answer'])
+        return
+    st.write_stream(stream_recommendation(cache_key, request, df_products))
+
+
+# 商品画像のローカルキャッシュ（内容のハッシュで原寸画像とサムネイルを保存する）
+IMAGE_CACHE_DIR = os.path.join(DATA_DIR, 'images')
+IMAGE_CACHE_DB_PATH = os.path.join(DATA_DIR, 'image_cache.sqlite3')
+IMAGE_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # キャッシュ全体の上限（超えたら最近使われていない画像から削除）
+IMAGE_MAX_CONCURRENCY = 16  # 画像の最大同時取得数
+IMAGE_MAX_CONCURRENCY_PER_HOST = 4  # 同じホストへの最大同時取得数
+IMAGE_REQUEST_TIMEOUT = 30  # 画像1枚あたりのタイムアウト（秒）
+IMAGE_MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024  # これより大きい画像は取得しない
+IMAGE_THUMBNAIL_SIZE = (320, 320)
+IMAGE_THUMBNAIL_QUALITY = 80
+IMAGE_CACHE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS image_urls (
+    url TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS image_urls_content_hash ON image_urls (content_hash);
+CREATE TABLE IF NOT EXISTS images (
+    content_hash TEXT PRIMARY KEY,
+    extension TEXT NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_last_access ON images (last_access);
+'''
+IMAGE_CONTENT_TYPE_EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/webp': '.webp',
+    'image/gif': '.gif',
+}
+
+
+def make_thumbnail(data):
+    # 縮小してJPEGに変換する（JPEGは縮小した解像度でデコードして処理を軽くする）
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft('RGB', IMAGE_THUMBNAIL_SIZE)
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        else:
+            image = image.convert('RGB')
+        image.thumbnail(IMAGE_THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=IMAGE_THUMBNAIL_QUALITY, optimize=True)
+        return output.getvalue()
+
+
+class ImageCache:
+    # 商品画像を取得して原寸画像とサムネイルをディスクに保存し、検索結果ではサムネイルを表示する
+    # 同じ画像は複数のURL・商品で共有し、容量の上限を超えたら最近使われていない画像から削除する
+
+    def __init__(self, path=IMAGE_CACHE_DB_PATH, directory=IMAGE_CACHE_DIR, max_bytes=IMAGE_CACHE_MAX_BYTES):
+        self.path = path
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.executescript(IMAGE_CACHE_SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def original_path(self, content_hash, extension):
+        return os.path.join(self.directory, 'originals', content_hash[:2], f'{content_hash}{extension}')
+
+    def thumbnail_path(self, content_hash):
+        return os.path.join(self.directory, 'thumbnails', content_hash[:2], f'{content_hash}.jpg')
+
+    def get_thumbnails(self, urls):
+        # キャッシュ済みの画像のサムネイルのパスを返し、最終利用日時を更新する
+        urls = list(dict.fromkeys(url for url in urls if url))
+        if not urls:
+            return {}
+        with closing(self._connect()) as conn, conn:
+            rows = conn.execute(
+                f"SELECT url, content_hash FROM image_urls WHERE url IN ({', '.join('?' * len(urls))})",
+                urls).fetchall()
+            conn.executemany('UPDATE images SET last_access = ? WHERE content_hash = ?',
+                             [(time.time(), content_hash) for _, content_hash in rows])
+        thumbnails = {url: self.thumbnail_path(content_hash) for url, content_hash in rows}
+        return {url: path for url, path in thumbnails.items() if os.path.exists(path)}
+
+    def _store(self, url, data, content_type):
+        # 原寸画像とサムネイルを保存する（同じ内容の画像は1つだけ保存する）
+        content_hash = hashlib.sha256(data).hexdigest()
+        # 別のURLで保存済みの画像は、保存済みの拡張子（原寸画像のパス）を使う
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT extension FROM images WHERE content_hash = ?', (content_hash,)).fetchone()
+        if row is not None:
+            extension = row[0]
+        else:
+            extension = IMAGE_CONTENT_TYPE_EXTENSIONS.get(content_type,
+                                                          os.path.splitext(urlparse(url).path)[1][:5] or '.img')
+        original_path = self.original_path(content_hash, extension)
+        thumbnail_path = self.thumbnail_path(content_hash)
+        if not os.path.exists(original_path) or not os.path.exists(thumbnail_path):
+            thumbnail = make_thumbnail(data)
+            for path, content in ((original_path, data), (thumbnail_path, thumbnail)):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # 同じ内容の画像を別のスレッド・プロセスが同時に書き込む場合があるため、一時ファイルは書き込み毎に分ける
+                temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                with open(temp_path, 'wb') as file:
+                    file.write(content)
+                os.replace(temp_path, path)
+        size_bytes = os.path.getsize(original_path) + os.path.getsize(thumbnail_path)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                'INSERT INTO images (content_hash, extension, size_bytes, last_access) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(content_hash) DO UPDATE SET last_access = excluded.last_access',
+                (content_hash, extension, size_bytes, time.time()))
+            conn.execute(
+                'INSERT INTO image_urls (url, content_hash) VALUES (?, ?) '
+                'ON CONFLICT(url) DO UPDATE SET content_hash = excluded.content_hash', (url, content_hash))
+
+    async def fetch(self, urls, max_concurrency=IMAGE_MAX_CONCURRENCY,
+                    max_concurrency_per_host=IMAGE_MAX_CONCURRENCY_PER_HOST):
+        # 未取得の画像のみ、接続を使い回すHTTPクライアントで並行して取得する
+        import aiohttp
+        from PIL import Image
+
+        urls = list(dict.fromkeys(url for url in urls if url and url.startswith(('http://', 'https://'))))
+        cached = self.get_thumbnails(urls)
+        urls = [url for url in urls if url not in cached]
+        stored_count = 0
+
+        async def download(session, url):
+            nonlocal stored_count
+            try:
+                async with session.get(url) as response:
+                    response.raise_for_status()
+                    if (response.content_length or 0) > IMAGE_MAX_DOWNLOAD_BYTES:
+                        return
+                    data = await response.content.read(IMAGE_MAX_DOWNLOAD_BYTES + 1)
+                    if len(data) > IMAGE_MAX_DOWNLOAD_BYTES:
+                        return
+                    content_type = response.content_type
+                # デコードと縮小はイベントループを止めないようスレッドで行う
+                await asyncio.to_thread(self._store, url, data, content_type)
+                stored_count += 1
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError, Image.DecompressionBombError) as e:
+                print(f"ImageCache.fetch() failed to fetch {url}: {e}")
+
+        if urls:
+            connector = aiohttp.TCPConnector(limit=max_concurrency, limit_per_host=max_concurrency_per_host)
+            timeout = aiohttp.ClientTimeout(total=IMAGE_REQUEST_TIMEOUT)
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                await asyncio.gather(*[download(session, url) for url in urls])
+            await asyncio.to_thread(self.evict)
+        return stored_count
+
+    def evict(self):
+        # 容量の上限を超えた分を、最近使われていない画像から削除する
+        with closing(self._connect()) as conn, conn:
+            total_bytes = conn.execute('SELECT COALESCE(SUM(size_bytes), 0) FROM images').fetchone()[0]
+            if total_bytes <= self.max_bytes:
+                return 0
+            evicted = []
+            for content_hash, extension, size_bytes in conn.execute(
+                    'SELECT content_hash, extension, size_bytes FROM images ORDER BY last_access'):
+                if total_bytes <= self.max_bytes:
+                    break
+                for path in (self.original_path(content_hash, extension), self.thumbnail_path(content_hash)):
+                    with suppress(FileNotFoundError):
+                        os.remove(path)
+                evicted.append((content_hash,))
+                total_bytes -= size_bytes
+            conn.executemany('DELETE FROM image_urls WHERE content_hash = ?', evicted)
+            conn.executemany('DELETE FROM images WHERE content_hash = ?', evicted)
+        return len(evicted)
+
+
+@st.cache_resource
+def get_image_cache():
+    return ImageCache()
+
+
+def cache_product_images(df_products):
+    # 保存した商品の画像を取得してサムネイルを作成する
+    image_urls = []
+    for urls in df_products['image_urls']:
+        image_urls.extend(json.loads(urls or '[]') if isinstance(urls, str) else urls or [])
+    return asyncio.run(get_image_cache().fetch(image_urls))
+
+
+# スクレイピングジョブの保存先（URL毎の進捗をチェックポイントとして記録する）
+SCRAPING_JOB_DB_PATH = os.path.join(DATA_DIR, 'scraping_jobs.sqlite3')
+SCRAPING_JOB_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    error_message TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_urls (
+    job_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    lastmod TEXT,
+    status TEXT NOT NULL,
+    record TEXT,
+    finished_at REAL,
+    PRIMARY KEY (job_id, position)
+);
+CREATE INDEX IF NOT EXISTS job_urls_status ON job_urls (job_id, status);
+'''
+SCRAPING_JOB_POLL_INTERVAL = 1  # 進捗表示の更新間隔（秒）
+SCRAPING_METRICS_CACHE_ENTRIES = 16  # 終了したジョブの計測値の集計結果を保持する件数
+# ジョブの状態
+SCRAPING_JOB_STATUS_LABELS = {
+    'queued': '待機中',
+    'running': '実行中',
+    'completed': '完了',
+    'failed': '失敗',
+    'cancelled': '中止',
+    'interrupted': '中断',
+}
+SCRAPING_JOB_ACTIVE_STATUSES = ('queued', 'running')
+# ページ毎の結果（markdownを含む全項目）の保存先
+SCRAPE_RESULT_DIR = os.path.join(DATA_DIR, 'scraping_results')
+SCRAPE_RESULT_LARGE_FIELDS = ('markdown',)  # ジョブのDBには保存せず、結果ファイルにのみ保存する項目
+SCRAPE_RESULT_BATCH_SIZE = 500  # 結果を読み込む・書き出す際の1回あたりの件数
+# 結果をParquetに書き出す際の列の型
+SCRAPE_RESULT_PARQUET_COLUMNS = {
+    'url': 'string',
+    'success': 'bool',
+    'status_code': 'int64',
+    'error_message': 'string',
+    'not_modified': 'bool',
+    'cache_hit': 'bool',
+    'extracted_content': 'string',
+    'markdown': 'string',
+    'tokens_raw': 'int64',
+    'tokens_sent': 'int64',
+    'tokens_out': 'int64',
+    'llm_seconds': 'double',
+    'seconds_saved': 'double',
+    'seconds': 'double',
+    'near_duplicate_of': 'string',
+    'site_schema': 'bool',
+    'metrics': 'string',  # JSON文字列
+}
+SCRAPE_PREVIEW_PAGE_SIZE = 50  # 結果のプレビューで1ページに表示する件数
+SCRAPE_PREVIEW_MAX_CHARS = 200  # プレビューで表示する抽出結果・エラーの最大文字数
+
+
+class ScrapingJobStore:
+    # スクレイピングジョブとURL毎の結果を保存する
+    # UIのスレッドとジョブのスレッドの両方から使うため、操作毎に接続する
+
+    def __init__(self, path=SCRAPING_JOB_DB_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.executescript(SCRAPING_JOB_SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        # 書き込み中でも進捗を読めるようにする
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def create_job(self, urls, lastmods=None, params=None):
+        job_id = hashlib.sha256(f'{time.time()}:{os.getpid()}:{urls[:1]}'.encode('utf-8')).hexdigest()[:16]
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                'INSERT INTO jobs (job_id, status, params, total, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, 'queued', json.dumps(params or {}), len(urls), now, now))
+            conn.executemany(
+                'INSERT INTO job_urls (job_id, position, url, lastmod, status) VALUES (?, ?, ?, ?, ?)',
+                [(job_id, i, url, normalize_lastmod((lastmods or {}).get(url)), 'pending')
+                 for i, url in enumerate(urls)])
+        return job_id
+
+    def set_status(self, job_id, status, error_message=None):
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute('UPDATE jobs SET status = ?, error_message = ?, updated_at = ? WHERE job_id = ?',
+                         (status, error_message, now, job_id))
+            if status == 'running':
+                conn.execute('UPDATE jobs SET started_at = ?, finished_at = NULL WHERE job_id = ?',
+                             (now, job_id))
+            elif status not in SCRAPING_JOB_ACTIVE_STATUSES:
+                conn.execute('UPDATE jobs SET finished_at = ? WHERE job_id = ?', (now, job_id))
+
+    def save_record(self, job_id, position, record):
+        # 1ページ完了する毎にチェックポイントを記録する（markdownなどの大きい項目は結果ファイルにのみ保存する）
+        now = time.time()
+        record = {key: value for key, value in record.items() if key not in SCRAPE_RESULT_LARGE_FIELDS}
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                'UPDATE job_urls SET status = ?, record = ?, finished_at = ? WHERE job_id = ? AND position = ?',
+                ('done' if record['success'] else 'failed', json.dumps(record, ensure_ascii=False), now,
+                 job_id, position))
+            conn.execute('UPDATE jobs SET updated_at = ? WHERE job_id = ?', (now, job_id))
+
+    def get_job(self, job_id):
+        with closing(self._connect()) as conn:
+            job = conn.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+            if job is None:
+                return None
+            counts = dict(
+                conn.execute('SELECT status, COUNT(*) FROM job_urls WHERE job_id = ? GROUP BY status',
+                             (job_id,)).fetchall())
+        job = dict(job)
+        job['params'] = json.loads(job['params'])
+        job['done'] = counts.get('done', 0)
+        job['failed'] = counts.get('failed', 0)
+        job['pending'] = counts.get('pending', 0)
+        return job
+
+    def list_jobs(self, limit=20):
+        with closing(self._connect()) as conn:
+            job_ids = [row[0] for row in conn.execute(
+                'SELECT job_id FROM jobs ORDER BY created_at DESC LIMIT ?', (limit,))]
+        return [self.get_job(job_id) for job_id in job_ids]
+
+    def get_pending_urls(self, job_id):
+        # 未完了のURLだけを返す（再開時はここから続ける）
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT position, url, lastmod FROM job_urls WHERE job_id = ? AND status = 'pending' "
+                'ORDER BY position', (job_id,)).fetchall()
+        return [tuple(row) for row in rows]
+
+    def get_records(self, job_id, offset=0, limit=None):
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT record FROM job_urls WHERE job_id = ? AND status != 'pending' "
+                'ORDER BY position LIMIT ? OFFSET ?', (job_id, -1 if limit is None else limit, offset)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def iter_records(self, job_id, batch_size=SCRAPE_RESULT_BATCH_SIZE):
+        # 完了したページの結果を一定件数ずつ返す（全件をメモリに載せない）
+        position = -1
+        while True:
+            with closing(self._connect()) as conn:
+                rows = conn.execute(
+                    "SELECT position, record FROM job_urls WHERE job_id = ? AND status != 'pending' "
+                    'AND position > ? ORDER BY position LIMIT ?', (job_id, position, batch_size)).fetchall()
+            if not rows:
+                return
+            position = rows[-1][0]
+            yield [json.loads(row[1]) for row in rows]
+
+    def get_summary(self, job_id):
+        # LLM抽出キャッシュと前処理によるトークン削減の状況をSQLで集計する
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                'SELECT '
+                "SUM(json_extract(record, '$.cache_hit')), "
+                "SUM(json_extract(record, '$.success') AND NOT json_extract(record, '$.cache_hit')), "
+                "SUM(json_extract(record, '$.not_modified')), "
+                "SUM(json_extract(record, '$.tokens_raw')), "
+                "SUM(json_extract(record, '$.tokens_sent')), "
+                "SUM(json_extract(record, '$.seconds_saved')), "
+                "SUM(json_extract(record, '$.near_duplicate_of') IS NOT NULL), "
+                "SUM(json_extract(record, '$.site_schema')) "
+                "FROM job_urls WHERE job_id = ? AND status != 'pending'", (job_id,)).fetchone()
+        return {
+            'cache_hits': row[0] or 0,
+            'cache_misses': row[1] or 0,
+            'not_modified': row[2] or 0,
+            'tokens_raw': row[3] or 0,
+            'tokens_sent': row[4] or 0,
+            'seconds_saved': row[5] or 0.0,
+            'near_duplicates': row[6] or 0,
+            'site_schemas': row[7] or 0,
+        }
+
+    def get_recent_errors(self, job_id, limit=5):
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT record FROM job_urls WHERE job_id = ? AND status = 'failed' "
+                'ORDER BY finished_at DESC LIMIT ?', (job_id, limit)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def mark_interrupted(self):
+        # プロセスの再起動で止まったジョブを中断扱いにする
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                f"UPDATE jobs SET status = 'interrupted', updated_at = ? "
+                f"WHERE status IN ({', '.join('?' * len(SCRAPING_JOB_ACTIVE_STATUSES))})",
+                (time.time(), *SCRAPING_JOB_ACTIVE_STATUSES))
+
+
+class ScrapeResultSink:
+    # ページ毎の結果をJSON Linesに追記する（ジョブを再開した場合も同じファイルに追記する）
+
+    def __init__(self, job_id, directory=SCRAPE_RESULT_DIR):
+        self.path = os.path.join(directory, f'{job_id}.jsonl')
+        self._file = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def iter_records(self):
+        if not self.exists():
+            return
+        with open(self.path, encoding='utf-8') as file:
+            for line in file:
+                yield json.loads(line)
+
+    def to_parquet(self, path=None, batch_size=SCRAPE_RESULT_BATCH_SIZE):
+        # 一定件数ずつ読み込んで書き出し、結果の件数によらずメモリ使用量を一定にする
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        path = path or self.path.replace('.jsonl', '.parquet')
+        schema = pa.schema([(name, pa.type_for_alias(alias)) for name, alias in SCRAPE_RESULT_PARQUET_COLUMNS.items()])
+        temp_path = f'{path}.tmp'
+        with pq.ParquetWriter(temp_path, schema) as writer:
+            rows = []
+            for record in self.iter_records():
+                row = {name: record.get(name) for name in SCRAPE_RESULT_PARQUET_COLUMNS}
+                row['metrics'] = json.dumps(record.get('metrics') or {})
+                rows.append(row)
+                if len(rows) >= batch_size:
+                    writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                    rows = []
+            if rows:
+                writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+        os.replace(temp_path, path)
+        return path
+
+
+# ジョブ間で共有するブラウザの設定
+SHARED_CRAWLER_IDLE_TIMEOUT = 10 * 60  # 使われていないブラウザを閉じるまでの時間（秒）
+SHARED_CRAWLER_MAX_MEMORY = 2 * 1024 ** 3  # 使われていない間にこれを超えたブラウザは閉じる（バイト）
+SHARED_CRAWLER_CHECK_INTERVAL = 30  # 上記を確認する間隔（秒）
+
+
+def get_child_process_memory():
+    # ブラウザなど子プロセスのメモリ使用量（RSS）の合計
+    total = 0
+    for child in psutil.Process().children(recursive=True):
+        with suppress(psutil.Error):
+            total += child.memory_info().rss
+    return total
+
+
+class SharedScrapingResources:
+    # 起動済みのブラウザとLLMのレート制限を、同じプロセスで実行する全ジョブで共有する
+    # （ジョブランナーのイベントループ上でのみ使う）
+
+    def __init__(self,
+                 idle_timeout=SHARED_CRAWLER_IDLE_TIMEOUT,
+                 max_memory=SHARED_CRAWLER_MAX_MEMORY):
+        self.idle_timeout = idle_timeout
+        self.max_memory = max_memory
+        from crawl4ai import BrowserConfig
+
+        self.browser_config = BrowserConfig(
+            user_agent_mode="random",  # ボット検出に対抗
+            verbose=True,
+        )
+        # LLMのレート制限はジョブ毎ではなくプロセス全体で守る
+        self.request_limiter = TokenBucket(LLM_REQUESTS_PER_MINUTE)
+        self.token_limiter = TokenBucket(LLM_TOKENS_PER_MINUTE)
+        self.crawler = None
+        self.users = 0
+        self.launches = 0
+        self.last_used = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    @asynccontextmanager
+    async def use_crawler(self):
+        # 起動済みのブラウザがあれば使い回し、無ければ起動する
+        async with self._lock:
+            if self.crawler is None:
+                from crawl4ai import AsyncWebCrawler
+
+                crawler = AsyncWebCrawler(config=self.browser_config)
+                await crawler.start()
+                self.crawler = crawler
+                self.launches += 1
+            self.users += 1
+        try:
+            yield self.crawler
+        finally:
+            self.users -= 1
+            self.last_used = time.monotonic()
+
+    async def close(self):
+        # 使用中のジョブがある場合は閉じない
+        async with self._lock:
+            if self.crawler is None or self.users > 0:
+                return False
+            crawler, self.crawler = self.crawler, None
+        try:
+            await crawler.close()
+        except Exception as e:
+            print(f"SharedScrapingResources.close() failed to close browser: {e}")
+        return True
+
+    async def close_idle(self):
+        # 一定時間使われていないか、メモリを使いすぎているブラウザを閉じる
+        while True:
+            await asyncio.sleep(SHARED_CRAWLER_CHECK_INTERVAL)
+            if self.crawler is None or self.users > 0:
+                continue
+            if time.monotonic() - self.last_used > self.idle_timeout or \
+                    get_child_process_memory() > self.max_memory:
+                await self.close()
+
+
+def get_metrics_path(job_id):
+    return os.path.join(METRICS_DIR, f'scrape-{job_id}.jsonl')
+
+
+class ScrapingJobRunner:
+    # Streamlitの再実行とは独立したスレッドでイベントループを動かし、スクレイピングジョブを実行する
+
+    def __init__(self, store):
+        self.store = store
+        self.loop = asyncio.new_event_loop()
+        self.futures = {}
+        self.metrics = {}
+        self.thread = threading.Thread(target=self.loop.run_forever, name='scraping-job-runner', daemon=True)
+        self.thread.start()
+        # ブラウザとLLMのレート制限はジョブをまたいで共有する
+        self.resources = SharedScrapingResources()
+        asyncio.run_coroutine_threadsafe(self.resources.close_idle(), self.loop)
+
+    def restart_browser(self):
+        # 次のジョブで新しいブラウザを起動する（実行中のジョブがある場合は閉じない）
+        return asyncio.run_coroutine_threadsafe(self.resources.close(), self.loop).result()
+
+    def submit(self, job_id):
+        # 未完了のURLから実行する（新規ジョブも再開も同じ処理）
+        if self.is_running(job_id):
+            return
+        self.store.set_status(job_id, 'queued')
+        self.futures[job_id] = asyncio.run_coroutine_threadsafe(self._run(job_id), self.loop)
+
+    def cancel(self, job_id):
+        future = self.futures.get(job_id)
+        if future is not None:
+            future.cancel()
+
+    def get_metrics(self, job_id):
+        # 実行中のジョブは計測値の集計をメモリに持ち、URL毎にJSON Linesにも追記する
+        if job_id not in self.metrics:
+            self.metrics[job_id] = PipelineMetrics.from_jsonl(get_metrics_path(job_id))
+        return self.metrics[job_id]
+
+    def is_running(self, job_id):
+        future = self.futures.get(job_id)
+        return future is not None and not future.done()
+
+    async def _run(self, job_id):
+        job = self.store.get_job(job_id)
+        pending = self.store.get_pending_urls(job_id)
+        positions = [position for position, _, _ in pending]
+        urls = [url for _, url, _ in pending]
+        lastmods = {url: lastmod for _, url, lastmod in pending}
+        self.store.set_status(job_id, 'running')
+        sink = ScrapeResultSink(job_id)
+
+        def on_result(index, record):
+            # 結果ファイルに追記してからチェックポイントを記録する
+            sink.append(record)
+            self.store.save_record(job_id, positions[index], record)
+
+        try:
+            with sink:
+                await scrape_data(urls, lastmods=lastmods, on_result=on_result, metrics=self.get_metrics(job_id),
+                                  resources=self.resources, **job['params'])
+        except asyncio.CancelledError:
+            self.store.set_status(job_id, 'cancelled')
+            raise
+        except Exception as e:
+            print(f"ScrapingJobRunner._run() failed to run job {job_id}: {e}")
+            self.store.set_status(job_id, 'failed', str(e))
+        else:
+            self.store.set_status(job_id, 'completed')
+        finally:
+            # 終了したジョブの計測値はファイルから読み込む
+            self.metrics.pop(job_id, None)
+
+
+@st.cache_resource
+def get_scraping_job_runner():
+    # プロセス内で1つだけ作成し、セッションや再実行をまたいで共有する
+    store = ScrapingJobStore()
+    store.mark_interrupted()
+    return ScrapingJobRunner(store)
 
 
 def init():
@@ -31,10 +3078,10 @@ def init():
                        initial_sidebar_state="collapsed")
     # セッションステート（家具選定）
     if 'furniture_condition_list' not in st.session_state:
-        # カラム名とデータ型の辞書を定義
+        # カラム名とデータ型の辞書を定義（範囲はタプル、選択肢はリストのまま保持する）
         column_types = {}
         for key in FURNITURE_CONDITIONS.keys():
-            column_types[key] = str
+            column_types[key] = object
         # セッションステートのDataFrameを初期化
         st.session_state['furniture_condition_list'] = pd.DataFrame({
             col: pd.Series(dtype=dtype) for col, dtype in column_types.items()
@@ -42,10 +3089,26 @@ def init():
     # セッションステート（スクレイピング）
     if 'scraping_data_source_type' not in st.session_state:
         st.session_state['scraping_data_source_type'] = 0
+    if 'scraping_incremental' not in st.session_state:
+        st.session_state['scraping_incremental'] = False
+    if 'scraping_include_patterns' not in st.session_state:
+        st.session_state['scraping_include_patterns'] = ''
+    if 'scraping_exclude_patterns' not in st.session_state:
+        st.session_state['scraping_exclude_patterns'] = ''
+    if 'scraping_discovery_max_depth' not in st.session_state:
+        st.session_state['scraping_discovery_max_depth'] = DISCOVERY_MAX_DEPTH
+    if 'scraping_discovery_max_concurrency_per_host' not in st.session_state:
+        st.session_state['scraping_discovery_max_concurrency_per_host'] = DISCOVERY_MAX_CONCURRENCY_PER_HOST
+    if 'scraping_discovery_host_delay' not in st.session_state:
+        st.session_state['scraping_discovery_host_delay'] = DISCOVERY_HOST_DELAY
     if 'scraping_all_url_list' not in st.session_state:
         st.session_state['scraping_all_url_list'] = pd.DataFrame()
     if 'scraping_selected_url_list' not in st.session_state:
         st.session_state['scraping_selected_url_list'] = pd.DataFrame()
+    if 'scraping_job_id' not in st.session_state:
+        st.session_state['scraping_job_id'] = None
+    if 'scraping_job_polling' not in st.session_state:
+        st.session_state['scraping_job_polling'] = None
 
 
 def sidebar():
@@ -100,19 +3163,14 @@ def add_furniture_condition_list(conditions):
         st.invalid("選定条件が正しく設定されていません。")
         return
 
+    # 検索で使えるよう、数値範囲はタプル、選択肢はリストのまま保存する
+    # （一覧表示用の文字列化は format_furniture_condition_list() で行う）
     new_condition = {}
     for key in FURNITURE_CONDITIONS.keys():
-        if isinstance(conditions[key], tuple) and len(
-                conditions[key]) == 2 and conditions[key][0] <= conditions[key][1]:
-            # 数値範囲の場合、文字列に変換
-            new_condition[key] = f"{conditions[key][0]} - {conditions[key][1]} mm"
+        if isinstance(conditions[key], tuple):
+            new_condition[key] = tuple(conditions[key])
         else:
-            # リストの場合、カンマ区切りの文字列に変換
-            # if isinstance(conditions[key], list):
-            #     new_condition[key] = ', '.join(conditions[key])
-            # else:   # 単一選択の場合
-            #     new_condition[key] = conditions[key]
-            new_condition[key] = conditions[key]
+            new_condition[key] = list(conditions[key])
 
     # 新しい行をDataFrameとして作成
     new_row_df = pd.DataFrame([new_condition])
@@ -158,18 +3216,8 @@ def search_conditions():
             # カテゴリ
             with st.container(border=True):
                 category = sac.cascader(items=[
-                    sac.CasItem('ソファ',
-                                children=[
-                                    sac.CasItem('1人掛けソファ'),
-                                    sac.CasItem('2人掛けソファ'),
-                                    sac.CasItem('3人掛けソファ'),
-                                ]),
-                    sac.CasItem('チェア・椅子',
-                                children=[
-                                    sac.CasItem('オフィスチェア・ワークチェア'),
-                                    sac.CasItem('ミーティングチェア'),
-                                    sac.CasItem('ダイニングチェア'),
-                                ]),
+                    sac.CasItem(parent, children=[sac.CasItem(child) for child in children])
+                    for parent, children in FURNITURE_CATEGORIES.items()
                 ],
                                         label='カテゴリ',
                                         placeholder='カテゴリを選択してください（まだ全カテゴリ入れてません）',
@@ -240,7 +3288,8 @@ def search_conditions():
             sac.divider(label='条件一覧', icon='card-checklist', align='start', color='red')
             # 選定条件一覧
             with st.container(border=True):
-                st.dataframe(data=st.session_state['furniture_condition_list'],
+                st.dataframe(data=format_furniture_condition_list(
+                    st.session_state['furniture_condition_list']),
                              key='furniture_condition_list_df',
                              hide_index=True,
                              on_select="rerun",
@@ -267,23 +3316,19 @@ def chat_input():
     if prompt:
         # st.write(f"User has sent the following prompt: {prompt}")
         with st.chat_message(name="assistant"):
-            st.markdown('''
-こちらの商品はいかがでしょうか？  
-商品名：[PENTE 1P SOFA](https://www.asplund-contract.com/product/12426/)  
-ブランド：Work Plus  
-Size:W760 D760 H670 SH425  
-Material:Fabric, Steel  
-Price:￥120,000  
-![PENTE 1P SOFA](https://www.asplund-contract.com/wp-content/uploads/2024/06/wp_pente1psofa-3-600x600.jpg)
-  
-  
-商品名：[MELTONE 1P SOFA](https://www.asplund-contract.com/product/12396/)  
-ブランド：Work Plus  
-Size:W870 D720 H750 SH410
-Material:Fabric, Steel  
-Price:￥110,000  
-![PENTE 1P SOFA](https://www.asplund-contract.com/wp-content/uploads/2024/06/wp_meltone1psofa-1-600x600.jpg)
-''')
+            # 同じご要望はキャッシュした提案文と商品を使い、検索（埋め込み）もLLMも呼ばない
+            cache_key = make_recommendation_cache_key(query=prompt.text)
+            cached = get_recommendation_cache().get(cache_key)
+            if cached is not None:
+                df_products = query_catalog(urls=cached['urls']).set_index('url')
+                df_products = df_products.loc[[url for url in cached['urls'] if url in df_products.index]].reset_index()
+            else:
+                df_products = search_products_by_text(prompt.text)
+            if len(df_products) == 0:
+                st.markdown('ご要望に合う商品が見つかりませんでした。')
+                return
+            write_recommendation(cache_key, format_recommendation_request(query=prompt.text), df_products)
+            show_products(df_products)
 
 
 def scrapintg():
@@ -315,10 +3360,49 @@ def scrapintg():
             url = st.text_input(label='URLを入力してください',
                                 value='https://www.asplund-contract.com/product/br/workplus/',
                                 placeholder='https://example.com',
-                                help='スクレイピングしたいページのURLを入力してください。')
+                                help='ブランドやカテゴリの一覧ページのURLを入力してください。ページ送りと配下の一覧ページを辿って商品URLを探します。')
         else:
             url = ''
 
+        if data_source_type in (0, 1):
+            col1, col2 = st.columns(spec=2, gap='large', border=False)
+            with col1:
+                st.text_input(label='含めるURLパターン',
+                              key='scraping_include_patterns',
+                              placeholder=r'/product/\d+/',
+                              help='正規表現をカンマ区切りで入力してください。いずれかに一致するURLのみを対象にします。'
+                              '一覧ページからの探索で未指定の場合は、/product/ や /item/ などを含むURLを商品ページとみなします。')
+            with col2:
+                st.text_input(label='除外するURLパターン',
+                              key='scraping_exclude_patterns',
+                              placeholder=r'/product/br/',
+                              help='正規表現をカンマ区切りで入力してください。いずれかに一致するURLを除外します。')
+        if data_source_type == 0:  # XMLサイトマップ
+            st.checkbox(label='差分のみ（前回から新規・更新されたURLのみ）',
+                        key='scraping_incremental',
+                        help='前回のlastmodとETag/Last-Modifiedを記録し、変更されたURLのみをスクレイピングします。')
+        elif data_source_type == 1:  # URL
+            col1, col2, col3 = st.columns(spec=3, gap='large', border=False)
+            with col1:
+                st.number_input(label='探索する深さ',
+                                key='scraping_discovery_max_depth',
+                                min_value=0,
+                                max_value=10,
+                                help='開始ページから辿る一覧ページの深さです。')
+            with col2:
+                st.number_input(label='同時取得数（ホスト毎）',
+                                key='scraping_discovery_max_concurrency_per_host',
+                                min_value=1,
+                                max_value=16,
+                                help='同じホストに対して同時に取得する一覧ページ数の上限です。')
+            with col3:
+                st.number_input(label='リクエスト間隔（秒）',
+                                key='scraping_discovery_host_delay',
+                                min_value=0.0,
+                                max_value=30.0,
+                                step=0.5,
+                                help='同じホストへのリクエストの最小間隔です。')
+
         # URL解析ボタン
         url_analyze_flag = st.button(label='URL解析',
                                      icon='🔍',
@@ -331,15 +3415,42 @@ def scrapintg():
     # URL解析
     if url_analyze_flag:
         if data_source_type == 0:  # XMLサイトマップ
-            sm = SiteMapParser(url)  # reads /sitemap.xml
-            json_exporter = JSONExporter(sm)
-            if sm.has_urls():
-                df_urls = pd.read_json(io.StringIO(json_exporter.export_urls()))
-                df_urls.drop(columns=['lastmod', 'changefreq', 'priority'], inplace=True)
-                df_urls.rename(columns={'loc': 'URL'}, inplace=True)
+            with st.spinner('サイトマップを解析しています...'):
+                df_urls, errors, loaded_at = load_sitemap_cached(url)
+            if errors:
+                # 一部の読み込みに失敗した結果は次回に持ち越さない
+                load_sitemap_cached.clear(url)
+            else:
+                loaded_at = pd.Timestamp(loaded_at, unit='s', tz='UTC').tz_convert('Asia/Tokyo')
+                st.caption(f'{loaded_at:%Y-%m-%d %H:%M:%S} に取得したサイトマップを使用しています'
+                           f'（{SITEMAP_CACHE_TTL // 60} 分間キャッシュ）。')
+            try:
+                df_urls = filter_url_table(df_urls,
+                                           split_patterns(st.session_state['scraping_include_patterns']),
+                                           split_patterns(st.session_state['scraping_exclude_patterns']))
+            except re.error as e:
+                st.error(f"URLパターンが正しくありません: {e}")
+                df_urls, errors = pd.DataFrame(), []
+            for error in errors:
+                st.warning(f"サイトマップの読み込みに失敗しました: {error}")
+            if len(df_urls) > 0:
+                df_urls.drop(columns=['changefreq', 'priority'], inplace=True)
+                if st.session_state['scraping_incremental']:
+                    # 前回から変更の無いURLを除外
+                    df_urls = asyncio.run(classify_incremental_urls(df_urls))
+                    unchanged_count = int((df_urls['状態'] == '変更なし').sum())
+                    df_urls = df_urls[df_urls['状態'] != '変更なし'].reset_index(drop=True)
+                    st.info(f'前回から変更の無い {unchanged_count} 件のURLを除外しました。')
         elif data_source_type == 1:  # URL
-            # asyncio.run(scrape_item_list(url))
-            st.write("未実装")
+            try:
+                df_urls, errors = discover_urls_to_table(
+                    url, split_patterns(st.session_state['scraping_include_patterns']),
+                    split_patterns(st.session_state['scraping_exclude_patterns']))
+            except re.error as e:
+                st.error(f"URLパターンが正しくありません: {e}")
+                df_urls, errors = pd.DataFrame(), []
+            for error in errors:
+                st.warning(f"一覧ページの読み込みに失敗しました: {error}")
 
     else:
         df_urls = st.session_state['scraping_all_url_list']
@@ -356,168 +3467,991 @@ def scrapintg():
                                      on_select="rerun",
                                      selection_mode="multi-row").selection
             # 選択されたURLをセッションステートに保存
-            if selection.rows:
+            select_all = st.checkbox(label='一覧のすべてのURLを対象にする', key='scraping_select_all')
+            if select_all:
+                st.session_state['scraping_selected_url_list'] = df_urls
+            elif selection.rows:
                 st.session_state['scraping_selected_url_list'] = df_urls.iloc[selection.rows, :]
             else:
                 st.session_state['scraping_selected_url_list'] = pd.DataFrame()
 
             # スクレイピングボタン
             if len(st.session_state['scraping_selected_url_list']) > 0:
+                # 同時取得数
+                col1, col2, col3 = st.columns(spec=3, gap='large', border=False)
+                with col1:
+                    max_concurrency = st.number_input(label='同時取得数（全体）',
+                                                      min_value=1,
+                                                      max_value=32,
+                                                      value=SCRAPING_MAX_CONCURRENCY,
+                                                      help='同時に取得するページ数の上限です。')
+                with col2:
+                    max_concurrency_per_host = st.number_input(
+                        label='同時取得数（ホスト毎）',
+                        min_value=1,
+                        max_value=32,
+                        value=SCRAPING_MAX_CONCURRENCY_PER_HOST,
+                        help='同じホストに対して同時に取得するページ数の上限です。')
+                with col3:
+                    llm_concurrency = st.number_input(label='LLM同時実行数',
+                                                      min_value=1,
+                                                      max_value=64,
+                                                      value=LLM_MAX_CONCURRENCY,
+                                                      help='LLMに同時に送るリクエスト数の上限です。')
+                llm_batching = st.checkbox(label='小さいページをまとめてLLMに送る',
+                                           help='複数の小さい商品ページを1回のリクエストで抽出します。')
+                near_duplicates = st.checkbox(label='バリエーションページは差分のみLLMに送る',
+                                              value=True,
+                                              help='色・張地・サイズ違いなど内容がほぼ同じページをまとめ、'
+                                              '代表ページの抽出結果との差分のみを抽出します。')
+                site_schemas = st.checkbox(label='サイト毎にCSSスキーマを学習してLLMを使わずに抽出する',
+                                           help='サイト毎に数ページをLLMで抽出した結果からCSSセレクタのスキーマを生成し、'
+                                           '検証に通ったスキーマで残りのページを抽出します。'
+                                           '抽出結果を検証できないページはLLMで抽出します。')
                 scraping_flag = st.button(label='スクレイピング', icon='🕷️', use_container_width=True)
 
     # スクレイピング
+    runner = get_scraping_job_runner()
     if scraping_flag:
+        # バックグラウンドのジョブとして実行し、画面の再実行や再読み込みでは止めない
+        df_selected_urls = st.session_state['scraping_selected_url_list']
+        lastmods = None
+        if 'lastmod' in df_selected_urls.columns:
+            lastmods = dict(zip(df_selected_urls['URL'], df_selected_urls['lastmod']))
+        job_id = runner.store.create_job(df_selected_urls['URL'].tolist(),
+                                         lastmods=lastmods,
+                                         params={
+                                             'max_concurrency': int(max_concurrency),
+                                             'max_concurrency_per_host': int(max_concurrency_per_host),
+                                             'incremental': st.session_state['scraping_incremental'],
+                                             'llm_concurrency': int(llm_concurrency),
+                                             'llm_batching': llm_batching,
+                                             'near_duplicates': near_duplicates,
+                                             'site_schemas': site_schemas,
+                                         })
+        runner.submit(job_id)
+        st.session_state['scraping_job_id'] = job_id
+
+    # ジョブ履歴（中断したジョブはここから再開する）
+    jobs = runner.store.list_jobs()
+    if len(jobs) > 0:
+        with st.expander(label='スクレイピングジョブ', expanded=False):
+            st.dataframe(pd.DataFrame([{
+                'ジョブID': job['job_id'],
+                '状態': SCRAPING_JOB_STATUS_LABELS.get(job['status'], job['status']),
+                '完了': job['done'],
+                '失敗': job['failed'],
+                '未完了': job['pending'],
+                '作成日時': pd.Timestamp(job['created_at'], unit='s', tz='UTC').tz_convert('Asia/Tokyo'),
+            } for job in jobs]),
+                         use_container_width=True,
+                         hide_index=True)
+            col1, col2 = st.columns(spec=[3, 1], gap='small', border=False, vertical_alignment='bottom')
+            with col1:
+                selected_job_id = st.selectbox(label='ジョブ',
+                                               options=[job['job_id'] for job in jobs],
+                                               index=None,
+                                               placeholder='表示・再開するジョブを選択してください')
+            with col2:
+                selected_job = next((job for job in jobs if job['job_id'] == selected_job_id), None)
+                resumable = selected_job is not None and selected_job['pending'] > 0 and \
+                    not runner.is_running(selected_job_id)
+                if st.button(label='再開' if resumable else '表示', use_container_width=True,
+                             disabled=selected_job is None):
+                    if resumable:
+                        runner.submit(selected_job_id)
+                    st.session_state['scraping_job_id'] = selected_job_id
+                    st.rerun()
+
+    # 再実行・セッションをまたいで共有しているキャッシュとブラウザ
+    with st.expander(label='キャッシュ', expanded=False):
+        scraping_cache_controls(runner)
+
+    job_id = st.session_state['scraping_job_id']
+    if job_id is not None and runner.store.get_job(job_id) is not None:
         with st.expander(label='スクレイピング', expanded=True):
-            scraped_data = asyncio.run(
-                scrape_data(st.session_state['scraping_selected_url_list']['URL'].tolist()))
-            st.text_area(label='スクレイピング結果', value=scraped_data, height=300, disabled=True)
-            st.button(label='データを保存', icon='💾', use_container_width=True)
-
-
-async def scrape_data(urls):
-
-    class ProductInfo(BaseModel):
-        brand_name: str = Field(..., description="ブランド名を表す文字列")
-        item_name: str = Field(..., description="アイテム名を表す文字列")
-        size: str = Field(..., description="サイズを表す文字列. 例：W500 D500 H550 ")
-        weight: str = Field(..., description="重量を表す文字列. 例：15kg")
-        material: str = Field(..., description="素材を表す文字列. 例：Fabric, Steel")
-        price: str = Field(..., description="価格を表す文字列. 例：￥120,000（税込）")
-        description: str = Field(...,
-                                 description="商品説明を表す文字列. 例：このソファは、快適な座り心地とスタイリッシュなデザインを兼ね備えています。")
-        image_urls: list[str] = Field(..., description="商品画像のURLリスト")  # 画像のURLリスト
-
-    browser_config = BrowserConfig(
-        user_agent_mode="random",  # ボット検出に対抗
-        verbose=True,
-        # headless=False
-    )
-    # Define the LLM extraction strategy
-    llm_strategy = LLMExtractionStrategy(
-        llm_config=LLMConfig(provider="gemini/gemini-2.5-flash",
-                             api_token=st.secrets['GEMINI_API_TOKEN']),
-        schema=ProductInfo.model_json_schema(),
-        extraction_type="schema",
-        # extraction_type="block",
-        verbose=True,
-        instruction='''
-与えられたコンテンツを、以下のJSON形式に変換して出力してください。\n\n
-プログラムコードではなく、JSON形式のデータを出力します。
-JSON以外の文字やコメントは絶対に絶対に絶対に出力しないでください。
+            # 進捗は一定間隔でポーリングし、画面全体は再実行しない
+            scraping_job_progress(job_id)
+            pipeline_metrics_downloads(job_id)
+            if runner.is_running(job_id):
+                return
+            # 結果は保存先から1ページ分ずつ読み込んで表示する
+            scrape_result_preview(runner.store, job_id)
+            # LLM抽出キャッシュのヒット状況
+            summary = runner.store.get_summary(job_id)
+            st.caption(f"LLM抽出キャッシュ: ヒット {summary['cache_hits']} 件 / ミス {summary['cache_misses']} 件 / "
+                       f"未変更（304）: {summary['not_modified']} 件 / "
+                       f"バリエーション（差分のみ抽出）: {summary['near_duplicates']} 件 / "
+                       f"CSSスキーマで抽出: {summary['site_schemas']} 件")
+            # 前処理によるトークン削減の状況
+            if summary['tokens_raw'] > 0:
+                st.caption(f"LLM入力トークン: {summary['tokens_raw']:,} → {summary['tokens_sent']:,} "
+                           f"（{1 - summary['tokens_sent'] / summary['tokens_raw']:.0%} 削減） / "
+                           f"削減時間（推定）: {summary['seconds_saved']:.1f} 秒")
+            sink = ScrapeResultSink(job_id)
+            if sink.exists():
+                st.caption(f'markdownを含む全項目の結果: {sink.path}')
+            col1, col2 = st.columns(spec=2, gap='small', border=False)
+            with col1:
+                if st.button(label='Parquetに書き出す', icon='📦', use_container_width=True,
+                             disabled=not sink.exists()):
+                    with st.spinner('結果を書き出しています...'):
+                        path = sink.to_parquet()
+                    st.success(f'{path} に書き出しました。')
+            with col2:
+                save_flag = st.button(label='データを保存', icon='💾', use_container_width=True)
+            if save_flag:
+                saved_count = 0
+                with st.spinner('商品カタログに保存しています...'):
+                    for records in runner.store.iter_records(job_id):
+                        # 商品カタログに保存
+                        saved_count += save_products(records)
+                        # 自由入力検索のインデックスに保存した商品を反映
+                        saved_urls = [record['url'] for record in records if record['success']]
+                        df_saved = query_catalog(urls=saved_urls)
+                        get_retrieval_index().update(df_saved)
+                        # 検索結果で表示する商品画像を取得しておく
+                        cache_product_images(df_saved)
+                st.success(f'{saved_count} 件の商品を商品カタログに保存しました。')
 
-# 以下の条件を必ず守ってください:
-- 結果は厳密なJSONオブジェクトを返すこと
-- JSON以外の文字やコメントは絶対に絶対に絶対に出力しない
-# 出力例
-{
-  "brand_name": "ここにブランド名",
-  "item_name": "ここに商品名を出力",
-  "size": "ここにサイズをmm単位に変換して出力",
-  "weight": "ここに重量をkg単位に変換して出力",
-  "material": "ここに素材を出力",
-  "price": "ここに価格を日本円で出力（税込/税抜がわかるように記載）",
-  "description": "ここに商品説明を出力",
-  "image_urls": [
-    "https://example.com/images/item1.jpg",
-    "https://example.com/images/item2.jpg",
-    "https://example.com/images/item3.jpg"
-  ]
-}
-''',
-        chunk_token_threshold=65536,
-        overlap_rate=0.0,
-        apply_chunking=True,
-        input_format="markdown",  # or "html", "fit_markdown"
-        extra_args={
-            "temperature": 0.0,
-            "max_tokens": 65536
-        })
+
+def truncate_text(text, max_chars=SCRAPE_PREVIEW_MAX_CHARS):
+    text = '' if text is None else str(text)
+    return text if len(text) <= max_chars else text[:max_chars] + '…'
+
+
+def scrape_result_preview(store, job_id):
+    # 完了したページの結果を1ページ分ずつ、長い項目を切り詰めて表示する（markdownは表示しない）
+    job = store.get_job(job_id)
+    finished = job['done'] + job['failed']
+    page_count = max((finished + SCRAPE_PREVIEW_PAGE_SIZE - 1) // SCRAPE_PREVIEW_PAGE_SIZE, 1)
+    col1, col2 = st.columns(spec=[1, 3], gap='small', border=False, vertical_alignment='bottom')
+    with col1:
+        page = st.number_input(label='ページ',
+                               min_value=1,
+                               max_value=page_count,
+                               value=1,
+                               key=f'scraping_preview_page_{job_id}')
+    offset = (page - 1) * SCRAPE_PREVIEW_PAGE_SIZE
+    records = store.get_records(job_id, offset=offset, limit=SCRAPE_PREVIEW_PAGE_SIZE)
+    with col2:
+        st.caption(f'{finished} 件中 {offset + 1 if records else 0}〜{offset + len(records)} 件目を表示しています。')
+    df_preview = pd.DataFrame([{
+        '状態': '変更なし' if record['not_modified'] else '成功' if record['success'] else '失敗',
+        'URL': record['url'],
+        '抽出結果': truncate_text(record['extracted_content']),
+        'エラー': '' if record['success'] else
+                  truncate_text(f"status_code:{record['status_code']} message:{record['error_message']}"),
+        '代表ページ': record.get('near_duplicate_of'),
+        'CSSスキーマ': record.get('site_schema', False),
+        '入力トークン（全体）': record['tokens_raw'],
+        '入力トークン（送信）': record['tokens_sent'],
+        '出力トークン': record['tokens_out'],
+        'LLM処理時間（秒）': round(record['llm_seconds'], 2),
+        '処理時間（秒）': round(record.get('seconds', 0.0), 2),
+    } for record in records])
+    if len(df_preview) > 0:
+        st.dataframe(df_preview,
+                     column_config={
+                         "URL": st.column_config.LinkColumn("URL"),
+                         "代表ページ": st.column_config.LinkColumn("代表ページ"),
+                     },
+                     use_container_width=True,
+                     hide_index=True)
+
+
+async def clear_llm_extraction_cache():
+    async with LLMExtractionCache() as cache:
+        await cache.clear()
+
+
+async def clear_site_schemas():
+    async with SiteSchemaStore() as store:
+        await store.clear()
+
+
+def scraping_cache_controls(runner):
+    # 共有キャッシュの状態とメモリ使用量を表示し、明示的に破棄できるようにする
+    resources = runner.resources
+    col1, col2, col3 = st.columns(spec=3, gap='large', border=False)
+    with col1:
+        st.metric(label='メモリ使用量（アプリ）', value=f'{psutil.Process().memory_info().rss / 1024 ** 2:,.0f} MB')
+    with col2:
+        st.metric(label='メモリ使用量（ブラウザ）', value=f'{get_child_process_memory() / 1024 ** 2:,.0f} MB')
+    with col3:
+        if resources.crawler is None:
+            browser_state = '停止中'
+        elif resources.users > 0:
+            browser_state = f'使用中（{resources.users} ジョブ）'
+        else:
+            browser_state = '待機中'
+        st.metric(label='ブラウザ', value=browser_state)
+    st.caption(f'サイトマップは {SITEMAP_CACHE_TTL // 60} 分間、最大 {SITEMAP_CACHE_MAX_ENTRIES} 件までキャッシュします。'
+               f'ブラウザは {SHARED_CRAWLER_IDLE_TIMEOUT // 60} 分間使われないか、'
+               f'{SHARED_CRAWLER_MAX_MEMORY / 1024 ** 3:.0f} GB を超えると閉じます。')
+
+    col1, col2, col3, col4, col5, col6 = st.columns(spec=6, gap='small', border=False)
+    with col1:
+        if st.button(label='サイトマップ', icon='🗑️', use_container_width=True, help='サイトマップのキャッシュを削除します。'):
+            load_sitemap_cached.clear()
+            st.toast('サイトマップのキャッシュを削除しました。')
+    with col2:
+        if st.button(label='ブラウザ', icon='🔄', use_container_width=True, help='次のスクレイピングで新しいブラウザを起動します。'):
+            if resources.crawler is None:
+                st.toast('ブラウザは起動していません。')
+            elif runner.restart_browser():
+                st.toast('ブラウザを閉じました。')
+            else:
+                st.toast('実行中のジョブがあるため、ブラウザは閉じませんでした。')
+    with col3:
+        if st.button(label='LLM抽出', icon='🗑️', use_container_width=True, help='LLM抽出結果のキャッシュを削除します。'):
+            asyncio.run(clear_llm_extraction_cache())
+            st.toast('LLM抽出のキャッシュを削除しました。')
+    with col4:
+        if st.button(label='CSSスキーマ', icon='🗑️', use_container_width=True, help='サイト毎に学習したCSSスキーマを削除します。'):
+            asyncio.run(clear_site_schemas())
+            st.toast('CSSスキーマを削除しました。次のスクレイピングで学習し直します。')
+    with col5:
+        if st.button(label='検索カタログ', icon='🔄', use_container_width=True, help='家具選定で使う商品カタログを再読み込みします。'):
+            load_search_catalog.clear()
+            st.toast('検索カタログを再読み込みします。')
+    with col6:
+        if st.button(label='提案文', icon='🗑️', use_container_width=True, help='家具選定の提案文のキャッシュを削除します。'):
+            get_recommendation_cache().clear()
+            st.toast('提案文のキャッシュを削除しました。')
+
+
+def discover_urls_to_table(url, include_patterns, exclude_patterns):
+    # 見つかった商品URLを逐次URL一覧に表示しながら探索する
+    placeholder = st.empty()
+    rows = []
+    errors = []
+
+    async def run():
+        last_update = 0
+        async for row in discover_product_urls(
+                url,
+                include_patterns,
+                exclude_patterns,
+                max_depth=st.session_state['scraping_discovery_max_depth'],
+                max_concurrency_per_host=st.session_state['scraping_discovery_max_concurrency_per_host'],
+                host_delay=st.session_state['scraping_discovery_host_delay'],
+                errors=errors):
+            rows.append(row)
+            # 表示の更新は間引く
+            if time.monotonic() - last_update > 0.5:
+                last_update = time.monotonic()
+                with placeholder.container():
+                    st.caption(f'{len(rows)} 件の商品URLが見つかりました...')
+                    st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+
+    with st.spinner('一覧ページから商品URLを探しています...'):
+        asyncio.run(run())
+    placeholder.empty()
+    df_urls = pd.DataFrame(rows, columns=['URL', '取得元']).astype({'URL': 'string'})
+    return df_urls, errors
+
+
+@st.fragment(run_every=SCRAPING_JOB_POLL_INTERVAL)
+def scraping_job_progress(job_id):
+    runner = get_scraping_job_runner()
+    job = runner.store.get_job(job_id)
+    finished = job['done'] + job['failed']
+    status = SCRAPING_JOB_STATUS_LABELS.get(job['status'], job['status'])
+    progress_bar_text = f"{status}: {finished} / {job['total']}"
+    st.progress(finished / max(job['total'], 1), text=progress_bar_text)
+
+    # スループットとエラー
+    elapsed = (job['finished_at'] or time.time()) - (job['started_at'] or time.time())
+    col1, col2, col3 = st.columns(spec=3, gap='large', border=False)
+    col1.metric(label='完了', value=f"{job['done']} 件")
+    col2.metric(label='失敗', value=f"{job['failed']} 件")
+    col3.metric(label='スループット', value=f"{finished / elapsed * 60 if elapsed > 0 else 0:.1f} 件/分")
+    if job['error_message']:
+        st.error(f"ジョブが失敗しました: {job['error_message']}")
+    for record in runner.store.get_recent_errors(job_id):
+        st.warning(f"{record['url']}: status_code:{record['status_code']} message:{record['error_message']}")
+
+    # 処理段階毎の計測値（終了したジョブはメモリに無いため、計測値のファイルから集計する）
+    metrics = runner.metrics.get(job_id)
+    if metrics is not None:
+        pipeline_metrics_panel(metrics.summary())
+    elif os.path.exists(get_metrics_path(job_id)):
+        pipeline_metrics_panel(load_pipeline_metrics_summary(get_metrics_path(job_id),
+                                                             os.path.getmtime(get_metrics_path(job_id))))
+
+    if runner.is_running(job_id):
+        if st.button(label='中止', icon='⏹️', use_container_width=True):
+            runner.cancel(job_id)
+    elif st.session_state['scraping_job_polling'] == job_id:
+        # ジョブが終わったら画面全体を再実行して結果を表示する
+        st.session_state['scraping_job_polling'] = None
+        st.rerun(scope='app')
+    if runner.is_running(job_id):
+        st.session_state['scraping_job_polling'] = job_id
+
+
+@st.cache_data(max_entries=SCRAPING_METRICS_CACHE_ENTRIES, show_spinner=False)
+def load_pipeline_metrics_summary(path, modified):
+    # ファイルが更新されるまで集計結果を使い回す
+    return PipelineMetrics.from_jsonl(path).summary()
+
+
+def pipeline_metrics_panel(summary):
+    if summary['pages'] == 0:
+        return
+    col1, col2, col3, col4 = st.columns(spec=4, gap='large', border=False)
+    col1.metric(label='LLMトークン（入力 / 出力）',
+                value=f"{summary['prompt_tokens']:,} / {summary['completion_tokens']:,}")
+    col2.metric(label='推定料金', value=f"${summary['cost_usd']:.4f}")
+    col3.metric(label='取得データ量', value=f"{summary['bytes_fetched'] / 1024 / 1024:.1f} MB")
+    col4.metric(label='ブラウザ起動',
+                value='-' if summary['browser_launch_seconds'] is None else f"{summary['browser_launch_seconds']:.1f} 秒")
+    quantiles = summary['page_seconds_quantiles']
+    st.caption(f'markdown: {summary["markdown_chars"]:,} 文字 / 1ページの処理時間: ' +
+               ' / '.join(f'p{quantile * 100:g} {seconds:.2f} 秒' for quantile, seconds in quantiles.items()))
+    # 処理段階毎の合計時間（並行して処理するため、合計はジョブの経過時間より長くなる）
+    total_seconds = sum(summary['stage_seconds'].values())
+    st.dataframe(pd.DataFrame([{
+        '処理段階': label,
+        '合計時間（秒）': round(summary['stage_seconds'][stage], 2),
+        '1ページ平均（秒）': round(summary['stage_seconds'][stage] / summary['pages'], 3),
+        '割合': f"{summary['stage_seconds'][stage] / max(total_seconds, 1e-9):.0%}",
+    } for stage, label in PIPELINE_STAGES.items()]),
+                 use_container_width=True,
+                 hide_index=True)
+
+
+def pipeline_metrics_downloads(job_id):
+    # ダウンロード用のデータは進捗の更新ごとには作らず、ボタンを押した時に計測値のファイルから作る
+    path = get_metrics_path(job_id)
+    if not os.path.exists(path):
+        return
+    if not st.button(label='計測値をダウンロード', icon='📥', use_container_width=True):
+        return
+    with open(path, 'rb') as file:
+        data = file.read()
+    col1, col2 = st.columns(spec=2, gap='small', border=False)
+    with col1:
+        st.download_button(label='計測値（JSON Lines）',
+                           data=data,
+                           file_name=f'scrape-{job_id}.jsonl',
+                           mime='application/jsonl',
+                           use_container_width=True)
+    with col2:
+        st.download_button(label='計測値（Prometheus）',
+                           data=PipelineMetrics.from_jsonl(path).to_prometheus(),
+                           file_name=f'scrape-{job_id}.prom',
+                           mime='text/plain',
+                           use_container_width=True)
+
+
+async def scrape_data(urls,
+                      max_concurrency=SCRAPING_MAX_CONCURRENCY,
+                      max_concurrency_per_host=SCRAPING_MAX_CONCURRENCY_PER_HOST,
+                      incremental=False,
+                      lastmods=None,
+                      llm_concurrency=LLM_MAX_CONCURRENCY,
+                      llm_batching=False,
+                      on_result=None,
+                      metrics=None,
+                      resources=None,
+                      near_duplicates=True,
+                      site_schemas=False):
+    import aiohttp
+    from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig, PruningContentFilter
+
+    schema = ProductInfo.model_json_schema()
+    # markdown生成の時間はページ読み込みと分けて計測する
+    markdown_generator = TimedMarkdownGenerator(
+        content_filter=PruningContentFilter(threshold=0.48, threshold_type='fixed'))
+    # LLM抽出は別ステージで行うため、クロール時には抽出しない
     run_config = CrawlerRunConfig(
         excluded_tags=['header', 'footer', 'nav'],  # 除外するタグ
-        extraction_strategy=llm_strategy,
         # word_count_threshold=10,  # Minimum words per content block. サイトに短い段落や項目が多数ある場合、ブロックが考慮される前の最小単語数を下げる
         exclude_external_links=True,  # Remove external links
         exclude_social_media_links=True,  # Remove social media links
         exclude_external_images=True,  # Remove external images
         remove_overlay_elements=True,  # Remove popups/modals
         process_iframes=True,  # Process iframe content
+        page_timeout=SCRAPING_PAGE_TIMEOUT,  # 遅いページで全体が止まらないようにする
+        # 関連商品のカルーセルや定型文を除いた商品部分（fit_markdown）も生成する
+        markdown_generator=markdown_generator,
         verbose=True)
 
-    scraped_data = ''
-    for url in urls:
-        async with AsyncWebCrawler(config=browser_config) as crawler:
-            result = await crawler.arun(url=url, config=run_config)
-            if result.success:
-                # st.write("markdown")
-                # st.write(result.markdown)
-                # LLMExtractionStrategyを使用している場合、result.markdownに抽出されたデータが含まれる
-                st.write(f"LLM: \n\n{result.extracted_content}")
-                st.write(f"markdown: \n\n{result.markdown}")
-                scraped_data += f"{result.markdown}\n\n"
-                # st.write("media")
-                # for image in result.media["images"]:
-                #     st.image(image['src'], caption=image['alt'])
-                # st.write("links")
-                # for link in result.links["internal"]:
-                #     st.markdown(f"[{link['text']}]({link['href']})")
-            else:
-                st.invalid(
-                    f"Failed to scrape {url}: status_code:{result.status_code} message:{result.invalid_message}"
-                )
+    # 全体とホスト毎の同時取得数をセマフォで制限する
+    # （crawl4aiのディスパッチャはホスト毎の同時実行数を制限できないため自前で制御）
+    semaphore = asyncio.Semaphore(max_concurrency)
+    host_semaphores = {}
+    learning_hosts = set()  # スキーマを生成中のホスト
+
+    async def extract(url, llm_input, tokens, base_product=None):
+        # 同じ内容のページはキャッシュから返す（バリエーションページは代表ページの抽出結果もキーに含める）
+        instruction = LLM_EXTRACTION_INSTRUCTION if base_product is None else \
+            LLM_VARIANT_INSTRUCTION + json.dumps(base_product, ensure_ascii=False, sort_keys=True)
+        cache_key = make_llm_cache_key(llm_input, schema, instruction, LLM_PROVIDER)
+        extracted_content = await llm_cache.get(cache_key)
+        if extracted_content is not None:
+            return {'extracted_content': extracted_content, 'cache_hit': True}, cache_key
+        if base_product is not None and not llm_input:
+            # 代表ページと異なる部分が無い場合はLLMに送らずに代表ページの抽出結果を使う
+            extracted_content = json.dumps([base_product], ensure_ascii=False)
+            await llm_cache.set(cache_key, extracted_content)
+            return {'extracted_content': extracted_content, 'cache_hit': True}, cache_key
+        # LLM抽出ステージのキューに投入し、結果を待つ間も他のページの取得は進める
+        extraction = await extraction_stage.extract(url, llm_input, tokens, base_product=base_product)
+        await llm_cache.set(cache_key, extraction['extracted_content'])
+        return dict(extraction, cache_hit=False), cache_key
+
+    async def extract_by_site_schema(host, url, html, llm_input, rule_fields):
+        # 学習済みのスキーマで抽出し、検証に通った場合のみ結果を返す（LLMは使わない）
+        entry = await site_schema_store.get(host)
+        if entry['status'] != 'active' or not html:
+            return None, None
+        item = await asyncio.to_thread(site_schema_store.extract_item, host, url, html)
+        product = build_site_schema_product(item, entry['semantic_map'], rule_fields)
+        valid = product is not None and validate_site_schema_product(site_schema_item_fields(item))
+        await site_schema_store.record_page(host, fallback=not valid)
+        if not valid:
+            return None, None
+        extracted_content = json.dumps([product], ensure_ascii=False)
+        # 差分クロールで変更が無い場合に再利用できるよう、LLMの抽出結果と同じキャッシュに保存する
+        cache_key = make_llm_cache_key(llm_input, entry['schema'], 'site_schema', 'css')
+        await llm_cache.set(cache_key, extracted_content)
+        return {
+            'extracted_content': extracted_content,
+            'cache_hit': False,
+            'prompt_tokens': 0,
+            'completion_tokens': 0,
+            'seconds': 0.0,
+        }, cache_key
+
+    async def learn_site_schema(host, url, html, extracted_content, rule_fields):
+        # LLMで抽出したページをサンプルとして集め、揃ったらスキーマを生成してサンプルで検証する
+        try:
+            blocks = json.loads(extracted_content)
+            if not html or not isinstance(blocks, list) or len(blocks) != 1 or not isinstance(blocks[0], dict):
+                return
+            product = blocks[0]
+            entry = await site_schema_store.get(host)
+            if entry['status'] == 'active':
+                # スキーマで抽出できなかったページのカテゴリ表記とLLMの判定結果を覚える
+                item = await asyncio.to_thread(site_schema_store.extract_item, host, url, html)
+                if item.get('category_text'):
+                    await site_schema_store.add_semantics(host, item['category_text'], product)
+                return
+            if entry['status'] != 'learning' or host in learning_hosts:
+                return
+            if await site_schema_store.add_sample(host, url, html, product, rule_fields) < SITE_SCHEMA_SAMPLE_PAGES:
+                return
+            learning_hosts.add(host)
+            try:
+                samples = await site_schema_store.get_samples(host)
+                example = {name: samples[0]['product'].get(name, '') for name in SITE_SCHEMA_FIELDS}
+                await extraction_stage.request_limiter.acquire()
+                await extraction_stage.token_limiter.acquire(count_tokens(compact_html_for_schema(samples[0]['html'])))
+                schema = await asyncio.to_thread(generate_site_schema, samples[0]['html'], example)
+                semantic_map = {}
+                valid = True
+                for sample in samples:
+                    item = await asyncio.to_thread(site_schema_store.extract_item, host, sample['url'], sample['html'],
+                                                   schema)
+                    semantic_map[normalize_field_text(item.get('category_text'))] = {
+                        'category': sample['product'].get('category', ''),
+                        'taste': sample['product'].get('taste', ''),
+                    }
+                    # ルールで抽出した項目で上書きする前の、スキーマだけの抽出結果をLLMの抽出結果と比べる
+                    valid = valid and bool(item.get('category_text')) and \
+                        validate_site_schema_product(site_schema_item_fields(item), sample['product'])
+                if valid:
+                    await site_schema_store.activate(host, schema, semantic_map)
+                else:
+                    print(f"scrape_data() generated schema for {host} failed validation")
+                    await site_schema_store.reject(host)
+            finally:
+                learning_hosts.discard(host)
+        except Exception as e:
+            print(f"scrape_data() failed to learn schema for {host}: {e}")
+
+    async def extract_near_duplicate(url, llm_input, tokens):
+        # バリエーションページは代表ページの抽出結果を元に、異なる部分のみをLLMに送る
+        # 戻り値は（抽出結果, キャッシュキー, 代表ページのURL, LLMに送ったトークン数）
+        if not near_duplicates:
+            extraction, cache_key = await extract(url, llm_input, tokens)
+            return extraction, cache_key, None, tokens
+        simhash = compute_simhash(llm_input)
+        group, future = await near_duplicate_index.find_group(url, simhash)
+        if group is not None:
+            base_blocks = json.loads(group['extracted_content'])
+            diff = diff_llm_input(group['llm_input'], llm_input)
+            diff_tokens = count_tokens(diff)
+            if len(base_blocks) == 1 and isinstance(base_blocks[0], dict) and \
+                    diff_tokens <= tokens * NEAR_DUPLICATE_MAX_DIFF_RATIO:
+                await near_duplicate_index.add_member(url, group['group_url'], group['distance'])
+                extraction, cache_key = await extract(url, diff, diff_tokens, base_product=base_blocks[0])
+                return extraction, cache_key, group['group_url'], diff_tokens
+        # 代表ページとして抽出し、同じグループの他のページに結果を渡す
+        extracted_content = None
+        try:
+            extraction, cache_key = await extract(url, llm_input, tokens)
+            extracted_content = extraction['extracted_content']
+        finally:
+            if future is not None:
+                await near_duplicate_index.add_group(url, simhash, llm_input, extracted_content, future)
+        return extraction, cache_key, None, tokens
+
+    async def is_not_modified(session, state):
+        # 前回のバリデータで条件付きリクエストを送り、304なら変更なしと判断する
+        headers = {}
+        if state['etag']:
+            headers['If-None-Match'] = state['etag']
+        if state['last_modified']:
+            headers['If-Modified-Since'] = state['last_modified']
+        if not headers:
+            return False
+        try:
+            async with session.get(state['url'], headers=headers) as response:
+                return response.status == 304
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"scrape_data() conditional request failed {state['url']}: {e}")
+            return False
+
+    async def crawl(crawler, index, url):
+        record = {
+            'url': url,
+            'success': False,
+            'status_code': None,
+            'error_message': '',
+            'markdown': '',
+            'extracted_content': '',
+            'cache_hit': False,
+            'not_modified': False,
+            'tokens_raw': 0,  # ページ全体のトークン数
+            'tokens_sent': 0,  # 前処理後にLLMに送ったトークン数
+            'tokens_out': 0,  # LLMの出力トークン数
+            'llm_seconds': 0.0,
+            'seconds_saved': 0.0,  # 前処理で削減できたLLM処理時間の推定
+            'seconds': 0.0,  # 取得開始から抽出完了までの時間
+            'near_duplicate_of': None,  # 差分のみを抽出したバリエーションページの場合は代表ページのURL
+            'site_schema': False,  # 学習したCSSスキーマで抽出した（LLMを使わなかった）場合はTrue
+            'metrics': {f'{stage}_seconds': 0.0 for stage in PIPELINE_STAGES},  # 処理段階毎の計測値
+        }
+        page_metrics = record['metrics']
+        page_metrics.update(bytes_fetched=0, markdown_chars=0, prompt_tokens=0, completion_tokens=0, cost_usd=0.0)
+        queued = time.perf_counter()
+        fit_markdown = ''
+        html = ''
+        images = []
+        state = states.get(url)
+        response_headers = {}
+        host = urlparse(url).netloc
+        if host not in host_semaphores:
+            host_semaphores[host] = asyncio.Semaphore(max_concurrency_per_host)
+        # ホストの枠を先に確保し、他ホストの取得を塞がないようにする
+        async with host_semaphores[host]:
+            async with semaphore:
+                started = time.perf_counter()
+                page_metrics['wait_seconds'] = started - queued
+                # 変更が無ければ前回の抽出結果を使い、ブラウザでの取得を省略する
+                not_modified = False
+                if incremental and state is not None and state['extracted_content']:
+                    not_modified = await is_not_modified(session, state)
+                    page_metrics['conditional_request_seconds'] = time.perf_counter() - started
+                if not_modified:
+                    # 取得状態の書き込みに失敗した場合はブラウザでの取得に戻す
+                    try:
+                        await state_store.update(url, normalize_lastmod((lastmods or {}).get(url)), state['etag'],
+                                                 state['last_modified'], state['cache_key'],
+                                                 state['extracted_content'])
+                        record.update(success=True,
+                                      status_code=304,
+                                      extracted_content=state['extracted_content'],
+                                      cache_hit=True,
+                                      not_modified=True)
+                    except Exception as e:
+                        print(f"scrape_data() failed to reuse previous result for {url}: {e}")
+                if not record['not_modified']:
+                    try:
+                        load_started = time.perf_counter()
+                        result = await crawler.arun(url=url, config=run_config)
+                        page_metrics['markdown_seconds'] = markdown_generator.pop_duration(
+                            getattr(result, 'redirected_url', None), url)
+                        page_metrics['page_load_seconds'] = time.perf_counter() - load_started - \
+                            page_metrics['markdown_seconds']
+                        record['status_code'] = result.status_code
+                        response_headers = result.response_headers
+                        page_metrics['bytes_fetched'] = len((result.html or '').encode('utf-8'))
+                        if result.success:
+                            record['markdown'] = str(result.markdown or '')
+                            page_metrics['markdown_chars'] = len(record['markdown'])
+                            fit_markdown = getattr(result.markdown, 'fit_markdown', '') or ''
+                            html = result.html or ''
+                            images = (result.media or {}).get('images', [])
+                        else:
+                            record['error_message'] = result.error_message
+                    except Exception as e:
+                        print(f"scrape_data() failed to scrape {url}: {e}")
+                        record['error_message'] = str(e)
+        # LLM抽出はページ取得の枠を解放してから行い、取得と抽出を重ねて進める
+        if record['markdown']:
+            try:
+                # 商品部分に絞り込み、ルールで取れる項目を抽出してから残りをLLMに送る
+                preprocess_started = time.perf_counter()
+                source = fit_markdown if len(fit_markdown) >= LLM_PRUNED_MIN_CHARS else record['markdown']
+                rule_fields = extract_product_fields_by_rules(source, images)
+                llm_input = prepare_llm_input(source)
+                record['tokens_raw'] = count_tokens(record['markdown'])
+                record['tokens_sent'] = count_tokens(llm_input)
+                llm_started = time.perf_counter()
+                page_metrics['preprocess_seconds'] = llm_started - preprocess_started
+                extraction = None
+                if site_schemas:
+                    # 学習済みのスキーマで抽出できればLLMに送らない
+                    extraction, cache_key = await extract_by_site_schema(host, url, html, llm_input, rule_fields)
+                    page_metrics['schema_extraction_seconds'] = time.perf_counter() - llm_started
+                    llm_started = time.perf_counter()
+                if extraction is not None:
+                    record['site_schema'] = True
+                    record['tokens_sent'] = 0
+                else:
+                    extraction, cache_key, record['near_duplicate_of'], record['tokens_sent'] = \
+                        await extract_near_duplicate(url, llm_input, record['tokens_sent'])
+                    if site_schemas:
+                        await learn_site_schema(host, url, html, extraction['extracted_content'], rule_fields)
+                record['cache_hit'] = extraction['cache_hit']
+                if not record['cache_hit']:
+                    record['llm_seconds'] = extraction['seconds']
+                    record['tokens_out'] = extraction['completion_tokens']
+                    page_metrics.update(llm_seconds=extraction['seconds'],
+                                        prompt_tokens=extraction['prompt_tokens'],
+                                        completion_tokens=extraction['completion_tokens'],
+                                        cost_usd=estimate_llm_cost(extraction['prompt_tokens'],
+                                                                   extraction['completion_tokens']))
+                    # LLMの処理時間はトークン数にほぼ比例するとして、削減できた時間を推定する
+                    tokens_total = record['tokens_sent'] + record['tokens_out']
+                    record['seconds_saved'] = record['llm_seconds'] * max(
+                        record['tokens_raw'] - record['tokens_sent'], 0) / max(tokens_total, 1)
+                page_metrics['llm_wait_seconds'] = max(
+                    time.perf_counter() - llm_started - page_metrics['llm_seconds'], 0.0)
+                record['extracted_content'] = merge_rule_fields(extraction['extracted_content'],
+                                                                rule_fields)
+                record['success'] = True
+                # 次回の差分判定のためにlastmodとHTTPバリデータを記録
+                await state_store.update(url, normalize_lastmod((lastmods or {}).get(url)),
+                                         get_header(response_headers, 'ETag'),
+                                         get_header(response_headers, 'Last-Modified'), cache_key,
+                                         record['extracted_content'])
+            except Exception as e:
+                print(f"scrape_data() failed to extract {url}: {e}")
+                record['error_message'] = str(e)
+        record['seconds'] = page_metrics['total_seconds'] = time.perf_counter() - started
+        if metrics is not None:
+            metrics.add(url, record['success'], page_metrics)
+        if on_result is not None:
+            # 結果は呼び出し元で逐次保存し、全ページ分をメモリに保持しない
+            on_result(index, record)
+            return None
+        return record
+
+    # ブラウザは1回だけ起動し、全URLで使い回す
+    # （共有リソースが渡された場合は起動済みのブラウザとプロセス全体のLLMレート制限を使う）
+    if resources is not None:
+        crawler_context = resources.use_crawler()
+        request_limiter, token_limiter = resources.request_limiter, resources.token_limiter
+    else:
+        browser_config = BrowserConfig(
+            user_agent_mode="random",  # ボット検出に対抗
+            verbose=True,
+            # headless=False
+        )
+        crawler_context = AsyncWebCrawler(config=browser_config)
+        request_limiter, token_limiter = None, None
+    timeout = aiohttp.ClientTimeout(total=CONDITIONAL_REQUEST_TIMEOUT)
+    async with LLMExtractionCache() as llm_cache, CrawlStateStore() as state_store, \
+            NearDuplicateIndex() as near_duplicate_index, SiteSchemaStore() as site_schema_store, \
+            aiohttp.ClientSession(timeout=timeout) as session, \
+            LLMExtractionStage(concurrency=llm_concurrency,
+                               batching=llm_batching,
+                               request_limiter=request_limiter,
+                               token_limiter=token_limiter) as extraction_stage:
+        states = await state_store.get_many(urls)
+        launch_started = time.perf_counter()
+        async with crawler_context as crawler:
+            if metrics is not None:
+                metrics.set_browser_launch(time.perf_counter() - launch_started)
+            # gatherは入力順に結果を返す（on_resultを指定した場合はNone）
+            results = await asyncio.gather(
+                *[crawl(crawler, i, url) for i, url in enumerate(urls)])
+
+    return results
+
+
+# PDFカタログ抽出の設定
+PDF_MAX_WORKERS = os.cpu_count() or 1  # ページを処理するプロセス数
+PDF_PAGES_PER_TASK = 8  # 1プロセスにまとめて渡すページ数
+PDF_COPY_CHUNK_SIZE = 1024 * 1024  # アップロードされたPDFを書き出す単位（バイト）
+PDF_MIN_TEXT_CHARS = 50  # これより短いページはLLMにも送らない
+# 表の見出しと商品情報の項目の対応（W/D/H/SHは完全一致、それ以外は部分一致）
+PDF_TABLE_DIMENSION_HEADERS = {'W': 'W', '幅': 'W', 'D': 'D', '奥行': 'D', 'H': 'H', '高さ': 'H', 'SH': 'SH', '座面高': 'SH'}
+PDF_TABLE_HEADER_KEYWORDS = {
+    'item_name': ('品名', '商品名', '名称', '品番', '型番', 'item', 'model'),
+    'size': ('サイズ', '寸法', 'size'),
+    'weight': ('重量', '質量', 'weight'),
+    'material': ('素材', '材質', '仕上', '張地', 'material'),
+    'price': ('価格', '定価', '税込', '税抜', 'price'),
+}
+
+
+def map_pdf_table_header(row):
+    # 表の見出し行から、列番号と項目名の対応を作る
+    columns = {}
+    for i, cell in enumerate(row):
+        cell = unicodedata.normalize('NFKC', cell or '').strip()
+        if cell.upper() in PDF_TABLE_DIMENSION_HEADERS or cell in PDF_TABLE_DIMENSION_HEADERS:
+            columns[i] = PDF_TABLE_DIMENSION_HEADERS.get(cell.upper(), PDF_TABLE_DIMENSION_HEADERS.get(cell))
+            continue
+        for key, keywords in PDF_TABLE_HEADER_KEYWORDS.items():
+            if key not in columns.values() and any(keyword in cell.lower() for keyword in keywords):
+                columns[i] = key
+                break
+    return columns
+
+
+def parse_pdf_table(table):
+    # 価格表・仕様表の各行を商品情報に変換する
+    products = []
+    columns = {}
+    headers = []
+    for row in table:
+        if not columns:
+            columns = map_pdf_table_header(row)
+            if 'item_name' not in columns.values() or len(columns) < 2:
+                columns = {}
+            headers = [unicodedata.normalize('NFKC', cell or '') for cell in row]
+            continue
+        fields = {}
+        dims = []
+        for i, key in columns.items():
+            value = unicodedata.normalize('NFKC', row[i] or '').replace('\n', ' ').strip() if i < len(row) else ''
+            if not value:
                 continue
+            if key in ('W', 'D', 'H', 'SH'):
+                dims.append(f'{key}{value}')
+            elif key == 'price':
+                # 金額だけの列は見出しから税込・税抜を判断する
+                price_yen, tax_included = parse_price(value if re.search(r'[¥￥円]', value) else f'{value}円')
+                if price_yen is not None:
+                    if tax_included is None:
+                        tax_included = 1 if '税込' in headers[i] else 0 if '税抜' in headers[i] else None
+                    fields['price'] = format_price(price_yen, tax_included)
+            else:
+                fields[key] = value
+        if dims and 'size' not in fields:
+            fields['size'] = ' '.join(dims)
+        if fields.get('size'):
+            # 単位を揃える
+            size_fields = extract_product_fields_by_rules(fields['size'])
+            fields['size'] = size_fields.get('size', fields['size'])
+        if fields.get('item_name') and (fields.get('size') or fields.get('price')):
+            products.append(fields)
+    return products
 
-    return scraped_data
 
+def parse_pdf_text(text):
+    # 表になっていないページは、価格の行を区切りとして商品ブロックに分ける
+    products = []
+    lines = []
+    for line in unicodedata.normalize('NFKC', text or '').splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        lines.append(line)
+        if not PRICE_PATTERN.search(line):
+            continue
+        fields = extract_product_fields_by_rules('\n'.join(lines))
+        if 'price' not in fields:
+            # 項目名の無い価格だけの行も、ブロックの区切りにした行なので価格として使う
+            fields['price'] = format_price(*parse_price(line))
+        # 商品名はサイズや価格ではない最初の行
+        item_name = next((block_line for block_line in lines
+                          if not PRICE_PATTERN.search(block_line) and parse_size(block_line) == (None, None, None, None)),
+                         None)
+        if item_name and 'price' in fields:
+            fields['item_name'] = item_name
+            products.append(fields)
+        lines = []
+    return products
 
-async def scrape_item_list(url):
-    browser_config = BrowserConfig(
-        user_agent_mode="random",  # ボット検出に対抗
-        verbose=True,
-        # headless=False
-    )
-    run_config = CrawlerRunConfig(
-        excluded_tags=['header', 'footer', 'nav'],  # 除外するタグ
-        # word_count_threshold=10,  # Minimum words per content block. サイトに短い段落や項目が多数ある場合、ブロックが考慮される前の最小単語数を下げる
-        exclude_external_links=True,  # Remove external links
-        exclude_social_media_links=True,  # Remove social media links
-        exclude_external_images=True,  # Remove external images
-        remove_overlay_elements=True,  # Remove popups/modals
-        process_iframes=True  # Process iframe content
-    )
-
-    async with AsyncWebCrawler(config=browser_config) as crawler:
-        result = await crawler.arun(url=url, config=run_config)
-        if result.success:
-            st.write("markdown")
-            st.write(result.markdown)
-            # st.write("media")
-            # for image in result.media["images"]:
-            #     st.image(image['src'], caption=image['alt'])
-            # st.write("links")
-            # for link in result.links["internal"]:
-            #     st.markdown(f"[{link['text']}]({link['href']})")
-        else:
-            st.invalid(
-                f"Failed to scrape {url}: status_code:{result.status_code} message:{result.invalid_message}"
-            )
 
+def extract_pdf_pages(path, start, end):
+    # ページ範囲毎にプロセスで実行する（テキストと表を抽出し、ルールで商品ブロックを取り出す）
+    # 処理したページはキャッシュを破棄し、PDFの大きさによらずメモリ使用量を一定にする
+    import pdfplumber
 
-async def deep_crawl_test(url):
-    config = CrawlerRunConfig(deep_crawl_strategy=BFSDeepCrawlStrategy(max_depth=0,
-                                                                       include_external=False),
-                              scraping_strategy=LXMLWebScrapingStrategy(),
-                              verbose=True)
+    pages = []
+    with pdfplumber.open(path, pages=list(range(start + 1, end + 1))) as pdf:
+        for page in pdf.pages:
+            try:
+                text = page.extract_text() or ''
+                products = [product for table in page.extract_tables() for product in parse_pdf_table(table)]
+                if not products:
+                    products = parse_pdf_text(text)
+            except Exception as e:
+                print(f"extract_pdf_pages() failed to extract page {page.page_number}: {e}")
+                text, products = '', []
+            pages.append({
+                'page': page.page_number,
+                'products': products,
+                # ルールで抽出できなかったページのみLLMに送るテキストを返す
+                'text': text if not products and len(text) >= PDF_MIN_TEXT_CHARS else '',
+            })
+            page.close()
+    return pages
+
+
+def get_pdf_page_worker():
+    # Streamlitが実行するスクリプトの関数は子プロセスに渡せないため、モジュールとして読み込んだ関数を使う
+    if __name__ == '__main__':
+        return importlib.import_module('interi_ai_app').extract_pdf_pages
+    return extract_pdf_pages
+
+
+def build_pdf_record(source_name, page, index, product, brand_name):
+    # Webのスクレイピング結果と同じ形式で商品カタログに保存する
+    product = dict({key: '' for key in ProductInfo.model_fields}, image_urls=[]) | \
+        {key: value for key, value in product.items() if value}
+    if not product['brand_name']:
+        product['brand_name'] = brand_name
+    return {
+        'url': f'pdf://{source_name}#page={page}&item={index}',
+        'success': True,
+        'extracted_content': json.dumps([product], ensure_ascii=False),
+    }
+
+
+async def extract_pdf(path,
+                      source_name,
+                      brand_name='',
+                      max_workers=PDF_MAX_WORKERS,
+                      use_llm=True,
+                      on_progress=None):
+    # PDFのページを複数プロセスで並行して処理し、ルールで抽出できなかったページのみLLMで抽出する
+    # 結果はページ範囲毎に商品カタログへ保存し、保存した商品の概要を返す
+    import pdfplumber
+
+    with pdfplumber.open(path) as pdf:
+        page_count = len(pdf.pages)
+    ranges = [(start, min(start + PDF_PAGES_PER_TASK, page_count))
+              for start in range(0, page_count, PDF_PAGES_PER_TASK)]
+    schema = ProductInfo.model_json_schema()
+    worker = get_pdf_page_worker()
+    loop = asyncio.get_running_loop()
+    # 処理中のページ範囲の数を制限し、結果が溜まらないようにする
+    semaphore = asyncio.Semaphore(max_workers * 2)
+    summary = []
+    done_pages = 0
+
+    async def extract_with_llm(page):
+        llm_input = prepare_llm_input(page['text'])
+        cache_key = make_llm_cache_key(llm_input, schema, LLM_EXTRACTION_INSTRUCTION, LLM_PROVIDER)
+        extracted_content = await llm_cache.get(cache_key)
+        if extracted_content is None:
+            extraction = await extraction_stage.extract(f"{source_name}#page={page['page']}", llm_input)
+            extracted_content = extraction['extracted_content']
+            await llm_cache.set(cache_key, extracted_content)
+        products = json.loads(extracted_content)
+        return [product for product in (products if isinstance(products, list) else [products])
+                if isinstance(product, dict) and product.get('item_name')]
+
+    async def process(executor, start, end):
+        nonlocal done_pages
+        async with semaphore:
+            pages = await loop.run_in_executor(executor, worker, path, start, end)
+        records = []
+        for page in pages:
+            methods = 'ルール'
+            products = page['products']
+            if not products and page['text'] and use_llm:
+                methods = 'LLM'
+                try:
+                    products = await extract_with_llm(page)
+                except Exception as e:
+                    print(f"extract_pdf() failed to extract page {page['page']} with LLM: {e}")
+                    products = []
+            for index, product in enumerate(products):
+                record = build_pdf_record(source_name, page['page'], index, product, brand_name)
+                records.append(record)
+                summary.append({
+                    'ページ': page['page'],
+                    '商品名': product.get('item_name'),
+                    'サイズ': product.get('size'),
+                    '価格': product.get('price'),
+                    '抽出方法': methods,
+                    'URL': record['url'],
+                })
+        if records:
+            await asyncio.to_thread(save_products, records)
+        done_pages += len(pages)
+        if on_progress is not None:
+            on_progress(done_pages, page_count)
+
+    # fork後のスレッドによるデッドロックを避けるためspawnで起動する
+    context = multiprocessing.get_context('spawn')
+    async with LLMExtractionCache() as llm_cache, LLMExtractionStage(batching=True) as extraction_stage:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+            await asyncio.gather(*[process(executor, start, end) for start, end in ranges])
+
+    return sorted(summary, key=lambda row: row['ページ'])
+
+
+def pdf_extraction():
+    with st.expander(label='PDFファイル', expanded=True):
+        uploaded_file = st.file_uploader(label='価格表・仕様書のPDFファイルを選択してください', type='pdf')
+        col1, col2 = st.columns(spec=2, gap='large', border=False)
+        with col1:
+            brand_name = st.text_input(label='ブランド名',
+                                       help='PDFにブランド名が記載されていない商品に設定します。')
+        with col2:
+            max_workers = st.number_input(label='同時処理数（プロセス）',
+                                          min_value=1,
+                                          max_value=max(PDF_MAX_WORKERS, 1) * 2,
+                                          value=PDF_MAX_WORKERS,
+                                          help='ページを並行して処理するプロセス数です。')
+        use_llm = st.checkbox(label='ルールで抽出できないページはLLMで抽出する', value=True)
+        extract_flag = st.button(label='PDFデータ抽出',
+                                 icon='📄',
+                                 use_container_width=True,
+                                 disabled=uploaded_file is None)
 
-    async with AsyncWebCrawler() as crawler:
-        results = await crawler.arun(url, config=config)
+    if extract_flag:
+        with st.expander(label='抽出結果', expanded=True):
+            # アップロードされたPDFは分割して一時ファイルに書き出し、各プロセスから読み込む
+            with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as file:
+                shutil.copyfileobj(uploaded_file, file, PDF_COPY_CHUNK_SIZE)
+            progress_bar = st.progress(0.0, text='PDFを読み込んでいます...')
 
-        st.write(f"Crawled {len(results)} pages in total")
+            def on_progress(done_pages, page_count):
+                progress_bar.progress(done_pages / max(page_count, 1), text=f'{done_pages} / {page_count} ページ')
 
-        # Access individual results
-        for result in results[:3]:  # Show first 3 results
-            st.write(f"URL: {result.url}")
-            st.write(f"Depth: {result.metadata.get('depth', 0)}")
-            st.write(result.markdown)  # Show first 500 characters of markdown
+            try:
+                summary = asyncio.run(
+                    extract_pdf(file.name,
+                                uploaded_file.name,
+                                brand_name=brand_name,
+                                max_workers=max_workers,
+                                use_llm=use_llm,
+                                on_progress=on_progress))
+            except Exception as e:
+                print(f"pdf_extraction() failed to extract {uploaded_file.name}: {e}")
+                st.error(f"PDFの読み込みに失敗しました: {e}")
+                return
+            finally:
+                os.remove(file.name)
+            # 自由入力検索のインデックスに保存した商品を反映
+            if summary:
+                get_retrieval_index().update(query_catalog(urls=[row['URL'] for row in summary]))
+            st.success(f'{len(summary)} 件の商品を商品カタログに保存しました。')
+            st.dataframe(pd.DataFrame(summary), use_container_width=True, hide_index=True)
 
 
 if __name__ == "__main__":
@@ -534,31 +4468,14 @@ if __name__ == "__main__":
                      icon='🔍',
                      disabled=len(st.session_state['furniture_condition_list']) == 0,
                      use_container_width=True):
-            with st.chat_message(name="assistant"):
-                st.markdown('''
-    こちらの商品はいかがでしょうか？  
-    商品名：[PENTE 1P SOFA](https://www.asplund-contract.com/product/12426/)  
-    ブランド：Work Plus  
-    Size:W760 D760 H670 SH425  
-    Material:Fabric, Steel  
-    Price:￥120,000  
-    ![PENTE 1P SOFA](https://www.asplund-contract.com/wp-content/uploads/2024/06/wp_pente1psofa-3-600x600.jpg)
-    
-    
-    商品名：[MELTONE 1P SOFA](https://www.asplund-contract.com/product/12396/)  
-    ブランド：Work Plus  
-    Size:W870 D720 H750 SH410
-    Material:Fabric, Steel  
-    Price:￥110,000  
-    ![PENTE 1P SOFA](https://www.asplund-contract.com/wp-content/uploads/2024/06/wp_meltone1psofa-1-600x600.jpg)
-    ''')
+            search_furniture()
 
         # チャット入力
         chat_input()
     elif menu == 'スクレイピング':
         scrapintg()
     elif menu == 'PDFデータ抽出':
-        st.write("未実装")
+        pdf_extraction()
     else:
         st.write("")
 
@@ -0,0 +1,451 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import numpy as np
+import psutil
+from aiohttp import web
+
+# ベンチマーク結果の保存先
+BENCH_OUTPUT_DIR = os.path.join('data', 'bench')
+# 比較で表示する指標（値が小さい方が良い指標はTrue）
+BENCH_METRICS = {
+    'startup.import_seconds': True,
+    'startup.first_page_seconds': True,
+    'sitemap.urls_per_second': False,
+    'sitemap.seconds': True,
+    'sitemap.peak_rss_mb': True,
+    'scrape.browser_startup_seconds': True,
+    'scrape.pages_per_second': False,
+    'scrape.latency_p50': True,
+    'scrape.latency_p95': True,
+    'scrape.latency_p99': True,
+    'scrape.tokens_sent_per_page': True,
+    'scrape.tokens_out_per_page': True,
+    'scrape.peak_rss_mb': True,
+}
+# 起動時間の内訳で表示するモジュール数
+STARTUP_REPORT_MODULES = 15
+# 家具選定の画面（初期表示）を1回実行するスクリプト
+FIRST_PAGE_SCRIPT = '''
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(sys.argv[1], default_timeout=120)
+started = time.perf_counter()
+at.run()
+print(json.dumps({'seconds': time.perf_counter() - started, 'exception': [e.value for e in at.exception]}))
+'''
+
+# 実際の商品ページを模したフィクスチャ（ヘッダー・パンくず・仕様表・関連商品・フッターを含む）
+PRODUCT_PAGE_TEMPLATE = '''<!DOCTYPE html>
+<html lang="ja">
+<head><meta charset="utf-8"><title>{item_name} | BENCH FURNITURE</title></head>
+<body>
+<header><nav>{nav}</nav></header>
+<main>
+<ol class="breadcrumb"><li><a href="/">HOME</a></li><li><a href="/product/br/bench/">BENCH</a></li><li>{item_name}</li></ol>
+<article class="product">
+<h1>{item_name}</h1>
+<p class="brand">BENCH FURNITURE</p>
+<img src="/images/{index}-1.jpg" alt="{item_name}"><img src="/images/{index}-2.jpg" alt="{item_name}">
+<p>{description}</p>
+<table class="spec">
+<tr><th>サイズ</th><td>W{width} D{depth} H{height} SH{seat_height}</td></tr>
+<tr><th>重量</th><td>{weight}kg</td></tr>
+<tr><th>素材</th><td>{material}</td></tr>
+<tr><th>価格</th><td>¥{price:,}（税込）</td></tr>
+<tr><th>納期</th><td>{delivery}</td></tr>
+</table>
+</article>
+<section class="related"><h2>関連商品</h2>{related}</section>
+</main>
+<footer>{footer}</footer>
+</body>
+</html>
+'''
+MATERIALS = ['Fabric, Steel', 'Leather, Oak', 'Walnut', 'Aluminium, Polypropylene']
+DELIVERIES = ['在庫品', '3週間', '1ヶ月', '1.5〜2ヶ月']
+PRODUCT_URL_PATTERN = re.compile(r'/product/(\d+)/')
+
+
+def render_product_page(index, page_count):
+    rng = random.Random(index)
+    item_name = f'BENCH-{index:05d} Lounge Chair'
+    related = ''.join(f'<div class="card"><a href="/product/{i}/"><img src="/images/{i}-1.jpg">'
+                      f'<p>BENCH-{i:05d}</p><p>¥{rng.randint(30, 300) * 1000:,}</p></a></div>'
+                      for i in rng.sample(range(page_count), min(8, page_count)))
+    return PRODUCT_PAGE_TEMPLATE.format(
+        index=index,
+        item_name=item_name,
+        nav=''.join(f'<a href="/category/{i}/">カテゴリ{i}</a>' for i in range(30)),
+        description='このチェアは、快適な座り心地とスタイリッシュなデザインを兼ね備えています。' * rng.randint(3, 12),
+        width=rng.randint(450, 900),
+        depth=rng.randint(450, 900),
+        height=rng.randint(700, 1100),
+        seat_height=rng.randint(380, 450),
+        weight=rng.randint(5, 40),
+        material=rng.choice(MATERIALS),
+        price=rng.randint(30, 300) * 1000,
+        delivery=rng.choice(DELIVERIES),
+        related=related,
+        footer='<p>会社概要 プライバシーポリシー お問い合わせ ショールーム</p>' * 10)
+
+
+def render_sitemap(base_url, page_count):
+    urls = ''.join(f'<url><loc>{base_url}/product/{i}/</loc><lastmod>2025-01-{i % 28 + 1:02d}</lastmod>'
+                   f'<changefreq>weekly</changefreq><priority>0.8</priority></url>' for i in range(page_count))
+    return f'<?xml version="1.0" encoding="UTF-8"?><urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{urls}</urlset>'
+
+
+def get_item_code(url):
+    # 関連商品の商品コードもページに含まれるため、ページ自身のURLから商品コードを求める
+    match = PRODUCT_URL_PATTERN.search(url or '')
+    return f'BENCH-{int(match.group(1)):05d}' if match else ''
+
+
+def make_fake_completion(prompt, model):
+    # 商品コードから抽出結果を組み立てる（バッチモードでは "## URL:" 毎に1件返す）
+    batch_urls = re.findall(r'^## URL: (\S+)$', prompt, flags=re.MULTILINE)
+    if batch_urls:
+        products = [{'url': url, 'item_name': get_item_code(url), 'brand_name': 'BENCH FURNITURE'} for url in batch_urls]
+        content = json.dumps({'products': products}, ensure_ascii=False)
+    else:
+        url = re.search(r'^# URL\n(\S+)$', prompt, flags=re.MULTILINE)
+        content = json.dumps({
+            'brand_name': 'BENCH FURNITURE',
+            'item_name': get_item_code(url.group(1) if url else ''),
+            'category': 'ラウンジチェア',
+            'taste': '',
+            'delivery': '',
+            'size': '',
+            'weight': '',
+            'material': '',
+            'price': '',
+            'description': 'ベンチマーク用の商品です。',
+            'image_urls': [],
+        }, ensure_ascii=False)
+    return {
+        'id': 'chatcmpl-bench',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+        # トークン数は文字数からの概算
+        'usage': {
+            'prompt_tokens': len(prompt) // 2,
+            'completion_tokens': len(content) // 2,
+            'total_tokens': (len(prompt) + len(content)) // 2,
+        },
+    }
+
+
+def run_fixture_server(port, page_count, sitemap_url_count, llm_latency, llm_jitter):
+    # フィクスチャサイトとOpenAI互換のLLMスタブを別プロセスで動かし、計測対象と競合させない
+    base_url = f'http://127.0.0.1:{port}'
+    sitemap = render_sitemap(base_url, page_count).encode('utf-8')
+    large_sitemap = render_sitemap(base_url, sitemap_url_count).encode('utf-8')
+
+    async def product(request):
+        index = int(request.match_info['index'])
+        return web.Response(text=render_product_page(index, page_count), content_type='text/html')
+
+    async def image(request):
+        return web.Response(body=b'\xff\xd8\xff\xd9', content_type='image/jpeg')
+
+    async def chat_completions(request):
+        body = await request.json()
+        prompt = '\n'.join(message['content'] for message in body['messages'])
+        await asyncio.sleep(max(0.0, random.gauss(llm_latency, llm_jitter)))
+        return web.json_response(make_fake_completion(prompt, body.get('model', 'bench')))
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_get('/product-sitemap.xml', lambda request: web.Response(body=sitemap, content_type='application/xml'))
+    app.router.add_get('/large-sitemap.xml',
+                       lambda request: web.Response(body=large_sitemap, content_type='application/xml'))
+    app.router.add_get('/product/{index}/', product)
+    app.router.add_get('/images/{name}', image)
+    app.router.add_post('/v1/chat/completions', chat_completions)
+    web.run_app(app, host='127.0.0.1', port=port, print=None, access_log=None)
+
+
+class PeakRSSSampler:
+    # 自プロセスと子プロセス（ブラウザ）の合計RSSの最大値を記録する（フィクスチャサーバーは除く）
+
+    def __init__(self, exclude_pids=(), interval=0.05):
+        self.exclude_pids = set(exclude_pids)
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        process = psutil.Process()
+        while not self._stop.is_set():
+            rss = 0
+            for proc in [process] + process.children(recursive=True):
+                if proc.pid in self.exclude_pids:
+                    continue
+                try:
+                    rss += proc.memory_info().rss
+                except psutil.Error:
+                    pass
+            self.peak = max(self.peak, rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(base_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f'{base_url}/product/0/', timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'fixture server did not start: {base_url}')
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True,
+                              text=True,
+                              check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if len(values) > 0 else None
+
+
+def parse_import_times(output, module='interi_ai_app'):
+    # python -X importtime の出力から、moduleが直接インポートしたパッケージ毎の累積時間（秒）を集計する
+    # （子モジュールは親より先に、1段深くインデントして出力される）
+    lines = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        lines.append((depth, int(cumulative), name.strip()))
+    index = next((i for i, (depth, _, name) in enumerate(lines) if depth == 0 and name == module), None)
+    if index is None:
+        return None, {}
+    packages = {}
+    for depth, cumulative, name in reversed(lines[:index]):
+        if depth == 0:
+            break
+        if depth == 1:
+            package = name.split('.')[0]
+            packages[package] = packages.get(package, 0) + cumulative / 1e6
+    return lines[index][1] / 1e6, dict(sorted(packages.items(), key=lambda item: -item[1]))
+
+
+def bench_startup():
+    # アプリのインポート時間の内訳と、家具選定の画面を初めて表示するまでの時間を新しいプロセスで計測する
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'interi_ai_app.py')
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import streamlit; import interi_ai_app'],
+                               capture_output=True,
+                               text=True,
+                               check=True,
+                               cwd=os.path.dirname(app_path))
+    import_seconds, modules = parse_import_times(completed.stderr)
+    completed = subprocess.run([sys.executable, '-c', FIRST_PAGE_SCRIPT, app_path],
+                               capture_output=True,
+                               text=True,
+                               check=True,
+                               cwd=os.path.dirname(app_path))
+    first_page = json.loads(completed.stdout.strip().splitlines()[-1])
+    if first_page['exception']:
+        print(f"bench_startup() first page raised: {first_page['exception']}", file=sys.stderr)
+    print(f"{'module':<34}{'seconds':>10}")
+    for module, seconds in list(modules.items())[:STARTUP_REPORT_MODULES]:
+        print(f'{module:<34}{seconds:>10.3f}')
+    return {
+        'import_seconds': import_seconds,
+        'first_page_seconds': first_page['seconds'],
+        'modules': modules,
+    }
+
+
+def bench_sitemap(app, base_url, server_pid):
+    with PeakRSSSampler(exclude_pids=[server_pid]) as sampler:
+        started = time.perf_counter()
+        df_urls, errors = asyncio.run(app.load_sitemap(f'{base_url}/large-sitemap.xml'))
+        seconds = time.perf_counter() - started
+    return {
+        'urls': len(df_urls),
+        'errors': len(errors),
+        'seconds': seconds,
+        'urls_per_second': len(df_urls) / seconds,
+        'peak_rss_mb': sampler.peak / 1024 / 1024,
+    }
+
+
+def bench_scrape(app, base_url, server_pid, args):
+    # ブラウザの起動時間は単独で計測する
+    async def browser_startup():
+        from crawl4ai import AsyncWebCrawler, BrowserConfig
+
+        started = time.perf_counter()
+        async with AsyncWebCrawler(config=BrowserConfig(verbose=False)):
+            return time.perf_counter() - started
+
+    browser_startup_seconds = asyncio.run(browser_startup())
+    urls = [f'{base_url}/product/{i}/' for i in range(args.pages)]
+    with PeakRSSSampler(exclude_pids=[server_pid]) as sampler:
+        started = time.perf_counter()
+        records = asyncio.run(
+            app.scrape_data(urls,
+                            max_concurrency=args.max_concurrency,
+                            max_concurrency_per_host=args.max_concurrency,
+                            llm_concurrency=args.llm_concurrency,
+                            llm_batching=args.llm_batching,
+                            near_duplicates=not args.no_near_duplicates))
+        seconds = time.perf_counter() - started
+    succeeded = [record for record in records if record['success']]
+    latencies = [record['seconds'] for record in succeeded]
+    return {
+        'pages': len(urls),
+        'succeeded': len(succeeded),
+        'seconds': seconds,
+        'browser_startup_seconds': browser_startup_seconds,
+        'pages_per_second': len(succeeded) / seconds,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_p99': percentile(latencies, 99),
+        'tokens_raw_per_page': float(np.mean([record['tokens_raw'] for record in succeeded])) if succeeded else None,
+        'tokens_sent_per_page': float(np.mean([record['tokens_sent'] for record in succeeded])) if succeeded else None,
+        'tokens_out_per_page': float(np.mean([record['tokens_out'] for record in succeeded])) if succeeded else None,
+        'peak_rss_mb': sampler.peak / 1024 / 1024,
+    }
+
+
+def run(args):
+    port = get_free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    server = multiprocessing.get_context('spawn').Process(target=run_fixture_server,
+                                                           args=(port, args.pages, args.sitemap_urls,
+                                                                 args.llm_latency, args.llm_jitter),
+                                                           daemon=True)
+    server.start()
+    # キャッシュや前回の状態の影響を受けないよう、空のデータディレクトリで計測する
+    data_dir = tempfile.mkdtemp(prefix='interi_ai_bench_')
+    os.environ['INTERI_AI_DATA_DIR'] = data_dir
+    os.environ['INTERI_AI_LLM_PROVIDER'] = 'openai/bench'
+    os.environ['INTERI_AI_LLM_API_BASE'] = f'{base_url}/v1'
+    os.environ.setdefault('GEMINI_API_TOKEN', 'bench')
+    import interi_ai_app as app
+
+    result = {
+        'commit': get_git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'params': {key: value for key, value in vars(args).items() if key not in ('func', 'output')},
+        'metrics': {},
+    }
+    try:
+        wait_for_server(base_url)
+        if 'startup' in args.stages:
+            result['metrics']['startup'] = bench_startup()
+            print(f"startup: import {result['metrics']['startup']['import_seconds']:.3f}s, "
+                  f"first page {result['metrics']['startup']['first_page_seconds']:.3f}s")
+        if 'sitemap' in args.stages:
+            result['metrics']['sitemap'] = bench_sitemap(app, base_url, server.pid)
+            print(f"sitemap: {json.dumps(result['metrics']['sitemap'])}")
+        if 'scrape' in args.stages:
+            try:
+                result['metrics']['scrape'] = bench_scrape(app, base_url, server.pid, args)
+                print(f"scrape: {json.dumps(result['metrics']['scrape'])}")
+            except Exception as e:
+                print(f"run() failed to run scrape benchmark: {e}", file=sys.stderr)
+                result['metrics']['scrape'] = {'error': str(e)}
+    finally:
+        server.terminate()
+
+    output = args.output or os.path.join(BENCH_OUTPUT_DIR, f"bench-{result['commit']}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(result, file, ensure_ascii=False, indent=2)
+    print(f'saved {output}')
+    return 0
+
+
+def compare(args):
+    # 2つのコミットの計測結果を並べて表示する
+    with open(args.base, encoding='utf-8') as file:
+        base = json.load(file)
+    with open(args.target, encoding='utf-8') as file:
+        target = json.load(file)
+    print(f"{'metric':<34}{base['commit']:>14}{target['commit']:>14}{'change':>10}")
+    for metric, lower_is_better in BENCH_METRICS.items():
+        stage, name = metric.split('.')
+        base_value = base['metrics'].get(stage, {}).get(name)
+        target_value = target['metrics'].get(stage, {}).get(name)
+        if base_value is None or target_value is None:
+            continue
+        change = (target_value - base_value) / base_value if base_value else 0.0
+        improved = change < 0 if lower_is_better else change > 0
+        mark = '+' if improved and abs(change) >= args.threshold else '-' if abs(change) >= args.threshold else ''
+        print(f'{metric:<34}{base_value:>14.3f}{target_value:>14.3f}{change:>9.1%}{mark}')
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='interiAI スクレイピング・抽出のベンチマーク（外部サイト・LLMを使わない）')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='フィクスチャサイトとLLMスタブで計測する')
+    run_parser.add_argument('--pages', type=int, default=100, help='商品ページ数')
+    run_parser.add_argument('--sitemap-urls', type=int, default=50000, help='サイトマップ解析で使うURL数')
+    run_parser.add_argument('--stages', default='startup,sitemap,scrape', help='計測する処理（カンマ区切り）')
+    run_parser.add_argument('--llm-latency', type=float, default=1.0, help='LLMスタブの平均応答時間（秒）')
+    run_parser.add_argument('--llm-jitter', type=float, default=0.3, help='LLMスタブの応答時間のばらつき（秒）')
+    run_parser.add_argument('--max-concurrency', type=int, default=8)
+    run_parser.add_argument('--llm-concurrency', type=int, default=8)
+    run_parser.add_argument('--llm-batching', action='store_true')
+    run_parser.add_argument('--no-near-duplicates',
+                            action='store_true',
+                            help='バリエーションページも差分ではなくページ全体をLLMに送る')
+    run_parser.add_argument('--output', help='結果のJSONファイル（省略時は data/bench/bench-<commit>.json）')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser('compare', help='2つの計測結果を比較する')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('target')
+    compare_parser.add_argument('--threshold', type=float, default=0.05, help='改善・悪化とみなす変化率')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        args.stages = [stage.strip() for stage in args.stages.split(',')]
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,199 @@
+import argparse
+import asyncio
+import concurrent.futures
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import pandas as pd
+import xxhash
+
+import interi_ai_app as app
+
+# 出力するシャードのファイル名
+SHARD_FILE_PATTERN = 'shard-{shard:05d}-of-{shard_count:05d}.jsonl'
+SHARD_GLOB_PATTERN = 'shard-?????-of-?????.jsonl'
+
+
+def shard_of(url, shard_count):
+    # URLのハッシュでシャードを決める（実行するホストやプロセス数によらず同じ結果になる）
+    return xxhash.xxh64_intdigest(url.encode('utf-8')) % shard_count
+
+
+def load_urls(args):
+    # サイトマップまたはURLリストのファイルから対象URLを読み込む
+    if args.sitemap:
+        df_urls, errors = asyncio.run(
+            app.load_sitemap(args.sitemap, app.split_patterns(args.include), app.split_patterns(args.exclude)))
+        for error in errors:
+            print(f"load_urls() failed to load sitemap: {error}", file=sys.stderr)
+        lastmods = dict(zip(df_urls['URL'], df_urls['lastmod']))
+        return df_urls['URL'].tolist(), lastmods
+    with open(args.urls, encoding='utf-8') as file:
+        urls = [line.strip() for line in file if line.strip() and not line.startswith('#')]
+    return list(dict.fromkeys(urls)), None
+
+
+def run_shard(shard, shard_count, urls, lastmods, output_dir, options):
+    # 1つのシャードを1プロセス（ブラウザ1つ）で処理し、完了したページから順にJSONLに書き出す
+    path = os.path.join(output_dir, SHARD_FILE_PATTERN.format(shard=shard, shard_count=shard_count))
+    temp_path = f'{path}.tmp'
+    # 処理段階毎の計測値をシャード毎にJSON LinesとPrometheus形式で出力する
+    metrics_path = path.replace('.jsonl', '.metrics.jsonl')
+    if os.path.exists(metrics_path):
+        os.remove(metrics_path)
+    metrics = app.PipelineMetrics(path=metrics_path)
+    started = time.perf_counter()
+    success_count = 0
+    with open(temp_path, 'w', encoding='utf-8') as file:
+
+        def on_result(index, record):
+            nonlocal success_count
+            success_count += record['success']
+            if not options['markdown']:
+                record = dict(record, markdown='')
+            file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            file.flush()
+
+        asyncio.run(
+            app.scrape_data(urls,
+                            max_concurrency=options['max_concurrency'],
+                            max_concurrency_per_host=options['max_concurrency_per_host'],
+                            incremental=options['incremental'],
+                            lastmods=lastmods,
+                            llm_concurrency=options['llm_concurrency'],
+                            llm_batching=options['llm_batching'],
+                            near_duplicates=options['near_duplicates'],
+                            site_schemas=options['site_schemas'],
+                            on_result=on_result,
+                            metrics=metrics))
+    with open(path.replace('.jsonl', '.prom'), 'w', encoding='utf-8') as file:
+        file.write(metrics.to_prometheus())
+    # 書き込みが完了したシャードのみ正式なファイル名にする（途中で止まった場合は再実行される）
+    os.replace(temp_path, path)
+    return shard, len(urls), success_count, time.perf_counter() - started
+
+
+def scrape(args):
+    urls, lastmods = load_urls(args)
+    # このホストが担当するシャード
+    shards = [shard for shard in range(args.shard_count) if shard % args.host_count == args.host_index]
+    shard_urls = {shard: [] for shard in shards}
+    for url in urls:
+        shard = shard_of(url, args.shard_count)
+        if shard in shard_urls:
+            shard_urls[shard].append(url)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    options = {
+        'max_concurrency': args.max_concurrency,
+        'max_concurrency_per_host': args.max_concurrency_per_host,
+        'incremental': args.incremental,
+        'llm_concurrency': args.llm_concurrency,
+        'llm_batching': args.llm_batching,
+        'near_duplicates': not args.no_near_duplicates,
+        'site_schemas': args.site_schemas,
+        'markdown': args.markdown,
+    }
+    tasks = []
+    for shard, shard_url_list in shard_urls.items():
+        path = os.path.join(args.output_dir, SHARD_FILE_PATTERN.format(shard=shard, shard_count=args.shard_count))
+        if not shard_url_list or (os.path.exists(path) and not args.overwrite):
+            continue
+        shard_lastmods = {url: lastmods[url] for url in shard_url_list} if lastmods else None
+        tasks.append((shard, args.shard_count, shard_url_list, shard_lastmods, args.output_dir, options))
+    print(f"{len(urls)} urls, {len(shards)} shards on this host, {len(tasks)} shards to run")
+
+    # Playwrightとイベントループをプロセス毎に持つため、forkではなくspawnで起動する
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, mp_context=context) as executor:
+        futures = [executor.submit(run_shard, *task) for task in tasks]
+        failed = 0
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                shard, url_count, success_count, seconds = future.result()
+                print(f"shard {shard}: {success_count}/{url_count} pages in {seconds:.1f}s")
+            except Exception as e:
+                print(f"scrape() failed to run shard: {e}", file=sys.stderr)
+                failed += 1
+    return 1 if failed else 0
+
+
+def merge(args):
+    # シャードを1つのJSONL/Parquetにまとめる（同じURLは後のシャードの結果を残す）
+    paths = sorted(glob.glob(os.path.join(args.input_dir, SHARD_GLOB_PATTERN)))
+    if not paths:
+        print(f"merge() no shards in {args.input_dir}", file=sys.stderr)
+        return 1
+    records = {}
+    for path in paths:
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                record = json.loads(line)
+                records[record['url']] = record
+    records = list(records.values())
+
+    if args.output.endswith('.parquet'):
+        pd.DataFrame(records).to_parquet(args.output, index=False)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            for record in records:
+                file.write(json.dumps(record, ensure_ascii=False) + '\n')
+    print(f"merged {len(records)} records from {len(paths)} shards into {args.output}")
+
+    if args.save_catalog:
+        saved_count = app.save_products(records)
+        df_saved = app.query_catalog(urls=[record['url'] for record in records])
+        app.get_retrieval_index().update(df_saved)
+        print(f"saved {saved_count} products to {app.CATALOG_DB_PATH}")
+        print(f"cached {app.cache_product_images(df_saved)} product images in {app.IMAGE_CACHE_DIR}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='interiAI 商品データのバッチ取り込み')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    scrape_parser = subparsers.add_parser('scrape', help='URLをシャードに分けてスクレイピングする')
+    source = scrape_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--sitemap', help='XMLサイトマップのURL')
+    source.add_argument('--urls', help='URLを1行に1つ記載したファイル')
+    scrape_parser.add_argument('--include', default='', help='含めるURLパターン（カンマ区切りの正規表現）')
+    scrape_parser.add_argument('--exclude', default='', help='除外するURLパターン（カンマ区切りの正規表現）')
+    scrape_parser.add_argument('--output-dir', default=os.path.join(app.DATA_DIR, 'shards'))
+    scrape_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='ワーカープロセス数')
+    scrape_parser.add_argument('--shard-count', type=int, default=16, help='全ホスト合計のシャード数')
+    scrape_parser.add_argument('--host-count', type=int, default=1, help='実行するホスト数')
+    scrape_parser.add_argument('--host-index', type=int, default=0, help='このホストの番号（0から）')
+    scrape_parser.add_argument('--max-concurrency', type=int, default=app.SCRAPING_MAX_CONCURRENCY)
+    scrape_parser.add_argument('--max-concurrency-per-host', type=int, default=app.SCRAPING_MAX_CONCURRENCY_PER_HOST)
+    scrape_parser.add_argument('--llm-concurrency', type=int, default=app.LLM_MAX_CONCURRENCY)
+    scrape_parser.add_argument('--llm-batching', action='store_true', help='小さいページをまとめてLLMに送る')
+    scrape_parser.add_argument('--no-near-duplicates',
+                               action='store_true',
+                               help='バリエーションページも差分ではなくページ全体をLLMに送る')
+    scrape_parser.add_argument('--site-schemas',
+                               action='store_true',
+                               help='サイト毎にCSSスキーマを学習し、検証に通ったページはLLMを使わずに抽出する')
+    scrape_parser.add_argument('--incremental', action='store_true', help='前回から変更の無いページを再取得しない')
+    scrape_parser.add_argument('--markdown', action='store_true', help='ページのmarkdownも出力する')
+    scrape_parser.add_argument('--overwrite', action='store_true', help='完了済みのシャードも再実行する')
+    scrape_parser.set_defaults(func=scrape)
+
+    merge_parser = subparsers.add_parser('merge', help='シャードを1つのファイルにまとめる')
+    merge_parser.add_argument('--input-dir', default=os.path.join(app.DATA_DIR, 'shards'))
+    merge_parser.add_argument('--output', required=True, help='出力ファイル（.jsonl または .parquet）')
+    merge_parser.add_argument('--save-catalog', action='store_true', help='商品カタログにも保存する')
+    merge_parser.set_defaults(func=merge)
+
+    args = parser.parse_args()
+    if args.command == 'scrape' and not 0 <= args.host_index < args.host_count:
+        parser.error('--host-index must be between 0 and --host-count - 1')
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
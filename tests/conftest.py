@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# テストではリポジトリ直下のモジュールを読み込み、データは一時ディレクトリに保存する
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('INTERI_AI_DATA_DIR', tempfile.mkdtemp(prefix='interi_ai_test_'))
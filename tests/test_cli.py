@@ -0,0 +1,38 @@
+import argparse
+import json
+
+import pandas as pd
+
+import interi_ai_cli as cli
+
+
+def write_shard(directory, shard, records):
+    path = directory / cli.SHARD_FILE_PATTERN.format(shard=shard, shard_count=2)
+    path.write_text(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records), encoding='utf-8')
+
+
+def test_shard_of_is_stable_and_in_range():
+    shards = [cli.shard_of(f'https://example.com/product/{i}/', 16) for i in range(100)]
+    assert shards == [cli.shard_of(f'https://example.com/product/{i}/', 16) for i in range(100)]
+    assert set(shards) <= set(range(16)) and len(set(shards)) > 1
+
+
+def test_merge_keeps_last_record_per_url(tmp_path):
+    write_shard(tmp_path, 0, [{'url': 'a', 'success': False}, {'url': 'b', 'success': True}])
+    write_shard(tmp_path, 1, [{'url': 'a', 'success': True}])
+    # 書き込み途中のシャードは対象にしない
+    (tmp_path / 'shard-00002-of-00003.jsonl.tmp').write_text('{"url": "c"}\n', encoding='utf-8')
+    output = tmp_path / 'merged.jsonl'
+    args = argparse.Namespace(input_dir=str(tmp_path), output=str(output), save_catalog=False)
+    assert cli.merge(args) == 0
+    records = [json.loads(line) for line in output.read_text(encoding='utf-8').splitlines()]
+    assert sorted((record['url'], record['success']) for record in records) == [('a', True), ('b', True)]
+
+    output = tmp_path / 'merged.parquet'
+    assert cli.merge(argparse.Namespace(input_dir=str(tmp_path), output=str(output), save_catalog=False)) == 0
+    assert sorted(pd.read_parquet(output)['url']) == ['a', 'b']
+
+
+def test_merge_without_shards_fails(tmp_path):
+    args = argparse.Namespace(input_dir=str(tmp_path), output=str(tmp_path / 'merged.jsonl'), save_catalog=False)
+    assert cli.merge(args) == 1
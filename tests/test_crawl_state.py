@@ -0,0 +1,30 @@
+import asyncio
+
+import interi_ai_app as app
+
+
+def test_state_store_round_trip_in_wal_mode(tmp_path):
+    path = str(tmp_path / 'crawl_state.sqlite3')
+
+    async def run():
+        async with app.CrawlStateStore(path=path) as store, app.CrawlStateStore(path=path) as other:
+            async with store._db.execute('PRAGMA journal_mode') as cursor:
+                assert (await cursor.fetchone())[0] == 'wal'
+            # 別のプロセスと同様に、2つの接続から書き込んでも互いの結果が読める
+            await store.update('https://example.com/a/', '2025-01-01T00:00:00', '"a"', None, 'key-a', '[{"item_name": "a"}]')
+            await other.update('https://example.com/b/', None, None, 'Wed, 01 Jan 2025 00:00:00 GMT', 'key-b',
+                               '[{"item_name": "b"}]')
+            states = await store.get_many(['https://example.com/a/', 'https://example.com/b/', 'https://example.com/c/'])
+        assert states['https://example.com/a/']['etag'] == '"a"'
+        assert states['https://example.com/b/']['cache_key'] == 'key-b'
+        assert states['https://example.com/b/']['extracted_content'] == '[{"item_name": "b"}]'
+        assert 'https://example.com/c/' not in states
+
+    asyncio.run(run())
+
+
+def test_normalize_lastmod():
+    assert app.normalize_lastmod('2025-01-01T09:00:00+09:00') == '2025-01-01T00:00:00+00:00'
+    assert app.normalize_lastmod('2025-01-01') == '2025-01-01T00:00:00'
+    assert app.normalize_lastmod('') is None
+    assert app.normalize_lastmod(None) is None
@@ -0,0 +1,126 @@
+import asyncio
+import http.server
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import interi_ai_app as app
+
+LISTING_PAGES = 8  # 一覧のページ数（DISCOVERY_MAX_DEPTHより多くする）
+
+
+class ListingHandler(http.server.BaseHTTPRequestHandler):
+    # /list/ は8ページのページ送りと配下のカテゴリ、/list/sub/ はさらに下のカテゴリを持つ
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        page = int(parse_qs(parsed.query).get('page', ['1'])[0])
+        links = []
+        if parsed.path == '/list/':
+            links += [f'/product/list-{page}/', '/about/', '/news/2025/']
+            if page < LISTING_PAGES:
+                links.append(f'/list/?page={page + 1}')
+            links.append('/list/sub/')
+        elif parsed.path == '/list/sub/':
+            links += ['/product/sub/', '/list/sub/deeper/']
+        elif parsed.path == '/list/sub/deeper/':
+            links += ['/product/deeper/', '/list/sub/deeper/deepest/']
+        elif parsed.path == '/list/sub/deeper/deepest/':
+            links.append('/product/deepest/')
+        body = ''.join(f'<a href="{link}">link</a>' for link in links)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.end_headers()
+        self.wfile.write(f'<html><body>{body}</body></html>'.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+class SharedListingHandler(http.server.BaseHTTPRequestHandler):
+    # /list/shared/ は深い経路（/list/fast/ から）で先に見つかり、浅い経路（遅い2ページ目から）で後から見つかる
+
+    def do_GET(self):
+        links = {
+            '/list/': ['/list/fast/', '/list/?page=2'],
+            '/list/fast/': ['/list/shared/'],
+            '/list/shared/': ['/list/shared/more/'],
+            '/list/shared/more/': ['/product/more/'],
+        }
+        if self.path == '/list/?page=2':
+            time.sleep(0.3)
+            links[self.path] = ['/list/shared/']
+        body = ''.join(f'<a href="{link}">link</a>' for link in links.get(self.path, []))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.end_headers()
+        self.wfile.write(f'<html><body>{body}</body></html>'.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(handler):
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd
+
+
+@pytest.fixture
+def server():
+    httpd = serve(ListingHandler)
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+
+
+@pytest.fixture
+def shared_server():
+    httpd = serve(SharedListingHandler)
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+
+
+def discover(start_url, include_patterns=(r'/product/',)):
+
+    async def run():
+        return [row['URL'] async for row in app.discover_product_urls(start_url, list(include_patterns), host_delay=0)]
+
+    return asyncio.run(run())
+
+
+def test_pagination_does_not_consume_depth(server):
+    urls = discover(f'{server}/list/')
+    listed = sorted(url for url in urls if re.search(r'/product/list-\d+/', url))
+    assert len(listed) == LISTING_PAGES
+
+
+def test_subcategories_are_limited_by_depth(server):
+    paths = {urlparse(url).path for url in discover(f'{server}/list/')}
+    assert '/product/sub/' in paths
+    assert '/product/deeper/' in paths
+    assert '/product/deepest/' not in paths
+
+
+def test_listing_found_again_at_shallower_depth_is_crawled_again(shared_server):
+    # 深さ2で見つかった /list/shared/ の配下は上限を超えるが、2ページ目から深さ1で見つかった後は辿れる
+    paths = [urlparse(url).path for url in discover(f'{shared_server}/list/')]
+    assert paths == ['/product/more/']
+
+
+def test_without_include_patterns_only_product_like_urls_are_returned(server):
+    paths = {urlparse(url).path for url in discover(f'{server}/list/', include_patterns=())}
+    assert '/product/sub/' in paths
+    assert '/about/' not in paths
+    assert '/news/2025/' not in paths
+    assert all(path.startswith('/product/') for path in paths)
+
+
+def test_strip_pagination():
+    assert app.strip_pagination('https://example.com/list/?page=3&sort=new') == \
+        app.strip_pagination('https://example.com/list/?sort=new')
+    assert app.strip_pagination('https://example.com/list/page/2/') == app.strip_pagination('https://example.com/list/')
+    assert app.strip_pagination('https://example.com/list/sub/?page=2') != app.strip_pagination('https://example.com/list/')
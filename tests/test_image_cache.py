@@ -0,0 +1,89 @@
+import asyncio
+import http.server
+import io
+import threading
+from contextlib import closing
+
+import pytest
+from PIL import Image
+
+import interi_ai_app as app
+
+
+def make_image(color, size=(1200, 900), format='PNG'):
+    output = io.BytesIO()
+    Image.new('RGB', size, color).save(output, format=format)
+    return output.getvalue()
+
+
+IMAGES = {
+    '/a.png': (make_image('red'), 'image/png'),
+    # 同じ内容の画像が別のURL・Content-Typeで配信される
+    '/same-as-a': (make_image('red'), 'application/octet-stream'),
+    '/b.jpg': (make_image('blue', format='JPEG'), 'image/jpeg'),
+}
+
+
+class ImageHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in IMAGES:
+            self.send_error(404)
+            return
+        data, content_type = IMAGES[self.path]
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return app.ImageCache(path=str(tmp_path / 'image_cache.sqlite3'), directory=str(tmp_path / 'images'))
+
+
+def test_fetch_creates_thumbnails_once(server, cache):
+    urls = [f'{server}{path}' for path in IMAGES] + [f'{server}/missing.png']
+    assert asyncio.run(cache.fetch(urls)) == 3
+    thumbnails = cache.get_thumbnails(urls)
+    assert sorted(thumbnails) == sorted(urls[:3])
+    with Image.open(thumbnails[urls[0]]) as thumbnail:
+        assert thumbnail.format == 'JPEG'
+        assert max(thumbnail.size) <= max(app.IMAGE_THUMBNAIL_SIZE)
+    # 取得済みの画像は再取得しない
+    assert asyncio.run(cache.fetch(urls)) == 0
+
+
+def test_same_content_is_stored_once(server, cache):
+    first, second = f'{server}/a.png', f'{server}/same-as-a'
+    cache._store(first, IMAGES['/a.png'][0], 'image/png')
+    # 拡張子を決められないURLでも、保存済みの原寸画像を共有する
+    cache._store(second, IMAGES['/same-as-a'][0], 'application/octet-stream')
+    thumbnails = cache.get_thumbnails([first, second])
+    assert thumbnails[first] == thumbnails[second]
+    with closing(cache._connect()) as conn:
+        assert conn.execute('SELECT extension FROM images').fetchall() == [('.png',)]
+
+
+def test_evict_removes_least_recently_used(server, cache):
+    urls = [f'{server}/a.png', f'{server}/b.jpg']
+    asyncio.run(cache.fetch(urls[:1]))
+    asyncio.run(cache.fetch(urls[1:]))
+    with closing(cache._connect()) as conn:
+        newest_bytes = conn.execute('SELECT size_bytes FROM images ORDER BY last_access DESC').fetchone()[0]
+    cache.max_bytes = newest_bytes
+    assert cache.evict() == 1
+    assert list(cache.get_thumbnails(urls)) == [urls[1]]
@@ -0,0 +1,41 @@
+import asyncio
+
+import interi_ai_app as app
+
+SCHEMA = app.ProductInfo.model_json_schema()
+
+
+def test_cache_key_ignores_whitespace_differences():
+    key = app.make_llm_cache_key('# Chair\n\nW600  D550\n', SCHEMA, 'instruction', 'model')
+    assert key == app.make_llm_cache_key('#  Chair\nW600 D550', SCHEMA, 'instruction', 'model')
+
+
+def test_cache_key_changes_with_content_schema_instruction_and_model():
+    key = app.make_llm_cache_key('# Chair', SCHEMA, 'instruction', 'model')
+    assert key != app.make_llm_cache_key('# Sofa', SCHEMA, 'instruction', 'model')
+    assert key != app.make_llm_cache_key('# Chair', {}, 'instruction', 'model')
+    assert key != app.make_llm_cache_key('# Chair', SCHEMA, 'other instruction', 'model')
+    assert key != app.make_llm_cache_key('# Chair', SCHEMA, 'instruction', 'other model')
+    # 区切りを入れているため、境界をずらした入力は別のキーになる
+    assert app.make_llm_cache_key('ab', SCHEMA, 'c', 'model') != app.make_llm_cache_key('a', SCHEMA, 'bc', 'model')
+
+
+def test_get_does_not_write_and_access_order_is_kept(tmp_path):
+    path = str(tmp_path / 'llm_cache.sqlite3')
+
+    async def run():
+        async with app.LLMExtractionCache(path=path) as cache:
+            await cache.set('old', 'old value')
+            await cache.set('new', 'new value')
+            changes = cache._db.total_changes
+            # 読み込みではデータベースに書き込まない
+            assert await cache.get('old') == 'old value'
+            assert cache._db.total_changes == changes
+            async with cache._db.execute('PRAGMA journal_mode') as cursor:
+                assert (await cursor.fetchone())[0] == 'wal'
+        # 閉じる際に反映した最終アクセス時刻で、最近使われたものを残す
+        async with app.LLMExtractionCache(path=path, max_entries=1) as cache:
+            assert await cache.get('old') == 'old value'
+            assert await cache.get('new') is None
+
+    asyncio.run(run())
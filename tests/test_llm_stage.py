@@ -0,0 +1,101 @@
+import asyncio
+import json
+import re
+import time
+
+import pytest
+
+import interi_ai_app as app
+
+URLS = [f'https://example.com/product/{i}/' for i in range(3)]
+
+
+class FakeCompletion:
+    # バッチのプロンプトには最初のmissing_from_batch件を除いたページだけを返す
+
+    def __init__(self, missing_from_batch=0, delay=0.0):
+        self.missing_from_batch = missing_from_batch
+        self.delay = delay
+        self.prompts = []
+        self.running = self.peak = 0
+
+    async def __call__(self, prompt, estimated_tokens):
+        self.prompts.append(prompt)
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.running -= 1
+        batch_urls = re.findall(r'^## URL: (\S+)$', prompt, re.MULTILINE)
+        if batch_urls:
+            products = [{'url': url, 'item_name': f'batch {url}'} for url in batch_urls[self.missing_from_batch:]]
+            return json.dumps({'products': products}), 100, 30, self.delay
+        url = re.search(r'^# URL\n(\S+)$', prompt, re.MULTILINE).group(1)
+        return json.dumps({'item_name': f'single {url}'}), 50, 10, self.delay
+
+
+def extract_all(completion, batching=True, concurrency=3, cancel=None):
+
+    async def run():
+        async with app.LLMExtractionStage(concurrency=concurrency, batching=batching) as stage:
+            stage._complete = completion
+            tasks = [asyncio.create_task(stage.extract(url, 'ダイニングチェア', tokens=100)) for url in URLS]
+            if cancel is not None:
+                await asyncio.sleep(0)
+                tasks[cancel].cancel()
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        return [
+            result if isinstance(result, BaseException) else json.loads(result['extracted_content'])[0]['item_name']
+            for result in results
+        ]
+
+    return asyncio.run(run())
+
+
+def test_small_pages_are_batched_into_one_request():
+    completion = FakeCompletion()
+    assert extract_all(completion) == [f'batch {url}' for url in URLS]
+    assert len(completion.prompts) == 1
+
+
+def test_pages_missing_from_batch_are_requeued_as_single_jobs():
+    completion = FakeCompletion(missing_from_batch=2, delay=0.1)
+    assert extract_all(completion) == [f'single {URLS[0]}', f'single {URLS[1]}', f'batch {URLS[2]}']
+    assert len(completion.prompts) == 3
+    # 1ページずつのジョブは別々のワーカーで並行して処理される
+    assert completion.peak == 2
+
+
+def test_cancelled_page_does_not_break_the_rest_of_the_batch():
+    results = extract_all(FakeCompletion(), cancel=1)
+    assert isinstance(results[1], asyncio.CancelledError)
+    assert [results[0], results[2]] == [f'batch {URLS[0]}', f'batch {URLS[2]}']
+
+
+def test_errors_are_set_on_each_page():
+
+    async def failing(prompt, estimated_tokens):
+        raise ValueError('invalid request')
+
+    results = extract_all(failing, batching=False)
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_token_bucket_paces_without_holding_the_lock():
+    # 1秒あたり10個、容量1のため、5回の取得は約0.1秒間隔になる
+    bucket = app.TokenBucket(600, capacity=1)
+    acquired = []
+
+    async def acquire():
+        await bucket.acquire()
+        acquired.append(time.monotonic())
+
+    async def run():
+        started = time.monotonic()
+        await asyncio.gather(*[acquire() for _ in range(5)])
+        return started
+
+    started = asyncio.run(run())
+    assert acquired[-1] - started == pytest.approx(0.4, abs=0.08)
+    assert all(later - earlier == pytest.approx(0.1, abs=0.05) for earlier, later in zip(acquired, acquired[1:]))
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+import interi_ai_app as app
+
+
+def page_metrics(total_seconds, llm_seconds=0.0, **metrics):
+    return dict({f'{stage}_seconds': 0.0 for stage in app.PIPELINE_STAGES},
+                llm_seconds=llm_seconds,
+                total_seconds=total_seconds,
+                **metrics)
+
+
+@pytest.fixture
+def metrics(tmp_path):
+    metrics = app.PipelineMetrics(path=str(tmp_path / 'metrics' / 'scrape.jsonl'))
+    metrics.set_browser_launch(1.5)
+    metrics.add('https://example.com/a/', True,
+                page_metrics(0.3, llm_seconds=0.2, bytes_fetched=1000, prompt_tokens=100, completion_tokens=20,
+                             cost_usd=0.001))
+    metrics.add('https://example.com/b/', True,
+                page_metrics(4.0, llm_seconds=3.0, bytes_fetched=2000, prompt_tokens=300, completion_tokens=40,
+                             cost_usd=0.002))
+    metrics.add('https://example.com/c/', False, page_metrics(200.0))
+    return metrics
+
+
+def test_jsonl_has_one_line_per_event(metrics):
+    with open(metrics.path, encoding='utf-8') as file:
+        entries = [json.loads(line) for line in file]
+    assert [entry['event'] for entry in entries] == ['browser_launch', 'page', 'page', 'page']
+    assert entries[2]['url'] == 'https://example.com/b/'
+    assert entries[2]['llm_seconds'] == 3.0
+    assert entries[3]['success'] is False
+
+
+def test_summary_uses_running_aggregates(metrics):
+    summary = metrics.summary()
+    assert (summary['pages'], summary['succeeded']) == (3, 2)
+    assert summary['bytes_fetched'] == 3000
+    assert summary['prompt_tokens'] == 400
+    assert summary['cost_usd'] == pytest.approx(0.003)
+    assert summary['stage_seconds']['llm'] == pytest.approx(3.2)
+    # 1ページの処理時間の中央値はバケット（2.5〜5秒）内で線形補間する
+    assert 2.5 <= summary['page_seconds_quantiles'][0.5] <= 5
+    # 最大のバケットを超えた値は最大のバケットの上限を返す
+    assert summary['page_seconds_quantiles'][0.99] == app.PIPELINE_LATENCY_BUCKETS[-1]
+
+
+def test_from_jsonl_restores_aggregates(metrics):
+    restored = app.PipelineMetrics.from_jsonl(metrics.path)
+    assert restored.summary() == metrics.summary()
+    assert restored.to_prometheus() == metrics.to_prometheus()
+
+
+def test_prometheus_text(metrics):
+    lines = metrics.to_prometheus().splitlines()
+    assert 'interi_ai_scrape_pages_total{status="success"} 2' in lines
+    assert 'interi_ai_scrape_pages_total{status="failure"} 1' in lines
+    assert '# TYPE interi_ai_scrape_stage_seconds histogram' in lines
+    assert 'interi_ai_scrape_stage_seconds_bucket{stage="llm",le="0.25"} 2' in lines
+    assert 'interi_ai_scrape_stage_seconds_bucket{stage="llm",le="+Inf"} 3' in lines
+    assert 'interi_ai_scrape_stage_seconds_sum{stage="llm"} 3.200000' in lines
+    assert 'interi_ai_scrape_stage_seconds_count{stage="llm"} 3' in lines
+    assert 'interi_ai_scrape_page_seconds_bucket{le="5"} 2' in lines
+    assert 'interi_ai_scrape_page_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'interi_ai_scrape_page_seconds_count 3' in lines
+    assert 'interi_ai_scrape_llm_tokens_total{type="prompt"} 400' in lines
+    assert 'interi_ai_scrape_browser_launch_seconds 1.500000' in lines
+    # バケットの値は累積で、減少しない
+    buckets = [int(line.rsplit(' ', 1)[1]) for line in lines if line.startswith('interi_ai_scrape_page_seconds_bucket')]
+    assert buckets == sorted(buckets)
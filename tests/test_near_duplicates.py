@@ -0,0 +1,55 @@
+import asyncio
+
+import interi_ai_app as app
+
+BASE = '\n'.join([
+    '# BENCH-00001 Lounge Chair',
+    'ゆったりとした座り心地のラウンジチェアです。' * 5,
+    '素材: Walnut',
+    'カラー: ブラウン',
+    '価格: ¥120,000（税込）',
+    '納期: 3週間',
+] + [f'ショールームのご案内 {i}' for i in range(20)])
+VARIANT = BASE.replace('カラー: ブラウン', 'カラー: ブラック').replace('¥120,000', '¥125,000')
+OTHER = '\n'.join(['# Dining Table', 'オーク無垢材のダイニングテーブルです。' * 5, '価格: ¥300,000'])
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def test_variant_pages_share_a_band():
+    base, variant, other = (app.compute_simhash(text) for text in (BASE, VARIANT, OTHER))
+    assert hamming(base, variant) <= app.NEAR_DUPLICATE_MAX_DISTANCE
+    assert hamming(base, other) > app.NEAR_DUPLICATE_MAX_DISTANCE
+    assert set(app.simhash_bands(base)) & set(app.simhash_bands(variant))
+
+
+def test_bands_cover_all_bits():
+    # 距離が上限以下なら、いずれかの帯が必ず一致する
+    simhash = 0x0123456789ABCDEF
+    flipped = simhash
+    for bit in range(0, 64, 64 // app.NEAR_DUPLICATE_MAX_DISTANCE)[:app.NEAR_DUPLICATE_MAX_DISTANCE]:
+        flipped ^= 1 << bit
+    assert hamming(simhash, flipped) == app.NEAR_DUPLICATE_MAX_DISTANCE
+    assert any(a == b for a, b in zip(app.simhash_bands(simhash), app.simhash_bands(flipped)))
+
+
+def test_diff_keeps_only_changed_lines():
+    assert app.diff_llm_input(BASE, VARIANT).splitlines() == ['カラー: ブラック', '価格: ¥125,000（税込）']
+    assert app.diff_llm_input(BASE, BASE) == ''
+
+
+def test_to_signed_int64():
+    assert app.to_signed_int64((1 << 64) - 1) == -1
+    assert app.to_signed_int64(1 << 62) == 1 << 62
+
+
+def test_index_opens_in_wal_mode(tmp_path):
+
+    async def run():
+        async with app.NearDuplicateIndex(path=str(tmp_path / 'near_duplicates.sqlite3')) as index:
+            async with index._db.execute('PRAGMA journal_mode') as cursor:
+                return (await cursor.fetchone())[0]
+
+    assert asyncio.run(run()) == 'wal'
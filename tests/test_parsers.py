@@ -0,0 +1,36 @@
+import pytest
+
+import interi_ai_app as app
+
+
+@pytest.mark.parametrize('size, expected', [
+    ('W500 D500 H550 SH420', (500.0, 500.0, 550.0, 420.0)),
+    ('Ｗ１,２００×Ｄ６００×Ｈ７２０ｍｍ', (1200.0, 600.0, 720.0, None)),
+    ('W50 D45 H80cm', (500.0, 450.0, 800.0, None)),
+    ('1800×900×720', (1800.0, 900.0, 720.0, None)),
+    ('', (None, None, None, None)),
+])
+def test_parse_size(size, expected):
+    assert app.parse_size(size) == expected
+
+
+@pytest.mark.parametrize('price, expected', [
+    ('￥120,000（税込）', (120000, 1)),
+    ('¥98,000（税抜）', (98000, 0)),
+    ('45,000円', (45000, None)),
+    ('お問い合わせください', (None, None)),
+    (None, (None, None)),
+])
+def test_parse_price(price, expected):
+    assert app.parse_price(price) == expected
+
+
+@pytest.mark.parametrize('weight, expected', [('15kg', 15.0), ('1500g', 1.5), ('約 ８.５ｋｇ', 8.5), ('', None)])
+def test_parse_weight(weight, expected):
+    assert app.parse_weight(weight) == expected
+
+
+def test_parse_extracted_product_skips_error_blocks():
+    content = '[{"error": true, "content": "timeout"}, {"item_name": "Chair", "price": "¥1,000"}]'
+    assert app.parse_extracted_product(content)['item_name'] == 'Chair'
+    assert app.parse_extracted_product('not json') is None
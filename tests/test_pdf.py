@@ -0,0 +1,85 @@
+import asyncio
+import json
+
+import interi_ai_app as app
+
+TABLE_COLUMNS = [72, 192, 252, 312, 372, 472]
+TABLE_ROWS = [
+    ['Model', 'W', 'D', 'H', 'Price'],
+    ['Sofa S-2', '1800', '850', '760', '250,000'],
+    ['Table T-1', '1600', '900', '720', '180,000'],
+]
+
+
+def text_ops(x, y, text):
+    text = text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)').encode('cp1252')
+    return b'BT /F1 10 Tf %d %d Td (' % (x, y) + text + b') Tj ET\n'
+
+
+def text_page():
+    # 表になっていない商品ブロック（価格の行で終わる）
+    lines = ['Lounge Chair LC-01', 'W600 D550 H780', '¥120,000']
+    return b''.join(text_ops(72, 720 - 20 * i, line) for i, line in enumerate(lines))
+
+
+def table_page():
+    # 罫線で囲んだ価格表
+    top = 700
+    bottom = top - 20 * len(TABLE_ROWS)
+    ops = [b'%d %d m %d %d l S\n' % (x, top, x, bottom) for x in TABLE_COLUMNS]
+    ops += [b'%d %d m %d %d l S\n' % (TABLE_COLUMNS[0], y, TABLE_COLUMNS[-1], y) for y in range(bottom, top + 1, 20)]
+    for i, row in enumerate(TABLE_ROWS):
+        ops += [text_ops(x + 4, top - 20 * i - 14, cell) for x, cell in zip(TABLE_COLUMNS, row)]
+    return b''.join(ops)
+
+
+def write_pdf(path, contents):
+    # テキストと罫線だけの最小限のPDFを書き出す
+    page_ids = [4 + 2 * i for i in range(len(contents))]
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [%s] /Count %d >>' % (b' '.join(b'%d 0 R' % i for i in page_ids), len(contents)),
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>',
+    ]
+    for page_id, content in zip(page_ids, contents):
+        objects.append(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] '
+                       b'/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % (page_id + 1))
+        objects.append(b'<< /Length %d >>\nstream\n' % len(content) + content + b'endstream')
+    output = b'%PDF-1.4\n'
+    offsets = []
+    for i, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b'%d 0 obj\n' % i + body + b'\nendobj\n'
+    xref = len(output)
+    output += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    output += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    output += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    with open(path, 'wb') as file:
+        file.write(output)
+    return str(path)
+
+
+def test_extract_pdf_pages_uses_text_blocks_and_tables(tmp_path):
+    path = write_pdf(tmp_path / 'catalog.pdf', [text_page(), table_page(), b''])
+    pages = app.extract_pdf_pages(path, 0, 3)
+    assert [page['page'] for page in pages] == [1, 2, 3]
+    assert pages[0]['products'] == [{'size': 'W600 D550 H780', 'price': '￥120,000', 'item_name': 'Lounge Chair LC-01'}]
+    assert pages[1]['products'] == [
+        {'item_name': 'Sofa S-2', 'size': 'W1800 D850 H760', 'price': '￥250,000'},
+        {'item_name': 'Table T-1', 'size': 'W1600 D900 H720', 'price': '￥180,000'},
+    ]
+    # 空のページはLLMにも送らない
+    assert pages[2] == {'page': 3, 'products': [], 'text': ''}
+
+
+def test_extract_pdf_saves_products_in_page_order(tmp_path):
+    path = write_pdf(tmp_path / 'catalog.pdf', [table_page(), text_page()] * 5)
+    progress = []
+    summary = asyncio.run(app.extract_pdf(path, 'catalog.pdf', brand_name='PDF BRAND', max_workers=2, use_llm=False,
+                                          on_progress=lambda done, total: progress.append((done, total))))
+    assert [row['ページ'] for row in summary] == sorted(row['ページ'] for row in summary)
+    assert len(summary) == 15
+    assert progress[-1] == (10, 10)
+    products = app.query_catalog(urls=[row['URL'] for row in summary])
+    assert len(products) == 15
+    assert set(products['brand_name']) == {'PDF BRAND'}
@@ -0,0 +1,50 @@
+import json
+
+import interi_ai_app as app
+
+# 耐荷重・送料が重量・価格より先に書かれているページ
+PAGE = '''# BENCH-00001 Lounge Chair
+![BENCH-00001](https://example.com/images/1-1.jpg)
+[関連商品](https://example.com/product/2/)
+耐荷重 100kg / 本体重量 6.5kg / 送料 ¥3,300 / 価格 ¥45,000（税込）
+サイズ: W600 D550 H780 SH420
+'''
+TABLE_PAGE = '''| 耐荷重 | 100kg |
+| 本体重量 | 6.5kg |
+| 送料 | ¥3,300 |
+| ポイント | 450円相当 |
+| 販売価格 | ¥45,000（税込） |
+'''
+
+
+def test_rules_use_labeled_weight_and_price_only():
+    for page in (PAGE, TABLE_PAGE):
+        fields = app.extract_product_fields_by_rules(page)
+        assert fields['weight'] == '6.5kg'
+        assert fields['price'] == '￥45,000（税込）'
+
+
+def test_rules_extract_size_and_images():
+    fields = app.extract_product_fields_by_rules(PAGE)
+    assert fields['size'] == 'W600 D550 H780 SH420'
+    assert fields['image_urls'] == ['https://example.com/images/1-1.jpg']
+
+
+def test_unlabeled_amounts_are_left_to_the_llm():
+    fields = app.extract_product_fields_by_rules('耐荷重 100kg\n送料 ¥3,300\n¥45,000')
+    assert 'weight' not in fields and 'price' not in fields
+
+
+def test_rule_fields_only_fill_empty_llm_fields():
+    extracted = json.dumps([{'weight': '6.5kg', 'price': '', 'size': 'W600 D550 H780', 'image_urls': []}])
+    rule_fields = {'weight': '100kg', 'price': '￥45,000（税込）', 'size': 'W1 D1 H1', 'image_urls': ['a.jpg']}
+    merged = json.loads(app.merge_rule_fields(extracted, rule_fields))[0]
+    assert merged == {'weight': '6.5kg', 'price': '￥45,000（税込）', 'size': 'W600 D550 H780', 'image_urls': ['a.jpg']}
+    # エラーのブロックには補わない
+    assert json.loads(app.merge_rule_fields('[{"error": true}]', rule_fields)) == [{'error': True}]
+
+
+def test_llm_input_drops_image_and_link_urls_and_respects_budget():
+    text = app.prepare_llm_input(PAGE)
+    assert 'https://' not in text and '関連商品' in text
+    assert app.count_tokens(app.prepare_llm_input(PAGE * 200, budget=100)) <= 100
@@ -0,0 +1,73 @@
+import os
+import types
+
+import litellm
+import pandas as pd
+import pytest
+
+import interi_ai_app as app
+
+PRODUCTS = pd.DataFrame([
+    {'url': 'https://example.com/sofa/', 'item_name': 'レザーソファ', 'brand_name': 'A', 'category': '3人掛けソファ',
+     'size': 'W2000 D900 H800', 'material': 'レザー', 'price': '￥300,000（税込）'},
+    {'url': 'https://example.com/chair/', 'item_name': 'オークチェア', 'brand_name': 'B', 'category': 'ダイニングチェア',
+     'size': 'W450 D500 H780', 'material': 'オーク', 'price': '￥60,000（税込）'},
+])
+
+
+@pytest.fixture
+def catalog(tmp_path, monkeypatch):
+    path = tmp_path / 'catalog.sqlite3'
+    path.write_bytes(b'')
+    os.utime(path, (1000, 1000))
+    monkeypatch.setattr(app, 'CATALOG_DB_PATH', str(path))
+    app.get_recommendation_cache().clear()
+    return path
+
+
+def fake_stream(chunks, error=None):
+
+    def completion(**kwargs):
+        completion.prompts.append(kwargs['messages'][0]['content'])
+        for text in chunks:
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=text))])
+        if error is not None:
+            raise error
+
+    completion.prompts = []
+    return completion
+
+
+def test_cache_key_is_normalized_and_follows_catalog_updates(catalog):
+    key = app.make_recommendation_cache_key({'テイスト': ['インダストリアル', 'ナチュラル'], '幅': (0, 1000)}, 'ソファ  を探しています')
+    assert key == app.make_recommendation_cache_key({'幅': (0, 1000), 'テイスト': ['ナチュラル', 'インダストリアル']},
+                                                    'ソファ を探しています')
+    assert key != app.make_recommendation_cache_key({'テイスト': ['ナチュラル'], '幅': (0, 1000)}, 'ソファ を探しています')
+    # 商品カタログが更新されたら以前の提案文は使わない
+    os.utime(catalog, (2000, 2000))
+    assert key != app.make_recommendation_cache_key({'テイスト': ['インダストリアル', 'ナチュラル'], '幅': (0, 1000)},
+                                                    'ソファ を探しています')
+
+
+def test_stream_recommendation_yields_chunks_and_caches_answer(catalog, monkeypatch):
+    completion = fake_stream(['レザーソファ', 'がおすすめです。'])
+    monkeypatch.setattr(litellm, 'completion', completion)
+    key = app.make_recommendation_cache_key(query='ソファ')
+    assert list(app.stream_recommendation(key, 'ご要望: ソファ', PRODUCTS)) == ['レザーソファ', 'がおすすめです。']
+    # 上位の商品だけを1行ずつプロンプトに入れる
+    assert '1. 商品名: レザーソファ' in completion.prompts[0]
+    assert app.get_recommendation_cache().get(key) == {
+        'answer': 'レザーソファがおすすめです。',
+        'urls': PRODUCTS['url'].tolist(),
+    }
+
+
+def test_interrupted_stream_is_not_cached(catalog, monkeypatch):
+    monkeypatch.setattr(litellm, 'completion', fake_stream(['レザー'], error=litellm.APIConnectionError(
+        message='closed', llm_provider='gemini', model='gemini-2.5-flash')))
+    key = app.make_recommendation_cache_key(query='ソファ')
+    assert list(app.stream_recommendation(key, 'ご要望: ソファ', PRODUCTS)) == ['レザー']
+    assert app.get_recommendation_cache().get(key) is None
+    # 何も受け取れなかった場合は定型文を返す
+    monkeypatch.setattr(litellm, 'completion', fake_stream([], error=RuntimeError('no api key')))
+    assert list(app.stream_recommendation(key, 'ご要望: ソファ', PRODUCTS)) == [app.RECOMMENDATION_FALLBACK_MESSAGE]
@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import interi_ai_app as app
+
+# 埋め込みの代わりに、語の出現で決まるベクトルを使う
+EMBEDDING_TERMS = ['ソファ', 'チェア', 'テーブル', 'ベッド', 'オーク', 'レザー', 'くつろ']
+
+PRODUCTS = pd.DataFrame([
+    {'url': 'https://example.com/sofa/', 'item_name': 'レザー 3人掛けソファ', 'brand_name': 'A',
+     'category': '3人掛けソファ', 'description': 'リビングでくつろげる本革のソファ。', 'material': 'レザー'},
+    {'url': 'https://example.com/chair/', 'item_name': 'オーク ダイニングチェア', 'brand_name': 'B',
+     'category': 'ダイニングチェア', 'description': '無垢材の椅子。', 'material': 'オーク'},
+    {'url': 'https://example.com/table/', 'item_name': 'オーク ダイニングテーブル', 'brand_name': 'B',
+     'category': 'ダイニングテーブル', 'description': '4人用のテーブル。', 'material': 'オーク'},
+    {'url': 'https://example.com/bed/', 'item_name': 'シングルベッド', 'brand_name': 'C',
+     'category': 'ベッド', 'description': 'ゆっくりくつろげるベッド。', 'material': 'ファブリック'},
+])
+
+
+def fake_embed_texts(texts):
+    vectors = np.array([[text.count(term) for term in EMBEDDING_TERMS] + [0.1] for text in texts], dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'embed_texts', fake_embed_texts)
+    retrieval_index = app.RetrievalIndex(index_dir=str(tmp_path / 'retrieval_index')).load()
+    assert retrieval_index.update(PRODUCTS) == len(PRODUCTS)
+    return retrieval_index
+
+
+def test_search_ranks_matching_product_first(index):
+    urls = [url for url, _ in index.search('レザーのソファ', top_k=3)]
+    assert urls[0] == 'https://example.com/sofa/'
+    assert [url for url, _ in index.search('オークのテーブル', top_k=2)][0] == 'https://example.com/table/'
+
+
+def test_bm25_only_when_embeddings_fail(index, monkeypatch):
+    monkeypatch.setattr(app, 'embed_texts', lambda texts: None)
+    assert [url for url, _ in index.search('ベッド', top_k=1)] == ['https://example.com/bed/']
+
+
+def test_update_only_changed_products_and_reload(index, tmp_path):
+    assert index.update(PRODUCTS) == 0
+    changed = PRODUCTS.copy()
+    changed.loc[3, 'description'] = 'ヘッドボード付きのソファベッド。レザー張り。'
+    assert index.update(changed) == 1
+    reloaded = app.RetrievalIndex(index_dir=index.index_dir).load()
+    assert len(reloaded) == len(PRODUCTS)
+    assert reloaded.search('ソファベッド', top_k=2) == index.search('ソファベッド', top_k=2)
+
+
+def test_retry_embeddings_after_failure(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'embed_texts', lambda texts: None)
+    retrieval_index = app.RetrievalIndex(index_dir=str(tmp_path / 'retrieval_index')).load()
+    assert retrieval_index.update(PRODUCTS) == len(PRODUCTS)
+    assert retrieval_index.hashes == [None] * len(PRODUCTS)
+    monkeypatch.setattr(app, 'embed_texts', fake_embed_texts)
+    assert retrieval_index.update(PRODUCTS) == len(PRODUCTS)
+    assert None not in retrieval_index.hashes
+    assert retrieval_index._dense_ranking('くつろげるソファ')[0] == 0
+
+
+def test_concurrent_instances_keep_each_others_products(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'embed_texts', fake_embed_texts)
+    index_dir = str(tmp_path / 'retrieval_index')
+    first = app.RetrievalIndex(index_dir=index_dir).load()
+    second = app.RetrievalIndex(index_dir=index_dir).load()
+    assert first.update(PRODUCTS.iloc[:2]) == 2
+    assert second.update(PRODUCTS.iloc[2:]) == 2
+    reloaded = app.RetrievalIndex(index_dir=index_dir).load()
+    assert sorted(reloaded.urls) == sorted(PRODUCTS['url'])
+    assert [url for url, _ in reloaded.search('レザーのソファ', top_k=1)] == ['https://example.com/sofa/']
+    # 古い版のディレクトリは直前の版まで残す
+    assert len([name for name in os.listdir(index_dir) if name.startswith('v')]) == 2
+
+
+def test_tokenize_japanese_uses_bigrams_for_japanese():
+    assert app.tokenize_japanese('ＳＯＦＡ ソファ') == ['sofa', 'ソフ', 'ファ']
@@ -0,0 +1,188 @@
+import asyncio
+import http.server
+import json
+import threading
+import types
+
+import crawl4ai
+import pytest
+
+import interi_ai_app as app
+
+PAGE_HTML = '''<html><body><main><h1>{name}</h1>
+<table><tr><th>サイズ</th><td>W600 D550 H780</td></tr><tr><th>価格</th><td>¥120,000（税込）</td></tr></table>
+<p>{description}</p></main></body></html>'''
+
+
+class NotModifiedHandler(http.server.BaseHTTPRequestHandler):
+    # 条件付きリクエストには常に304を返す
+
+    def do_GET(self):
+        self.send_response(304)
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeCrawler:
+    delays = {}
+
+    def __init__(self, config=None):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def start(self):
+        FakeCrawler.started += 1
+
+    async def close(self):
+        FakeCrawler.closed += 1
+
+    async def arun(self, url, config):
+        FakeCrawler.fetched.append(url)
+        FakeCrawler.running += 1
+        FakeCrawler.peak = max(FakeCrawler.peak, FakeCrawler.running)
+        try:
+            await asyncio.sleep(FakeCrawler.delays.get(url, 0))
+        finally:
+            FakeCrawler.running -= 1
+        html = PAGE_HTML.format(name=url, description='座り心地の良いチェアです。' * 20)
+        markdown = config.markdown_generator.generate_markdown(html, base_url=url)
+        return types.SimpleNamespace(success=True,
+                                     status_code=200,
+                                     response_headers={'ETag': '"v1"'},
+                                     html=html,
+                                     markdown=markdown.raw_markdown,
+                                     media={'images': [{'src': f'{url}main.jpg', 'score': 5}]},
+                                     error_message='')
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), NotModifiedHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+
+
+@pytest.fixture
+def fake_pipeline(monkeypatch):
+    FakeCrawler.fetched = []
+    FakeCrawler.delays = {}
+    FakeCrawler.running = FakeCrawler.peak = 0
+    FakeCrawler.started = FakeCrawler.closed = 0
+    monkeypatch.setattr(crawl4ai, 'AsyncWebCrawler', FakeCrawler)
+
+    async def extract(self, url, llm_input, tokens=None, base_product=None):
+        return {
+            'extracted_content': json.dumps([{'item_name': url}]),
+            'prompt_tokens': 10,
+            'completion_tokens': 5,
+            'seconds': 0.0,
+        }
+
+    monkeypatch.setattr(app.LLMExtractionStage, 'extract', extract)
+
+
+def test_concurrency_is_bounded_and_results_keep_input_order(server, fake_pipeline):
+    urls = [f'{server}/concurrent/{i}/' for i in range(12)]
+    # 後のURLほど早く取得が終わるようにする
+    FakeCrawler.delays = {url: 0.01 * (len(urls) - i) for i, url in enumerate(urls)}
+    records = asyncio.run(app.scrape_data(urls, max_concurrency=3, max_concurrency_per_host=5))
+    assert FakeCrawler.peak == 3
+    assert [record['url'] for record in records] == urls
+    assert [json.loads(record['extracted_content'])[0]['item_name'] for record in records] == urls
+
+
+def test_shared_browser_is_reused_across_jobs(server, fake_pipeline):
+
+    async def run():
+        resources = app.SharedScrapingResources()
+        first = await app.scrape_data([f'{server}/shared/1/'], resources=resources)
+        second = await app.scrape_data([f'{server}/shared/2/'], resources=resources)
+        assert first[0]['success'] and second[0]['success']
+        assert (resources.launches, FakeCrawler.started, FakeCrawler.closed) == (1, 1, 0)
+        # 使用中のブラウザは閉じない
+        async with resources.use_crawler():
+            assert not await resources.close()
+        assert await resources.close()
+        assert FakeCrawler.closed == 1
+
+    asyncio.run(run())
+
+
+def test_not_modified_record_equals_previous_record(server, fake_pipeline):
+    urls = [f'{server}/item/{i}/' for i in range(2)]
+    fetched = asyncio.run(app.scrape_data(urls))
+    product = json.loads(fetched[0]['extracted_content'])[0]
+    # LLMが返さなかった価格・サイズ・画像はルールで補われている
+    assert product['price'] == '￥120,000（税込）'
+    assert product['size'] == 'W600 D550 H780'
+    assert product['image_urls'] == [f'{urls[0]}main.jpg']
+
+    # LLM抽出キャッシュを消しても、304のページは前回の最終的な抽出結果を返す
+    asyncio.run(app.clear_llm_extraction_cache())
+    FakeCrawler.fetched = []
+    not_modified = asyncio.run(app.scrape_data(urls, incremental=True))
+    assert FakeCrawler.fetched == []
+    assert [record['not_modified'] for record in not_modified] == [True, True]
+    assert [record['extracted_content'] for record in not_modified] == \
+        [record['extracted_content'] for record in fetched]
+
+
+def test_not_modified_page_falls_back_to_fetch_when_state_update_fails(server, fake_pipeline, monkeypatch):
+    urls = [f'{server}/product/{i}/' for i in range(3)]
+    records = asyncio.run(app.scrape_data(urls))
+    assert all(record['success'] for record in records)
+
+    # 304のページで取得状態の保存に1回だけ失敗させる
+    update = app.CrawlStateStore.update
+    failures = []
+
+    async def flaky_update(self, url, *args):
+        if url == urls[1] and not failures:
+            failures.append(url)
+            raise RuntimeError('database is locked')
+        await update(self, url, *args)
+
+    monkeypatch.setattr(app.CrawlStateStore, 'update', flaky_update)
+    FakeCrawler.fetched = []
+    records = asyncio.run(app.scrape_data(urls, incremental=True))
+    assert [record['success'] for record in records] == [True, True, True]
+    assert [record['not_modified'] for record in records] == [True, False, True]
+    assert FakeCrawler.fetched == [urls[1]]
+
+
+def test_job_resumes_from_checkpoint_and_streams_results_to_sink(server, fake_pipeline, tmp_path):
+    import pyarrow.parquet as pq
+
+    store = app.ScrapingJobStore(path=str(tmp_path / 'scraping_jobs.sqlite3'))
+    urls = [f'{server}/job/{i}/' for i in range(4)]
+    job_id = store.create_job(urls)
+    # 前回の実行で最初の2ページまで完了していた
+    for position in range(2):
+        store.save_record(job_id, position, {'url': urls[position], 'success': True, 'markdown': '# done'})
+    # ジョブランナーのスレッドはデーモンスレッドのため、テストの終了時に止まる
+    runner = app.ScrapingJobRunner(store)
+    runner.submit(job_id)
+    runner.futures[job_id].result(timeout=60)
+    job = store.get_job(job_id)
+    assert (job['status'], job['done'], job['pending']) == ('completed', 4, 0)
+    assert sorted(FakeCrawler.fetched) == urls[2:]
+
+    # markdownは結果ファイルにのみ保存し、チェックポイントのDBには保存しない
+    records = list(app.ScrapeResultSink(job_id).iter_records())
+    assert sorted(record['url'] for record in records) == urls[2:]
+    assert all(record['markdown'] for record in records)
+    assert all('markdown' not in record for record in store.get_records(job_id))
+
+    table = pq.read_table(app.ScrapeResultSink(job_id).to_parquet(str(tmp_path / 'results.parquet'), batch_size=1))
+    assert sorted(table.column('url').to_pylist()) == urls[2:]
+    assert 'llm_seconds' in json.loads(table.column('metrics')[0].as_py())
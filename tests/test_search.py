@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+
+import interi_ai_app as app
+
+
+def make_catalog(prices, widths=None):
+    count = len(prices)
+    return pd.DataFrame({
+        'url': [f'https://example.com/product/{i}/' for i in range(count)],
+        'taste': ['ナチュラル'] * count,
+        'delivery': ['在庫品'] * count,
+        'price_band': app.price_band_of(prices),
+        'category': ['ダイニングチェア'] * count,
+        'width_mm': widths if widths is not None else [500.0] * count,
+        'depth_mm': [500.0] * count,
+        'height_mm': [800.0] * count,
+        'seat_height_mm': [420.0] * count,
+        'price_yen': prices,
+    })
+
+
+def make_conditions(**overrides):
+    row = {
+        'テイスト': ['ナチュラル'],
+        '納期': ['在庫品'],
+        '価格帯': ['Low', 'Middle', 'High'],
+        'カテゴリ': ['チェア・椅子'],
+        '幅': app.FURNITURE_CONDITIONS['幅'],
+        '奥行': app.FURNITURE_CONDITIONS['奥行'],
+        '高さ': app.FURNITURE_CONDITIONS['高さ'],
+        '座面高': app.FURNITURE_CONDITIONS['座面高'],
+    }
+    row.update(overrides)
+    return pd.DataFrame([row])
+
+
+def test_tied_scores_return_cheapest_products():
+    # 全範囲の条件では全商品が同点になるため、価格の安い順に上位を返す
+    prices = np.random.default_rng(0).permutation(np.arange(1, 1001) * 1000.0)
+    results = app.match_furniture_conditions(make_conditions(), make_catalog(prices), top_k=5)
+    assert results[0]['price_yen'].tolist() == [1000.0, 2000.0, 3000.0, 4000.0, 5000.0]
+
+
+def test_score_ranks_before_price():
+    # 範囲の中央に近い商品を優先し、同点の商品は価格の安い順にする
+    catalog = make_catalog([3000.0, 1000.0, 2000.0, 500.0], widths=[500.0, 500.0, 600.0, 900.0])
+    results = app.match_furniture_conditions(make_conditions(幅=(400, 600)), catalog, top_k=3)
+    assert results[0]['url'].tolist() == [catalog['url'][1], catalog['url'][0], catalog['url'][2]]
+
+
+def test_unmatched_options_are_excluded():
+    catalog = make_catalog([1000.0, 2000.0])
+    catalog.loc[0, 'category'] = '3人掛けソファ'
+    results = app.match_furniture_conditions(make_conditions(), catalog)
+    assert results[0]['url'].tolist() == [catalog['url'][1]]
@@ -0,0 +1,65 @@
+import asyncio
+
+import interi_ai_app as app
+
+ITEM = {
+    'brand_name': 'BENCH FURNITURE',
+    'item_name': 'BENCH-00001 Lounge Chair',
+    'category_text': 'チェア',
+    'delivery': '納期：約3週間',
+    'size': 'W600 D550 H780 SH420',
+    'material': 'Walnut',
+    'price': '¥120,000（税込）',
+}
+EXPECTED = {
+    'brand_name': 'BENCH FURNITURE',
+    'item_name': 'BENCH-00001 Lounge Chair',
+    'category': 'ダイニングチェア',
+    'taste': 'ナチュラル',
+    'delivery': '3週間',
+    'size': 'W600 D550 H780 SH420',
+    'material': 'Walnut',
+    'price': '￥120,000（税込）',
+}
+
+
+def test_schema_output_matching_llm_sample_is_valid():
+    assert app.validate_site_schema_product(app.site_schema_item_fields(ITEM), EXPECTED)
+
+
+def test_wrong_nodes_are_rejected_even_if_rule_fields_match():
+    # ルールで抽出した価格・サイズが正しくても、スキーマが別の要素を取っていれば不合格にする
+    for name, value in [('brand_name', 'OTHER BRAND'), ('material', 'Steel'), ('delivery', '在庫品'),
+                        ('price', '¥98,000'), ('size', 'W500 D500 H700')]:
+        fields = app.site_schema_item_fields(dict(ITEM, **{name: value}))
+        assert not app.validate_site_schema_product(fields, EXPECTED), name
+
+
+def test_field_missing_from_schema_output_is_rejected():
+    fields = app.site_schema_item_fields(dict(ITEM, material=''))
+    assert not app.validate_site_schema_product(fields, EXPECTED)
+
+
+def test_runtime_validation_requires_name_and_price_or_size():
+    assert app.validate_site_schema_product(app.site_schema_item_fields(ITEM))
+    assert not app.validate_site_schema_product(app.site_schema_item_fields(dict(ITEM, item_name='')))
+    assert not app.validate_site_schema_product(app.site_schema_item_fields(dict(ITEM, price='', size='')))
+
+
+def test_build_product_uses_learned_semantics_and_rule_fields():
+    semantic_map = {app.normalize_field_text('チェア'): {'category': 'ダイニングチェア', 'taste': 'ナチュラル'}}
+    product = app.build_site_schema_product(ITEM, semantic_map, {'weight': '5kg'})
+    assert product['category'] == 'ダイニングチェア'
+    assert product['delivery'] == '3週間'
+    assert product['weight'] == '5kg'
+    assert app.build_site_schema_product(dict(ITEM, category_text='ソファ'), semantic_map, {}) is None
+
+
+def test_store_opens_in_wal_mode(tmp_path):
+
+    async def run():
+        async with app.SiteSchemaStore(path=str(tmp_path / 'site_schemas.sqlite3')) as store:
+            async with store._db.execute('PRAGMA journal_mode') as cursor:
+                return (await cursor.fetchone())[0]
+
+    assert asyncio.run(run()) == 'wal'
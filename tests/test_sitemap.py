@@ -0,0 +1,82 @@
+import asyncio
+import gzip
+import http.server
+import threading
+
+import pandas as pd
+import pytest
+
+import interi_ai_app as app
+
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+REQUESTS = []  # サーバーが受けたリクエストのパス
+
+
+def urlset(base_url, paths):
+    urls = ''.join(f'<url><loc>{base_url}{path}</loc><lastmod>2025-01-02T03:04:05+09:00</lastmod>'
+                   f'<changefreq>weekly</changefreq><priority>0.8</priority></url>' for path in paths)
+    return f'<?xml version="1.0" encoding="UTF-8"?><urlset xmlns="{SITEMAP_NS}">{urls}</urlset>'.encode('utf-8')
+
+
+@pytest.fixture
+def server():
+    files = {}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            REQUESTS.append(self.path)
+            if self.path not in files:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/xml')
+            self.end_headers()
+            self.wfile.write(files[self.path])
+
+        def log_message(self, *args):
+            pass
+
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    base_url = f'http://127.0.0.1:{httpd.server_port}'
+    # サイトマップインデックスから通常のサイトマップと.xml.gzのサイトマップを参照する
+    files['/sitemap.xml'] = (
+        f'<?xml version="1.0" encoding="UTF-8"?><sitemapindex xmlns="{SITEMAP_NS}">'
+        f'<sitemap><loc>{base_url}/products.xml</loc></sitemap>'
+        f'<sitemap><loc>{base_url}/more.xml.gz</loc></sitemap>'
+        f'<sitemap><loc>{base_url}/missing.xml</loc></sitemap>'
+        f'<sitemap><loc>{base_url}/sitemap.xml</loc></sitemap>'
+        '</sitemapindex>').encode('utf-8')
+    files['/products.xml'] = urlset(base_url, ['/product/1/', '/product/2/', '/news/1/'])
+    files['/more.xml.gz'] = gzip.compress(urlset(base_url, ['/product/3/']))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    REQUESTS.clear()
+    yield base_url
+    httpd.shutdown()
+
+
+def test_load_sitemap_index_with_gzip_and_patterns(server):
+    df_urls, errors = asyncio.run(app.load_sitemap(f'{server}/sitemap.xml', [r'/product/'], [r'/product/2/']))
+    assert sorted(df_urls['URL']) == [f'{server}/product/1/', f'{server}/product/3/']
+    assert (df_urls['lastmod'].dt.tz is not None) and str(df_urls['lastmod'].iloc[0]) == '2025-01-01 18:04:05+00:00'
+    # 読み込めなかった子サイトマップはエラーとして返し、他の結果は残す
+    assert len(errors) == 1 and 'missing.xml' in errors[0]
+
+
+def test_filter_url_table():
+    df_urls = pd.DataFrame({'URL': ['https://example.com/product/1/', 'https://example.com/news/1/']})
+    assert app.filter_url_table(df_urls, [r'/product/'], [])['URL'].tolist() == ['https://example.com/product/1/']
+    assert app.filter_url_table(df_urls, [], [r'/news/'])['URL'].tolist() == ['https://example.com/product/1/']
+
+
+def test_load_sitemap_cached_reuses_result_until_cleared(server):
+    url = f'{server}/products.xml'
+    df_urls, errors, loaded_at = app.load_sitemap_cached(url)
+    assert len(df_urls) == 3 and errors == []
+    # 同じURLは取得し直さない
+    assert app.load_sitemap_cached(url)[2] == loaded_at
+    assert REQUESTS == ['/products.xml']
+    app.load_sitemap_cached.clear(url)
+    assert app.load_sitemap_cached(url)[2] > loaded_at
+    assert REQUESTS == ['/products.xml', '/products.xml']